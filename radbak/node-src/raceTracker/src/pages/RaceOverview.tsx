@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import DataTable from "../components/DataTable/DataTable";
 import { json, useParams } from "react-router-dom";
 import fetchLeaderboard from "../api/fetchLeaderboard";
@@ -19,23 +19,69 @@ export interface Checkpoint {
   timeLimit: string | null;
 }
 
+interface PassingDelta {
+  race_id: number;
+  runner_id: number;
+  checkpoint_id: number;
+  passing_time: string;
+  rank: number | null;
+}
+
 const RaceOverview = () => {
+  const { raceId } = useParams();
+  const intRaceId = parseInt(raceId!);
+
   // Websocket connection code
   const WS_URL = "ws://" + LOCALHOST_BASE + "/ws"; // TODO: Make this more robust. And does it work on MAC? // And localhost // Or 127.0.0.1
-  useWebSocket(WS_URL, {
-    share: true,
-    shouldReconnect: () => true,
-    onMessage: (event) => {
-      // Run when a new WebSocket alert is received to update the results
-      console.log(`Got a new message!: ${event.data}`);
-      refetch();
-    },
-  });
+  const lastSeq = useRef<number | null>(null); // Resume from here after a reconnect
+  useWebSocket(
+    () =>
+      `${WS_URL}?race_id=${intRaceId}` +
+      (lastSeq.current !== null ? `&since=${lastSeq.current}` : ""),
+    {
+      share: true,
+      shouldReconnect: () => true,
+      onMessage: (event) => {
+        let message;
+        try {
+          message = JSON.parse(event.data);
+        } catch {
+          return; // Not a live update
+        }
+        if (message.type === "hello" && lastSeq.current === null) {
+          lastSeq.current = message.seq;
+        } else if (message.type === "reset") {
+          refetch();
+        } else if (message.type === "passings") {
+          lastSeq.current = message.seq;
+          const changes = message.passings.filter(
+            (passing: PassingDelta) => passing.race_id === intRaceId
+          );
+          if (changes.length === 0) return;
+          const knownRunner = (passing: PassingDelta) =>
+            runners.some((runner) => runner.id === passing.runner_id);
+          if (!changes.every(knownRunner)) {
+            refetch(); // A runner we don't know about yet
+            return;
+          }
+          // Apply the new passings without reloading the whole race
+          setRunners((current) =>
+            current.map((runner) => {
+              const times = { ...runner.times };
+              changes
+                .filter((passing: PassingDelta) => passing.runner_id === runner.id)
+                .forEach((passing: PassingDelta) => {
+                  times[passing.checkpoint_id] = new Date(passing.passing_time);
+                });
+              return { ...runner, times };
+            })
+          );
+        }
+      },
+    }
+  );
 
   // Non-websocket-code:
-  const { raceId } = useParams();
-  const intRaceId = parseInt(raceId!);
-
   // Fetch data
   const {
     data: raceOverview,
@@ -0,0 +1,161 @@
+import asyncio
+import zlib
+from typing import AsyncIterable, AsyncIterator
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# Detached race partitions are kept here until they are restored or purged
+SCHEMA = "archive"
+COLUMNS = ["raceid", "runnerid", "checkpointid", "passingtime"]
+
+# wbits for zlib that produce and accept gzip framing
+GZIP = 31
+
+
+def partition_name(race_id: int) -> str:
+    return f"checkpointpassing_r{race_id}"
+
+
+async def is_archived(conn: AsyncConnection, race_id: int) -> bool:
+    result = await conn.execute(
+        sa.text("SELECT to_regclass(:name) IS NOT NULL"),
+        {"name": f"{SCHEMA}.{partition_name(race_id)}"},
+    )
+    return result.scalar()
+
+
+async def archive_race(conn: AsyncConnection, race_id: int) -> int:
+    """Detach a race's passings into the archive schema and return how many."""
+    name = partition_name(race_id)
+    await conn.execute(
+        sa.text(f"ALTER TABLE CheckpointPassing DETACH PARTITION {name}")
+    )
+    # Lets a later ATTACH trust the rows instead of scanning them
+    await conn.execute(
+        sa.text(
+            f"ALTER TABLE {name} ADD CONSTRAINT {name}_race CHECK (RaceID = {race_id})"
+        )
+    )
+    await conn.execute(sa.text(f"ALTER TABLE {name} SET SCHEMA {SCHEMA}"))
+    await conn.execute(
+        sa.text("UPDATE Race SET ArchivedAt = NOW() WHERE RaceID = :race_id"),
+        {"race_id": race_id},
+    )
+    result = await conn.execute(sa.text(f"SELECT COUNT(*) FROM {SCHEMA}.{name}"))
+    return result.scalar()
+
+
+async def restore_race(conn: AsyncConnection, race_id: int) -> None:
+    """Attach an archived race's passings back to CheckpointPassing."""
+    name = partition_name(race_id)
+    await conn.execute(sa.text(f"ALTER TABLE {SCHEMA}.{name} SET SCHEMA public"))
+    await conn.execute(
+        sa.text(
+            f"ALTER TABLE CheckpointPassing ATTACH PARTITION {name}"
+            f" FOR VALUES IN ({race_id})"
+        )
+    )
+    await conn.execute(
+        sa.text(f"ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {name}_race")
+    )
+    await conn.execute(
+        sa.text("UPDATE Race SET ArchivedAt = NULL WHERE RaceID = :race_id"),
+        {"race_id": race_id},
+    )
+
+
+async def purge_race(conn: AsyncConnection, race_id: int) -> None:
+    """Drop an archived race's passings, once they have been exported."""
+    await conn.execute(
+        sa.text(f"DROP TABLE IF EXISTS {SCHEMA}.{partition_name(race_id)}")
+    )
+
+
+async def drop_race(conn: AsyncConnection, race_id: int) -> None:
+    """Drop a race's passings wherever they are, before deleting the race."""
+    await conn.execute(sa.text(f"DROP TABLE IF EXISTS {partition_name(race_id)}"))
+    await purge_race(conn, race_id)
+
+
+async def export_race(conn: AsyncConnection, race_id: int) -> AsyncIterator[bytes]:
+    """Stream an archived race's passings as gzip compressed CSV.
+
+    COPY writes into a small queue that the caller drains, so the export is
+    never held in memory as a whole. If the caller stops early, e.g. because
+    the client disconnected, the COPY is cancelled and waited for, so the
+    connection is free again once this returns.
+    """
+    raw = (await conn.get_raw_connection()).driver_connection
+    chunks: asyncio.Queue[bytes | None] = asyncio.Queue(maxsize=16)
+
+    async def copy() -> None:
+        try:
+            await raw.copy_from_table(
+                partition_name(race_id),
+                schema_name=SCHEMA,
+                columns=COLUMNS,
+                output=chunks.put,
+                format="csv",
+                header=True,
+            )
+        except asyncio.CancelledError:
+            # Nobody is reading any more, and a put could wait forever
+            raise
+        except Exception:
+            # Wake the reader, which raises the error from the task
+            await chunks.put(None)
+            raise
+        await chunks.put(None)
+
+    compressor = zlib.compressobj(wbits=GZIP)
+    task = asyncio.create_task(copy())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        await task
+        yield compressor.flush()
+    finally:
+        task.cancel()
+        await asyncio.wait([task])
+
+
+async def import_race(
+    conn: AsyncConnection, race_id: int, source: AsyncIterable[bytes]
+) -> int:
+    """Load an exported race into the archive, ready to be restored."""
+    name = partition_name(race_id)
+    await conn.execute(
+        sa.text(
+            f"CREATE TABLE {SCHEMA}.{name}"
+            " (LIKE CheckpointPassing INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+    )
+    await conn.execute(
+        sa.text(
+            f"ALTER TABLE {SCHEMA}.{name}"
+            f" ADD CONSTRAINT {name}_race CHECK (RaceID = {race_id})"
+        )
+    )
+
+    async def decompressed() -> AsyncIterator[bytes]:
+        decompressor = zlib.decompressobj(wbits=GZIP)
+        async for chunk in source:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        yield decompressor.flush()
+
+    raw = (await conn.get_raw_connection()).driver_connection
+    status = await raw.copy_to_table(
+        name,
+        schema_name=SCHEMA,
+        columns=COLUMNS,
+        source=decompressed(),
+        format="csv",
+        header=True,
+    )
+    # asyncpg returns the command tag, e.g. "COPY 1200"
+    return int(status.split()[-1])
@@ -0,0 +1,191 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from . import db
+
+
+class RaceRoute:
+    """Tags, checkpoint order and progress of every runner in one race."""
+
+    def __init__(self, race_id: int, start_time: datetime) -> None:
+        self.race_id = race_id
+        self.start_time = start_time
+        self.tags: dict[str, int] = {}
+        # DeviceID -> [(Position, CheckpointID)] ordered by position
+        self.devices: dict[int, list[tuple[int, int]]] = {}
+        self.positions: dict[int, int] = {}
+        self.passed: dict[int, set[int]] = {}
+
+    def next_checkpoint(self, runner_id: int, device_id: int) -> int | None:
+        passed = self.passed.get(runner_id, ())
+        for _, checkpoint_id in self.devices.get(device_id, ()):
+            if checkpoint_id not in passed:
+                return checkpoint_id
+        return None
+
+    def next_position(self, runner_id: int) -> int | None:
+        passed = self.passed.get(runner_id, ())
+        remaining = [
+            position
+            for checkpoint_id, position in self.positions.items()
+            if checkpoint_id not in passed
+        ]
+        return min(remaining, default=None)
+
+
+class ResolutionCache:
+    """Per-race tag and route lookups kept in the API process.
+
+    Races are loaded at startup when they start within `window` of now, and
+    reloaded when a "cache" notification names them. A tag that is not
+    cached is a miss and must be resolved by the database instead.
+    """
+
+    def __init__(self, window: timedelta = timedelta(hours=24)) -> None:
+        self.window = window
+        self.engine: AsyncEngine | None = None
+        self.races: dict[int, RaceRoute] = {}
+        self.tags: dict[str, tuple[int, int]] = {}
+
+    def load(
+        self,
+        race_id: int,
+        start_time: datetime,
+        runners: Iterable[tuple[str, int]],
+        checkpoints: Iterable[tuple[int, int, int]],
+        passings: Iterable[tuple[int, int, datetime]],
+    ) -> RaceRoute:
+        route = RaceRoute(race_id, start_time)
+        for tag_id, runner_id in runners:
+            route.tags[tag_id] = runner_id
+        for device_id, checkpoint_id, position in sorted(
+            checkpoints, key=lambda checkpoint: checkpoint[2]
+        ):
+            route.devices.setdefault(device_id, []).append((position, checkpoint_id))
+            route.positions[checkpoint_id] = position
+        for runner_id, checkpoint_id, _ in passings:
+            route.passed.setdefault(runner_id, set()).add(checkpoint_id)
+
+        self.drop(race_id)
+        self.races[race_id] = route
+        for tag_id, runner_id in route.tags.items():
+            current = self.tags.get(tag_id)
+            # A reused tag resolves to the latest race, like the database does
+            if current is None or self.races[current[1]].start_time <= start_time:
+                self.tags[tag_id] = (runner_id, race_id)
+        return route
+
+    def drop(self, race_id: int) -> None:
+        route = self.races.pop(race_id, None)
+        if route is None:
+            return
+        for tag_id in route.tags:
+            if self.tags.get(tag_id, (None, None))[1] == race_id:
+                del self.tags[tag_id]
+
+    def clear(self) -> None:
+        self.races.clear()
+        self.tags.clear()
+
+    def lookup(self, tag_id: str) -> tuple[int, RaceRoute] | None:
+        """Return the runner and race route for a tag, or None on a cache miss."""
+        if tag_id not in self.tags:
+            return None
+        runner_id, race_id = self.tags[tag_id]
+        return runner_id, self.races[race_id]
+
+    def record(
+        self, race_id: int, runner_id: int, checkpoint_id: int, passing_time: datetime
+    ) -> None:
+        route = self.races.get(race_id)
+        if route is None:
+            return
+        route.passed.setdefault(runner_id, set()).add(checkpoint_id)
+
+    async def warm(self, conn: AsyncConnection, race_id: int) -> RaceRoute | None:
+        result = await conn.execute(
+            sa.text(
+                "SELECT startTime FROM Race"
+                " WHERE RaceID = :race_id AND ArchivedAt IS NULL"
+            ),
+            {"race_id": race_id},
+        )
+        start_time = result.scalar()
+        if start_time is None:
+            self.drop(race_id)
+            return None
+
+        runners = await conn.execute(
+            sa.text("SELECT TagID, RunnerID FROM RunnerInRace WHERE RaceID = :race_id"),
+            {"race_id": race_id},
+        )
+        checkpoints = await conn.execute(
+            sa.text(
+                """
+                SELECT c.DeviceID, cir.CheckpointID, cir.Position
+                FROM Checkpoint c
+                JOIN CheckpointInRace cir ON cir.CheckpointID = c.CheckpointID
+                WHERE cir.RaceID = :race_id
+                """
+            ),
+            {"race_id": race_id},
+        )
+        passings = await conn.execute(
+            sa.text(
+                """
+                SELECT RunnerID, CheckpointID, PassingTime
+                FROM CheckpointPassing
+                WHERE RaceID = :race_id
+                """
+            ),
+            {"race_id": race_id},
+        )
+        return self.load(
+            race_id,
+            start_time,
+            runners.tuples().all(),
+            checkpoints.tuples().all(),
+            passings.tuples().all(),
+        )
+
+    async def warm_active(self, conn: AsyncConnection) -> None:
+        result = await conn.execute(
+            sa.text(
+                "SELECT RaceID FROM Race WHERE startTime BETWEEN :earliest AND :latest"
+                " AND ArchivedAt IS NULL"
+            ),
+            {
+                "earliest": datetime.now() - self.window,
+                "latest": datetime.now() + self.window,
+            },
+        )
+        for race_id in result.scalars().all():
+            await self.warm(conn, race_id)
+
+    async def refresh(self, race_id: int | None = None) -> None:
+        """Reload one race, or every cached and active race when None."""
+        if self.engine is None:
+            return
+        try:
+            async with db.get_connection(self.engine) as conn:
+                if race_id is not None:
+                    await self.warm(conn, race_id)
+                    return
+                cached = list(self.races)
+                self.clear()
+                for cached_race_id in cached:
+                    await self.warm(conn, cached_race_id)
+                await self.warm_active(conn)
+        except Exception:
+            logging.exception("Could not refresh resolution cache")
+            if race_id is None:
+                self.clear()
+            else:
+                self.drop(race_id)
+
+
+resolution_cache = ResolutionCache()
@@ -1,10 +1,13 @@
 import logging
+import time
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, NamedTuple
 
+import asyncpg
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
 
+from . import metrics
 from .settings import Settings, get_settings
 
 
@@ -22,7 +25,9 @@ def get_engine(settings: Settings | None = None) -> AsyncEngine:
 async def get_connection(
     engine: AsyncEngine,
 ) -> AsyncGenerator[AsyncConnection, None]:
+    started = time.perf_counter()
     async with engine.connect() as conn:
+        metrics.DB_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
         try:
             yield conn
             await conn.commit()
@@ -44,3 +49,79 @@ async def get_single_connection(
         pass
     finally:
         await engine.dispose()
+
+
+class Statement(NamedTuple):
+    """A hot query, defined once and prepared on each pooled connection.
+
+    The SQL uses asyncpg's $1 style parameters. Statements skip SQLAlchemy
+    altogether and return asyncpg records, and run in the connection's
+    transaction when it has one. Statements that must commit together are
+    run inside transaction().
+    """
+
+    name: str
+    sql: str
+
+
+@asynccontextmanager
+async def transaction(conn: AsyncConnection) -> AsyncGenerator[None, None]:
+    """Commit the statements run inside as one.
+
+    SQLAlchemy only begins a transaction on its first execute, so without one
+    each statement would commit on its own. In a transaction that has begun,
+    the statements run in a savepoint of it instead.
+    """
+    pooled = await conn.get_raw_connection()
+    async with pooled.driver_connection.transaction():
+        yield
+
+
+async def prepare(
+    conn: AsyncConnection, statement: Statement
+) -> asyncpg.prepared_stmt.PreparedStatement:
+    pooled = await conn.get_raw_connection()
+    # info lives as long as the database connection, across checkouts
+    prepared = pooled.info.setdefault("prepared", {})
+    if statement.name not in prepared:
+        prepared[statement.name] = await pooled.driver_connection.prepare(statement.sql)
+    return prepared[statement.name]
+
+
+async def run(
+    conn: AsyncConnection, statement: Statement, method: str, *args: Any
+) -> Any:
+    started = time.perf_counter()
+    prepared = await prepare(conn, statement)
+    try:
+        result = await getattr(prepared, method)(*args)
+    except (
+        asyncpg.exceptions.InvalidCachedStatementError,
+        asyncpg.exceptions.OutdatedSchemaCacheError,
+    ):
+        # A migration changed what the statement returns. Outside a
+        # transaction it can be prepared again right away.
+        pooled = await conn.get_raw_connection()
+        del pooled.info["prepared"][statement.name]
+        if pooled.driver_connection.is_in_transaction():
+            raise
+        prepared = await prepare(conn, statement)
+        result = await getattr(prepared, method)(*args)
+    metrics.DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement.name)
+    return result
+
+
+async def fetch(
+    conn: AsyncConnection, statement: Statement, *args: Any
+) -> list[asyncpg.Record]:
+    return await run(conn, statement, "fetch", *args)
+
+
+async def fetchrow(
+    conn: AsyncConnection, statement: Statement, *args: Any
+) -> asyncpg.Record | None:
+    return await run(conn, statement, "fetchrow", *args)
+
+
+async def fetchval(conn: AsyncConnection, statement: Statement, *args: Any) -> Any:
+    return await run(conn, statement, "fetchval", *args)
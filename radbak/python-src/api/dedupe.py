@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+class Burst:
+    __slots__ = ("first", "last", "seen_at")
+
+    def __init__(self, passing_time: datetime, seen_at: float) -> None:
+        self.first = passing_time
+        self.last = passing_time
+        self.seen_at = seen_at
+
+
+class ReadWindow:
+    """Drops repeated reads of a tag at a checkpoint before they reach the database.
+
+    A checkpoint reads a tag again every scan for as long as the runner stands
+    on the mat. Reads of the same (TagID, DeviceID) belong to one burst while
+    each comes within `window` of the burst, by passing time. The first read
+    of a burst is kept and the rest are duplicates.
+
+    Only reads that were added are remembered, once their transaction has
+    committed: every worker, this one included, remembers them from the
+    "reads" notification. A read that fails, or resolves to no passing, is
+    not remembered, so a retry of it is recorded. Repeats only stretch the
+    burst they belong to. Repeats of reads not yet committed get past the
+    window, and the insert statements in ingest.py skip them.
+
+    Bursts are forgotten `retention` after their last added read arrived, and
+    only the `max_entries` most recently added are kept.
+    """
+
+    def __init__(
+        self,
+        window: timedelta = timedelta(seconds=5),
+        retention: timedelta = timedelta(minutes=5),
+        max_entries: int = 100_000,
+    ) -> None:
+        self.window = window
+        self.retention = retention
+        self.max_entries = max_entries
+        # Least recently seen first
+        self.bursts: OrderedDict[tuple[str, int], Burst] = OrderedDict()
+
+    def expire(self, now: float) -> None:
+        oldest = now - self.retention.total_seconds()
+        while self.bursts:
+            burst = next(iter(self.bursts.values()))
+            if burst.seen_at > oldest:
+                break
+            self.bursts.popitem(last=False)
+
+    def is_duplicate(self, tag_id: str, device_id: int, passing_time: datetime) -> bool:
+        """Whether a read repeats a burst of an added read."""
+        self.expire(time.monotonic())
+        burst = self.bursts.get((tag_id, device_id))
+        if burst is None or not (
+            burst.first - self.window < passing_time < burst.last + self.window
+        ):
+            return False
+        burst.last = max(burst.last, passing_time)
+        return True
+
+    def remember(self, tag_id: str, device_id: int, passing_time: datetime) -> None:
+        """Remember an added read, starting a burst or stretching its own."""
+        now = time.monotonic()
+        key = (tag_id, device_id)
+        if self.is_duplicate(tag_id, device_id, passing_time):
+            self.bursts[key].seen_at = now
+        else:
+            self.bursts[key] = Burst(passing_time, now)
+        self.bursts.move_to_end(key)
+        if len(self.bursts) > self.max_entries:
+            self.bursts.popitem(last=False)
+
+    def clear(self) -> None:
+        self.bursts.clear()
+
+
+read_window = ReadWindow()
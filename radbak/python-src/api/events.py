@@ -0,0 +1,246 @@
+"""Live events shared by every API worker, on every node.
+
+Accepted passings are written to the LiveEvent outbox in the transaction
+that adds them, one event per ingest call however many passings it holds.
+Each worker has a single relay task that tails the outbox in batches and
+fans the events out. A "passing" notification with the new EventID only
+wakes the relays early; however many arrive, a relay reads everything new in
+one query, and it polls anyway in case one is lost.
+
+EventIDs are taken before the transaction commits, so a lower ID can become
+visible after a higher one. Relays therefore number events in the order they
+become visible: whichever relay gets there first gives every newly committed
+event the next Seq, holding the LiveEventOrder row until it commits. Seqs
+have no gaps and only ever grow, so every worker reads the same events in the
+same order, and websocket clients resume after a Seq from memory or from the
+outbox.
+
+Accepted reads only feed each worker's read window and are sent as
+notifications themselves, packed to fit.
+"""
+
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, NamedTuple
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from api import db
+
+# pg_notify rejects payloads of 8000 bytes or more, leave room to spare
+MAX_PAYLOAD_BYTES = 7900
+
+# Added passings, then the accepted reads so every worker drops their
+# repeats (see api/dedupe.py), as one round trip
+NOTIFY_ADDED = db.Statement(
+    "notify_added",
+    """
+    WITH event AS (INSERT INTO LiveEvent (Payload) VALUES ($1) RETURNING EventID)
+    SELECT pg_notify('passing', EventID::TEXT) FROM event
+    UNION ALL
+    SELECT pg_notify('reads', payload) FROM unnest($2::TEXT[]) AS payload
+    """,
+)
+# Held until the numbering commits, so one relay at a time numbers events
+# and it sees every event committed before it
+LOCK_ORDER = "SELECT LastSeq FROM LiveEventOrder FOR UPDATE"
+HAS_UNORDERED = db.Statement(
+    "has_unordered", "SELECT EXISTS (SELECT 1 FROM LiveEvent WHERE Seq IS NULL)"
+)
+ORDER_EVENTS = db.Statement(
+    "order_events",
+    """
+    WITH pending AS (
+        SELECT EventID, row_number() OVER (ORDER BY EventID) AS n
+        FROM LiveEvent WHERE Seq IS NULL
+    ),
+    ordered AS (
+        UPDATE LiveEvent e SET Seq = o.LastSeq + pending.n
+        FROM pending, LiveEventOrder o
+        WHERE e.EventID = pending.EventID
+        RETURNING e.Seq
+    )
+    UPDATE LiveEventOrder SET LastSeq = (SELECT max(Seq) FROM ordered)
+    WHERE EXISTS (SELECT 1 FROM ordered)
+    """,
+)
+READ_EVENTS = db.Statement(
+    "read_events",
+    "SELECT Seq, Payload FROM LiveEvent WHERE Seq > $1 ORDER BY Seq LIMIT $2",
+)
+LAST_EVENT = db.Statement("last_event", "SELECT LastSeq FROM LiveEventOrder")
+# The oldest Seq still kept, or the next to be given if none are, and the newest
+EVENT_RANGE = db.Statement(
+    "event_range",
+    """
+    SELECT coalesce((SELECT min(Seq) FROM LiveEvent), LastSeq + 1), LastSeq
+    FROM LiveEventOrder
+    """,
+)
+# Only ever a prefix by Seq, so the events kept have no gaps
+PRUNE_EVENTS = db.Statement(
+    "prune_events",
+    """
+    DELETE FROM LiveEvent WHERE Seq <= (
+        SELECT max(Seq) FROM LiveEvent WHERE CreatedAt < NOW() - $1::INTERVAL
+    )
+    """,
+)
+
+
+class Passing(NamedTuple):
+    race_id: int
+    runner_id: int
+    checkpoint_id: int
+    passing_time: datetime
+
+
+def encode_passing(passing: Passing) -> str:
+    return (
+        f"{passing.race_id}:{passing.runner_id}:{passing.checkpoint_id}:"
+        f"{passing.passing_time.isoformat()}"
+    )
+
+
+class Read(NamedTuple):
+    """A checkpoint read as it arrives, before it is resolved to a passing."""
+
+    tag_id: str
+    device_id: int
+    passing_time: datetime
+
+
+def encode_read(read: Read) -> str:
+    # The tag goes last since it is the only free-form field
+    return f"{read.device_id}|{read.passing_time.isoformat()}|{read.tag_id}"
+
+
+def pack_lines(lines: Iterable[str]) -> list[str]:
+    """Pack lines into as few notification payloads as fit."""
+    payloads: list[str] = []
+    packed: list[str] = []
+    size = 0
+    for line in lines:
+        if packed and size + len(line) + 1 > MAX_PAYLOAD_BYTES:
+            payloads.append("\n".join(packed))
+            packed, size = [], 0
+        packed.append(line)
+        size += len(line) + 1
+    if packed:
+        payloads.append("\n".join(packed))
+    return payloads
+
+
+def encode_passings(passings: Iterable[Passing]) -> str:
+    """The payload of an event, one passing per line."""
+    return "\n".join(encode_passing(passing) for passing in passings)
+
+
+def encode_reads(reads: Iterable[Read]) -> list[str]:
+    return pack_lines(encode_read(read) for read in reads)
+
+
+def decode_reads(payload: str) -> list[Read]:
+    reads = []
+    for line in payload.splitlines():
+        device_id, passing_time, tag_id = line.split("|", 2)
+        reads.append(Read(tag_id, int(device_id), datetime.fromisoformat(passing_time)))
+    return reads
+
+
+def decode_passings(payload: str) -> list[Passing]:
+    passings = []
+    for line in payload.splitlines():
+        race_id, runner_id, checkpoint_id, passing_time = line.split(":", 3)
+        passings.append(
+            Passing(
+                int(race_id),
+                int(runner_id),
+                int(checkpoint_id),
+                datetime.fromisoformat(passing_time),
+            )
+        )
+    return passings
+
+
+class Event(NamedTuple):
+    seq: int
+    passings: list[Passing]
+
+
+class Outbox:
+    """Numbers and tails the LiveEvent outbox for this worker's relay, and
+    keeps it short.
+
+    Relaying starts from the newest Seq when the worker starts, and again if
+    the outbox is reset; `started` is where it last started. Events are kept
+    for `retention`, and any worker removes older ones every
+    `prune_interval`.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 500,
+        poll_interval: float = 1,
+        retention: timedelta = timedelta(hours=1),
+        prune_interval: float = 60,
+    ) -> None:
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.engine: AsyncEngine | None = None
+        # The newest Seq relayed
+        self.last: int | None = None
+        self.started: int | None = None
+        self.pruned_at = time.monotonic()
+
+    def receive(self, last_seq: int, rows: Iterable[tuple[int, str]]) -> list[Event]:
+        """The events among rows not yet relayed, last_seq being the newest Seq."""
+        if self.last is None or last_seq < self.last:
+            # Caches are loaded from the database at startup, so only events
+            # from now on are relayed
+            self.last = self.started = last_seq
+            return []
+        received = [
+            Event(seq, decode_passings(payload))
+            for seq, payload in rows
+            if seq > self.last
+        ]
+        if received:
+            self.last = received[-1].seq
+        return received
+
+    async def poll(self) -> list[Event]:
+        """Up to `batch_size` events that this worker has not relayed yet."""
+        async with db.get_connection(self.engine) as conn:
+            if await db.fetchval(conn, HAS_UNORDERED):
+                await conn.execute(sa.text(LOCK_ORDER))
+                await db.fetch(conn, ORDER_EVENTS)
+            last_seq = await db.fetchval(conn, LAST_EVENT)
+            rows = []
+            if self.last is not None and last_seq > self.last:
+                rows = await db.fetch(conn, READ_EVENTS, self.last, self.batch_size)
+        # Only once the numbering has committed
+        return self.receive(last_seq, rows)
+
+    async def since(self, seq: int, limit: int) -> list[Event] | None:
+        """Up to limit events after seq, or None if they are not all kept."""
+        async with db.get_connection(self.engine) as conn:
+            first, last = await db.fetchrow(conn, EVENT_RANGE)
+            if seq + 1 < first or seq > last:
+                return None
+            rows = await db.fetch(conn, READ_EVENTS, seq, limit)
+        return [Event(seq, decode_passings(payload)) for seq, payload in rows]
+
+    async def prune(self) -> None:
+        """Remove expired events, if it is time to."""
+        if time.monotonic() - self.pruned_at < self.prune_interval:
+            return
+        self.pruned_at = time.monotonic()
+        async with db.get_connection(self.engine) as conn:
+            await db.fetch(conn, PRUNE_EVENTS, self.retention)
+
+
+outbox = Outbox()
@@ -0,0 +1,372 @@
+from collections import defaultdict
+from datetime import datetime
+from enum import StrEnum
+from typing import Sequence
+
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from api import db, events, metrics
+from api.cache import resolution_cache
+from api.dedupe import ReadWindow, read_window
+from api.events import Read
+
+
+class Outcome(StrEnum):
+    ADDED = "added"
+    UNKNOWN_TAG = "unknown_tag"
+    DUPLICATE = "duplicate"
+    NO_CHECKPOINT = "no_checkpoint"
+
+
+# A read repeats a passing when the runner already passed a checkpoint of the
+# same device within the read window. The in-memory window only knows of
+# committed reads, so this also catches repeats that were still in flight,
+# which would otherwise be taken for the device's next checkpoint.
+DUPLICATE_PASSING = """
+    SELECT 1 FROM CheckpointPassing cp
+    JOIN Checkpoint c ON c.CheckpointID = cp.CheckpointID
+    WHERE cp.RaceID = {race_id} AND cp.RunnerID = {runner_id}
+      AND c.DeviceID = {device_id}
+      AND cp.PassingTime > {passing_time} - {window}
+      AND cp.PassingTime < {passing_time} + {window}
+"""
+
+# The function before it took the read window
+DROP_RECORD_PASSING_V1 = (
+    "DROP FUNCTION IF EXISTS record_checkpoint_passing(VARCHAR, BIGINT, TIMESTAMP)"
+)
+
+# Resolves the tag and checkpoint and inserts the passing in a single
+# server-side call, so an ingested read costs one round trip. Repeats of
+# reads already added are mostly dropped by the read window before they get
+# here.
+RECORD_PASSING_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_checkpoint_passing(
+    p_tag_id VARCHAR,
+    p_device_id BIGINT,
+    p_passing_time TIMESTAMP,
+    p_window INTERVAL
+) RETURNS TEXT AS $$
+DECLARE
+    v_runner_id INT;
+    v_race_id INT;
+    v_checkpoint_id INT;
+    v_event_id BIGINT;
+BEGIN
+    SELECT rir.RunnerID, rir.RaceID INTO v_runner_id, v_race_id
+    FROM RunnerInRace rir
+    JOIN Race r ON r.RaceID = rir.RaceID
+    WHERE rir.TagID = p_tag_id AND r.ArchivedAt IS NULL
+    ORDER BY r.startTime DESC
+    LIMIT 1;
+    IF v_runner_id IS NULL THEN
+        RETURN 'unknown_tag';
+    END IF;
+
+    IF EXISTS ({duplicate}) THEN
+        RETURN 'duplicate';
+    END IF;
+
+    SELECT cir.CheckpointID INTO v_checkpoint_id
+    FROM Checkpoint c
+    JOIN CheckpointInRace cir ON cir.CheckpointID = c.CheckpointID
+    WHERE cir.RaceID = v_race_id
+      AND c.DeviceID = p_device_id
+      AND NOT EXISTS (
+          SELECT 1 FROM CheckpointPassing cp
+          WHERE cp.RaceID = v_race_id
+            AND cp.RunnerID = v_runner_id
+            AND cp.CheckpointID = cir.CheckpointID
+      )
+    ORDER BY cir.Position
+    LIMIT 1;
+    IF v_checkpoint_id IS NULL THEN
+        RETURN 'no_checkpoint';
+    END IF;
+
+    INSERT INTO CheckpointPassing (RaceID, RunnerID, CheckpointID, PassingTime)
+    VALUES (v_race_id, v_runner_id, v_checkpoint_id, p_passing_time)
+    ON CONFLICT DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN 'duplicate';
+    END IF;
+
+    -- Let every worker update its cache and standings, and the live feed.
+    INSERT INTO LiveEvent (Payload)
+    VALUES (format(
+        '%s:%s:%s:%s', v_race_id, v_runner_id, v_checkpoint_id, p_passing_time
+    ))
+    RETURNING EventID INTO v_event_id;
+    PERFORM pg_notify('passing', v_event_id::TEXT);
+    PERFORM pg_notify(
+        'reads',
+        format('%s|%s|%s', p_device_id, p_passing_time, p_tag_id)
+    );
+    RETURN 'added';
+END;
+$$ LANGUAGE plpgsql;
+""".format(
+    duplicate=DUPLICATE_PASSING.format(
+        race_id="v_race_id",
+        runner_id="v_runner_id",
+        device_id="p_device_id",
+        passing_time="p_passing_time",
+        window="p_window",
+    )
+)
+
+RECORD_PASSING = db.Statement(
+    "record_passing", "SELECT record_checkpoint_passing($1, $2, $3, $4)"
+)
+# A passing for a cached tag, already resolved to its checkpoint
+INSERT_PASSING = db.Statement(
+    "insert_passing",
+    """
+    WITH added AS (
+        INSERT INTO CheckpointPassing (RaceID, RunnerID, CheckpointID, PassingTime)
+        SELECT $1::INT, $2::INT, $3::INT, $4::TIMESTAMP
+        WHERE NOT EXISTS ({duplicate})
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ),
+    event AS (
+        INSERT INTO LiveEvent (Payload) SELECT $5 FROM added RETURNING EventID
+    )
+    SELECT pg_notify('passing', EventID::TEXT), pg_notify('reads', $6)
+    FROM event
+    """.format(
+        duplicate=DUPLICATE_PASSING.format(
+            race_id="$1",
+            runner_id="$2",
+            device_id="$7",
+            passing_time="$4::TIMESTAMP",
+            window="$8::INTERVAL",
+        )
+    ),
+)
+RESOLVE_TAGS = db.Statement(
+    "resolve_tags",
+    """
+    SELECT DISTINCT ON (rir.TagID) rir.TagID, rir.RunnerID, rir.RaceID
+    FROM RunnerInRace rir
+    JOIN Race r ON r.RaceID = rir.RaceID
+    WHERE rir.TagID = ANY($1) AND r.ArchivedAt IS NULL
+    ORDER BY rir.TagID, r.startTime DESC
+    """,
+)
+RACE_ROUTES = db.Statement(
+    "race_routes",
+    """
+    SELECT cir.RaceID, c.DeviceID, cir.CheckpointID
+    FROM Checkpoint c
+    JOIN CheckpointInRace cir ON cir.CheckpointID = c.CheckpointID
+    WHERE cir.RaceID = ANY($1)
+    ORDER BY cir.Position
+    """,
+)
+PASSED_CHECKPOINTS = db.Statement(
+    "passed_checkpoints",
+    """
+    SELECT cp.RunnerID, cp.CheckpointID
+    FROM CheckpointPassing cp
+    JOIN unnest($1::INT[], $2::INT[]) AS entry(RunnerID, RaceID)
+      ON entry.RaceID = cp.RaceID AND entry.RunnerID = cp.RunnerID
+    WHERE cp.RaceID = ANY($2)
+    """,
+)
+INSERT_PASSINGS = db.Statement(
+    "insert_passings",
+    """
+    INSERT INTO CheckpointPassing (RaceID, RunnerID, CheckpointID, PassingTime)
+    SELECT entry.RaceID, entry.RunnerID, entry.CheckpointID, entry.PassingTime
+    FROM unnest($1::INT[], $2::INT[], $3::INT[], $4::TIMESTAMP[], $5::BIGINT[])
+      AS entry(RaceID, RunnerID, CheckpointID, PassingTime, DeviceID)
+    WHERE NOT EXISTS ({duplicate})
+    ON CONFLICT DO NOTHING
+    RETURNING RunnerID, CheckpointID
+    """.format(
+        duplicate=DUPLICATE_PASSING.format(
+            race_id="entry.RaceID",
+            runner_id="entry.RunnerID",
+            device_id="entry.DeviceID",
+            passing_time="entry.PassingTime",
+            window="$6::INTERVAL",
+        )
+    ),
+)
+
+
+def counted(*outcomes: Outcome) -> None:
+    for outcome in outcomes:
+        metrics.INGEST_READS.inc(outcome.value)
+
+
+async def record_passing(
+    conn: AsyncConnection,
+    tag_id: str,
+    device_id: int,
+    passing_time: datetime,
+) -> Outcome:
+    if read_window.is_duplicate(tag_id, device_id, passing_time):
+        counted(Outcome.DUPLICATE)
+        return Outcome.DUPLICATE
+
+    found = resolution_cache.lookup(tag_id)
+    if found is not None:
+        runner_id, route = found
+        checkpoint_id = route.next_checkpoint(runner_id, device_id)
+        if checkpoint_id is None:
+            counted(Outcome.NO_CHECKPOINT)
+            return Outcome.NO_CHECKPOINT
+
+        passing = events.Passing(route.race_id, runner_id, checkpoint_id, passing_time)
+        added = await db.fetchrow(
+            conn,
+            INSERT_PASSING,
+            route.race_id,
+            runner_id,
+            checkpoint_id,
+            passing_time,
+            events.encode_passing(passing),
+            events.encode_read(Read(tag_id, device_id, passing_time)),
+            device_id,
+            read_window.window,
+        )
+        if added is not None:
+            # Caches and standings are updated by the relay once this commits
+            counted(Outcome.ADDED)
+            return Outcome.ADDED
+
+    # A repeat, or another worker got there first: let the database decide
+    outcome = Outcome(
+        await db.fetchval(
+            conn, RECORD_PASSING, tag_id, device_id, passing_time, read_window.window
+        )
+    )
+    if found is not None and outcome != Outcome.DUPLICATE:
+        route.passed.setdefault(runner_id, set()).add(checkpoint_id)
+    counted(outcome)
+    return outcome
+
+
+async def record_passings(
+    conn: AsyncConnection, reads: Sequence[Read]
+) -> list[Outcome]:
+    """Record a batch of reads with a fixed number of round trips.
+
+    Repeated reads are dropped by the read window before any SQL runs, and
+    the insert skips repeats of passings the window did not know of yet. Tags,
+    routes and earlier passings are resolved set-wise up front, the reads are
+    then assigned to checkpoints in passing-time order and all accepted
+    passings are inserted with one statement. Their live event and
+    notifications are added for the whole batch at once, in the same
+    transaction.
+    """
+    outcomes = [Outcome.UNKNOWN_TAG] * len(reads)
+    # In passing-time order, so the first read of a burst is the one kept
+    order = sorted(range(len(reads)), key=lambda i: reads[i].passing_time)
+    # The batch's own bursts, since the shared window only learns of reads
+    # once they are committed
+    batch = ReadWindow(window=read_window.window)
+    fresh = []
+    for index in order:
+        read = reads[index]
+        if read_window.is_duplicate(*read) or batch.is_duplicate(*read):
+            outcomes[index] = Outcome.DUPLICATE
+        else:
+            batch.remember(*read)
+            fresh.append(index)
+    if not fresh:
+        counted(*outcomes)
+        return outcomes
+
+    rows = await db.fetch(
+        conn, RESOLVE_TAGS, list({reads[index].tag_id for index in fresh})
+    )
+    runner_by_tag = {row["tagid"]: (row["runnerid"], row["raceid"]) for row in rows}
+    if not runner_by_tag:
+        counted(*outcomes)
+        return outcomes
+
+    entries = list(set(runner_by_tag.values()))
+    race_ids = list({race_id for _, race_id in entries})
+
+    # (RaceID, DeviceID) -> checkpoints ordered by position
+    route: dict[tuple[int, int], list[int]] = defaultdict(list)
+    for race_id, device_id, checkpoint_id in await db.fetch(
+        conn, RACE_ROUTES, race_ids
+    ):
+        route[(race_id, device_id)].append(checkpoint_id)
+
+    passed: dict[int, set[int]] = defaultdict(set)
+    for runner_id, checkpoint_id in await db.fetch(
+        conn,
+        PASSED_CHECKPOINTS,
+        [runner_id for runner_id, _ in entries],
+        [race_id for _, race_id in entries],
+    ):
+        passed[runner_id].add(checkpoint_id)
+
+    accepted: list[tuple[int, int, int, datetime]] = []
+    for index in fresh:
+        read = reads[index]
+        if read.tag_id not in runner_by_tag:
+            continue
+        runner_id, race_id = runner_by_tag[read.tag_id]
+
+        checkpoint_id = next(
+            (
+                checkpoint_id
+                for checkpoint_id in route[(race_id, read.device_id)]
+                if checkpoint_id not in passed[runner_id]
+            ),
+            None,
+        )
+        if checkpoint_id is None:
+            outcomes[index] = Outcome.NO_CHECKPOINT
+            continue
+
+        passed[runner_id].add(checkpoint_id)
+        accepted.append((index, runner_id, checkpoint_id, read.passing_time))
+
+    if not accepted:
+        counted(*outcomes)
+        return outcomes
+
+    # The passings and their live event commit together, or not at all
+    async with db.transaction(conn):
+        rows = await db.fetch(
+            conn,
+            INSERT_PASSINGS,
+            [runner_by_tag[reads[index].tag_id][1] for index, _, _, _ in accepted],
+            [runner_id for _, runner_id, _, _ in accepted],
+            [checkpoint_id for _, _, checkpoint_id, _ in accepted],
+            [passing_time for _, _, _, passing_time in accepted],
+            [reads[index].device_id for index, _, _, _ in accepted],
+            read_window.window,
+        )
+        inserted = {(row["runnerid"], row["checkpointid"]) for row in rows}
+        added: list[events.Passing] = []
+        for index, runner_id, checkpoint_id, passing_time in accepted:
+            if (runner_id, checkpoint_id) in inserted:
+                outcomes[index] = Outcome.ADDED
+                race_id = runner_by_tag[reads[index].tag_id][1]
+                added.append(
+                    events.Passing(race_id, runner_id, checkpoint_id, passing_time)
+                )
+            else:
+                outcomes[index] = Outcome.DUPLICATE
+
+        if added:
+            await db.fetch(
+                conn,
+                events.NOTIFY_ADDED,
+                events.encode_passings(added),
+                events.encode_reads(
+                    reads[index]
+                    for index, _, _, _ in accepted
+                    if outcomes[index] == Outcome.ADDED
+                ),
+            )
+    counted(*outcomes)
+    return outcomes
@@ -1,11 +1,27 @@
 import sys
+import time
 from contextlib import asynccontextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 
-from api import db, deps, routes, settings, socket
+from api import (
+    cache,
+    db,
+    dedupe,
+    deps,
+    events,
+    metrics,
+    migrations,
+    mqtt,
+    responses,
+    routes,
+    settings,
+    socket,
+    standings,
+)
+from api.settings import get_settings
 
 
 @asynccontextmanager
@@ -13,10 +29,40 @@ async def lifespan(
     app: FastAPI,
     settings: settings.Settings | None = None,
 ):
+    settings = settings or get_settings()
     app.state.sqlalchemy_engine = db.get_engine(settings)
+    metrics.instrument(app.state.sqlalchemy_engine)
+    if settings.MIGRATE_ON_STARTUP:
+        await migrations.migrate(app.state.sqlalchemy_engine)
+
+    window = timedelta(hours=settings.RESOLUTION_CACHE_WINDOW_HOURS)
+    cache.resolution_cache.engine = app.state.sqlalchemy_engine
+    cache.resolution_cache.window = window
+    await cache.resolution_cache.refresh()
+    standings.live_standings.engine = app.state.sqlalchemy_engine
+    standings.live_standings.window = window
+    await standings.live_standings.refresh()
+    dedupe.read_window.window = timedelta(seconds=settings.DEDUPE_WINDOW_SECONDS)
+    dedupe.read_window.retention = timedelta(seconds=settings.DEDUPE_RETENTION_SECONDS)
+    dedupe.read_window.max_entries = settings.DEDUPE_MAX_ENTRIES
+    events.outbox.engine = app.state.sqlalchemy_engine
+    events.outbox.retention = timedelta(minutes=settings.LIVE_EVENT_RETENTION_MINUTES)
+    # Started up front so cache invalidations reach every worker
+    await socket.router.start_task()
+    if settings.MQTT_INGEST:
+        mqtt.mqtt_ingest.start(app.state.sqlalchemy_engine, settings)
 
     yield
 
+    await mqtt.mqtt_ingest.stop()
+    await socket.router.stop_task()
+    cache.resolution_cache.engine = None
+    cache.resolution_cache.clear()
+    standings.live_standings.engine = None
+    standings.live_standings.races.clear()
+    dedupe.read_window.clear()
+    events.outbox.engine = None
+    responses.response_cache.clear()
     await app.state.sqlalchemy_engine.dispose()
 
 
@@ -29,10 +75,31 @@ app.add_middleware(
     allow_credentials=True,
 )
 
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # The route template, so /race/1 and /race/2 are counted together
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        request.method,
+        route.path if route is not None else "unmatched",
+        str(response.status_code),
+    )
+    return response
+
+
 app.include_router(socket.router.router)
 app.include_router(routes.router)
 
 
+@app.get("/metrics", tags=["Status"])
+async def get_metrics():
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/health", tags=["Status"])
 async def health_check(
     dbc: deps.GetDbCtx,
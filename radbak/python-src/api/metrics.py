@@ -0,0 +1,308 @@
+"""A small metrics registry rendered in the Prometheus text format at /metrics.
+
+Metrics are defined here so the full list is in one place, and updated by
+the modules that own the work. Gauges for state that already exists, such
+as the connection pool or the websocket queues, read it when scraped.
+
+Everything is kept in the process, so each worker has its own metrics and
+`poetry run serve` starts one worker unless told otherwise.
+"""
+
+import re
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cached insert to a slow leaderboard
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+Labels = tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        for labels, value in sorted(self.values.items()):
+            yield "", format_labels(self.labels, labels), value
+
+
+class Gauge(Metric):
+    """A value that is set directly, or read from a function when scraped.
+
+    The function returns the value, or a dict of label values to values.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+        self.function: Callable[[], float | dict[Labels, float]] | None = None
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def set_function(self, function: Callable[[], float | dict[Labels, float]]):
+        self.function = function
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        values = self.values
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield "", format_labels(self.labels, labels), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = (*buckets, float("inf"))
+        # labels -> [count per bucket..., sum]
+        self.values: dict[Labels, list[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels: str) -> int:
+        counts = self.values.get(labels)
+        return int(sum(counts[:-1])) if counts else 0
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{format_value(bucket)}"'
+                yield "_bucket", format_labels(self.labels, labels, le), cumulative
+            yield "_sum", format_labels(self.labels, labels), counts[-1]
+            yield "_count", format_labels(self.labels, labels), cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time to handle a request, by route",
+        ("method", "route", "status"),
+    )
+)
+INGEST_READS = registry.register(
+    Counter(
+        "ingest_reads_total",
+        "Checkpoint reads by outcome: added, unknown_tag, duplicate or no_checkpoint",
+        ("outcome",),
+    )
+)
+DB_CHECKOUT_SECONDS = registry.register(
+    Histogram(
+        "db_pool_checkout_seconds",
+        "Time spent waiting for a database connection from the pool",
+    )
+)
+DB_POOL_CONNECTIONS = registry.register(
+    Gauge(
+        "db_pool_connections",
+        "Pooled database connections by state: idle, checked_out or overflow",
+        ("state",),
+    )
+)
+DB_POOL_SATURATION = registry.register(
+    Gauge(
+        "db_pool_saturation",
+        "Checked out connections as a share of the pool size, above 1 in overflow",
+    )
+)
+DB_STATEMENT_SECONDS = registry.register(
+    Histogram(
+        "db_statement_duration_seconds",
+        "Time to run a statement, by operation and table or function,"
+        " or by name for prepared statements",
+        ("statement",),
+    )
+)
+WS_CONNECTIONS = registry.register(
+    Gauge("ws_connections", "Open websocket connections")
+)
+WS_LAGGING = registry.register(
+    Gauge("ws_lagging_connections", "Websocket clients that were sent a reset")
+)
+WS_QUEUE_DEPTH = registry.register(
+    Gauge(
+        "ws_queue_depth",
+        "Messages waiting in websocket client queues, as the total and the deepest",
+        ("aggregate",),
+    )
+)
+WS_DROPPED = registry.register(
+    Counter(
+        "ws_dropped_messages_total", "Live updates dropped for slow websocket clients"
+    )
+)
+WS_FANOUT_SECONDS = registry.register(
+    Histogram(
+        "ws_fanout_duration_seconds",
+        "Time to queue a delta for every subscribed websocket client",
+        buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+    )
+)
+
+# Distinct statement labels kept before the rest are counted as "other"
+MAX_STATEMENTS = 200
+
+STATEMENT_TARGET = re.compile(
+    r"\b(?:INTO|FROM|UPDATE|TABLE|INDEX)\s+(?:IF (?:NOT )?EXISTS\s+)?([\w.]+)"
+    r"|\bSELECT\s+([\w.]+)\(",
+    re.IGNORECASE,
+)
+STATEMENT_VERB = re.compile(
+    r"\b(SELECT|INSERT|UPDATE|DELETE|CREATE|ALTER|DROP|TRUNCATE|COPY)\b",
+    re.IGNORECASE,
+)
+
+
+def statement_name(statement: str) -> str:
+    """A short label such as "INSERT checkpointpassing" for a statement.
+
+    Statements starting with WITH are named after their first data-modifying
+    part, so an insert wrapped in a CTE is still counted as an insert.
+    """
+    verbs = STATEMENT_VERB.findall(statement)
+    verb = next(
+        (verb for verb in verbs if verb.upper() != "SELECT"), verbs[0] if verbs else ""
+    ).upper()
+    target = ""
+    for match in STATEMENT_TARGET.finditer(statement):
+        if verb == "SELECT" or match.group(1) is not None:
+            target = (match.group(1) or match.group(2)).lower()
+            break
+    return f"{verb} {target}".strip() or "other"
+
+
+def instrument(engine: AsyncEngine) -> None:
+    """Time every statement run on the engine and report its pool when scraped."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+        name = statement_name(statement)
+        if (name,) not in DB_STATEMENT_SECONDS.values:
+            if len(DB_STATEMENT_SECONDS.values) >= MAX_STATEMENTS:
+                name = "other"
+        DB_STATEMENT_SECONDS.observe(elapsed, name)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        started = (
+            context.connection.info.get("statement_started")
+            if context.connection
+            else None
+        )
+        if started:
+            started.pop()
+
+    pool = sync_engine.pool
+
+    def connections() -> dict[Labels, float]:
+        return {
+            ("idle",): pool.checkedin(),
+            ("checked_out",): pool.checkedout(),
+            ("overflow",): max(pool.overflow(), 0),
+        }
+
+    DB_POOL_CONNECTIONS.set_function(connections)
+    DB_POOL_SATURATION.set_function(lambda: pool.checkedout() / max(pool.size(), 1))
@@ -0,0 +1,104 @@
+"""Versioned schema changes, applied in order and recorded in schema_version.
+
+A migration is never edited once released; change the schema by adding the
+next version. Functions are re-created on every upgrade instead, so they
+always match the code that calls them.
+"""
+
+import logging
+from typing import NamedTuple
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from api import db, ingest
+
+from . import (
+    v001_initial,
+    v002_live_events,
+    v003_hot_path_indexes,
+    v004_race_partitions,
+    v005_live_event_log,
+    v006_live_event_order,
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: list[str]
+
+
+MIGRATIONS = [
+    Migration(version, module.NAME, module.STATEMENTS)
+    for version, module in enumerate(
+        [
+            v001_initial,
+            v002_live_events,
+            v003_hot_path_indexes,
+            v004_race_partitions,
+            v005_live_event_log,
+            v006_live_event_order,
+        ],
+        start=1,
+    )
+]
+
+REPEATABLE = [ingest.DROP_RECORD_PASSING_V1, ingest.RECORD_PASSING_FUNCTION]
+
+SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    Version INT PRIMARY KEY,
+    Name VARCHAR(255) NOT NULL,
+    AppliedAt TIMESTAMP NOT NULL DEFAULT NOW()
+)
+"""
+
+# Held for the whole transaction so workers starting together upgrade once
+LOCK_ID = 5_460_101
+
+
+async def current_version(conn: AsyncConnection) -> int:
+    result = await conn.execute(
+        sa.text("SELECT COALESCE(MAX(Version), 0) FROM schema_version")
+    )
+    return result.scalar()
+
+
+async def upgrade(conn: AsyncConnection, target: int | None = None) -> list[int]:
+    """Apply every migration newer than the database, returning their versions.
+
+    Runs in the caller's transaction, so a failing migration leaves the
+    database as it was.
+    """
+    await conn.execute(sa.text("SELECT pg_advisory_xact_lock(:id)"), {"id": LOCK_ID})
+    await conn.execute(sa.text(SCHEMA_VERSION_TABLE))
+    version = await current_version(conn)
+
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if target is not None and migration.version > target:
+            break
+        for statement in migration.statements:
+            await conn.execute(sa.text(statement))
+        await conn.execute(
+            sa.text("INSERT INTO schema_version (Version, Name) VALUES (:v, :name)"),
+            {"v": migration.version, "name": migration.name},
+        )
+        applied.append(migration.version)
+        logging.info("Applied migration %d (%s)", migration.version, migration.name)
+
+    for statement in REPEATABLE:
+        await conn.execute(sa.text(statement))
+    return applied
+
+
+async def migrate(engine: AsyncEngine) -> list[int]:
+    try:
+        async with db.get_connection(engine) as conn:
+            return await upgrade(conn)
+    except Exception:
+        logging.exception("Could not migrate the database")
+        return []
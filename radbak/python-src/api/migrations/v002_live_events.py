@@ -0,0 +1,3 @@
+NAME = "live events"
+
+STATEMENTS = ["CREATE SEQUENCE IF NOT EXISTS live_event_seq"]
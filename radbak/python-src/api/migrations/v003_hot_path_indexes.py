@@ -0,0 +1,17 @@
+# Every lookup made while ingesting passings or building a leaderboard can use
+# an index, so neither slows down as races accumulate. Fails if a tag is
+# already registered twice in the same race; fix those registrations first.
+NAME = "hot path indexes"
+
+STATEMENTS = [
+    # Tag resolution and the runners of a race
+    "CREATE UNIQUE INDEX IF NOT EXISTS runnerinrace_race_tag ON RunnerInRace (RaceID, TagID)",
+    "CREATE INDEX IF NOT EXISTS runnerinrace_tag ON RunnerInRace (TagID)",
+    # The route of a race, in order
+    "CREATE INDEX IF NOT EXISTS checkpointinrace_race_position ON CheckpointInRace (RaceID, Position)",
+    # A runner's passings in time order, and cascades from Checkpoint
+    "CREATE INDEX IF NOT EXISTS checkpointpassing_runner_time ON CheckpointPassing (RunnerID, PassingTime)",
+    "CREATE INDEX IF NOT EXISTS checkpointpassing_checkpoint ON CheckpointPassing (CheckpointID)",
+    # Races around now, for the caches and standings
+    "CREATE INDEX IF NOT EXISTS race_starttime ON Race (startTime)",
+]
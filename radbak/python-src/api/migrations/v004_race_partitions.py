@@ -0,0 +1,84 @@
+# CheckpointPassing becomes a table partitioned by race, with one partition
+# per race created alongside it. Live queries only ever touch the partitions
+# of the races they ask about, and a finished race can be detached into the
+# archive schema without rewriting the rest (see api/archive.py).
+#
+# The primary key now includes RaceID, so a runner can pass the same
+# checkpoint again in a later race. Existing passings are assigned to the
+# latest race that has both the runner and the checkpoint; any that match no
+# race are kept in archive.unassigned_passings.
+NAME = "race partitions"
+
+STATEMENTS = [
+    "CREATE SCHEMA IF NOT EXISTS archive",
+    "ALTER TABLE Race ADD COLUMN IF NOT EXISTS ArchivedAt TIMESTAMP",
+    "ALTER TABLE CheckpointPassing RENAME TO unassigned_passings",
+    "ALTER TABLE unassigned_passings RENAME CONSTRAINT checkpointpassing_pkey TO unassigned_passings_pkey",
+    "DROP INDEX IF EXISTS checkpointpassing_runner_time",
+    "DROP INDEX IF EXISTS checkpointpassing_checkpoint",
+    """
+    CREATE TABLE CheckpointPassing (
+        RaceID INT NOT NULL,
+        RunnerID INT NOT NULL,
+        CheckpointID INT NOT NULL,
+        PassingTime TIMESTAMP NOT NULL,
+        PRIMARY KEY (RaceID, RunnerID, CheckpointID),
+        FOREIGN KEY (RaceID) REFERENCES Race (RaceID) ON DELETE CASCADE,
+        FOREIGN KEY (RunnerID) REFERENCES Runner (RunnerID) ON DELETE CASCADE,
+        FOREIGN KEY (CheckpointID) REFERENCES Checkpoint (CheckpointID) ON DELETE CASCADE
+    ) PARTITION BY LIST (RaceID)
+    """,
+    "CREATE INDEX checkpointpassing_runner_time ON CheckpointPassing (RaceID, RunnerID, PassingTime)",
+    "CREATE INDEX checkpointpassing_checkpoint ON CheckpointPassing (CheckpointID)",
+    """
+    CREATE OR REPLACE FUNCTION create_race_partition(p_race_id INT) RETURNS VOID AS $$
+    BEGIN
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF CheckpointPassing FOR VALUES IN (%s)',
+            'checkpointpassing_r' || p_race_id,
+            p_race_id
+        );
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION race_partition_trigger() RETURNS TRIGGER AS $$
+    BEGIN
+        PERFORM create_race_partition(NEW.RaceID);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER race_partition AFTER INSERT ON Race
+    FOR EACH ROW EXECUTE FUNCTION race_partition_trigger()
+    """,
+    "SELECT create_race_partition(RaceID) FROM Race",
+    """
+    INSERT INTO CheckpointPassing (RaceID, RunnerID, CheckpointID, PassingTime)
+    SELECT DISTINCT ON (u.RunnerID, u.CheckpointID)
+        r.RaceID, u.RunnerID, u.CheckpointID, u.PassingTime
+    FROM unassigned_passings u
+    JOIN RunnerInRace rir ON rir.RunnerID = u.RunnerID
+    JOIN CheckpointInRace cir
+      ON cir.RaceID = rir.RaceID AND cir.CheckpointID = u.CheckpointID
+    JOIN Race r ON r.RaceID = rir.RaceID
+    ORDER BY u.RunnerID, u.CheckpointID, r.startTime DESC
+    """,
+    """
+    DELETE FROM unassigned_passings u
+    USING CheckpointPassing cp
+    WHERE cp.RunnerID = u.RunnerID AND cp.CheckpointID = u.CheckpointID
+    """,
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM unassigned_passings) THEN
+            ALTER TABLE unassigned_passings SET SCHEMA archive;
+        ELSE
+            DROP TABLE unassigned_passings;
+        END IF;
+    END;
+    $$
+    """,
+]
@@ -0,0 +1,14 @@
+# Passings reach the other workers through a log instead of notification
+# payloads; see api/events.py
+NAME = "live event log"
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS LiveEvent (
+        EventID BIGINT PRIMARY KEY DEFAULT nextval('live_event_seq'),
+        Payload TEXT NOT NULL,
+        CreatedAt TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS liveevent_createdat ON LiveEvent (CreatedAt)",
+]
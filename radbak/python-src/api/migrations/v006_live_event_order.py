@@ -0,0 +1,13 @@
+# EventIDs are taken before their transaction commits, so they are not in
+# commit order. Relays number events as they become visible instead, from a
+# single counter row; see api/events.py
+NAME = "live event order"
+
+STATEMENTS = [
+    "ALTER TABLE LiveEvent ADD COLUMN IF NOT EXISTS Seq BIGINT UNIQUE",
+    "CREATE INDEX IF NOT EXISTS liveevent_unordered ON LiveEvent (EventID)"
+    " WHERE Seq IS NULL",
+    "CREATE TABLE IF NOT EXISTS LiveEventOrder (LastSeq BIGINT NOT NULL)",
+    "INSERT INTO LiveEventOrder (LastSeq)"
+    " SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM LiveEventOrder)",
+]
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import random
+from datetime import datetime
+
+import asyncpg
+import paho.mqtt.client as mqtt
+import paho.mqtt.enums as mqtt_enums
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from api import db, ingest
+from api.settings import Settings
+from fwdservice import decode
+from fwdservice.clock import DeviceClocks
+
+# Reads taken from the queue and recorded with one call to ingest.record_passings
+BATCH_SIZE = 128
+
+# Messages, their reads, and what to acknowledge once the reads are committed
+Message = tuple[list[ingest.Read], int, int]
+
+# The database is down or unreachable, so the same reads may go in later.
+# Anything else would fail the same way every time.
+UNAVAILABLE = (
+    OSError,
+    sa.exc.InterfaceError,
+    sa.exc.OperationalError,
+    sa.exc.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError,
+    asyncpg.InsufficientResourcesError,
+)
+
+
+def unavailable(error: Exception) -> bool:
+    if isinstance(error, sa.exc.DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, UNAVAILABLE)
+
+
+def parse_reads(
+    payload: bytes, received_at: datetime, clocks: DeviceClocks | None = None
+) -> list[ingest.Read]:
+    """The reads in a message, in any format the forward service decodes."""
+    return [
+        ingest.Read(
+            passing["TagID"],
+            int(passing["DeviceID"]),
+            datetime.fromisoformat(passing["PassingTime"]),
+        )
+        for passing in decode.decode(payload, received_at, clocks)
+    ]
+
+
+class MqttIngest:
+    """Records checkpoint reads straight from the broker, without fwdservice.
+
+    paho runs its network loop in a background thread and hands each message
+    to the event loop. A single task drains the queue in batches through the
+    same validation and insert as POST /checkpoint_passings/batch, on the
+    app's own connection pool. Like the forward service, messages are only
+    acknowledged once their reads are committed and batches are retried
+    while the database is unavailable, so an outage only delays reads. The
+    queue needs no bound of its own, as the broker stops sending once its
+    window of unacknowledged messages is full. Messages are decoded by
+    fwdservice/decode.py, so binary frames are read here just as the forward
+    service reads them.
+    """
+
+    def __init__(self) -> None:
+        self.engine: AsyncEngine | None = None
+        self.client: mqtt.Client | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.queue: asyncio.Queue[Message] = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+        self.topic = ""
+        # Only used on the paho network thread, where frames arrive in order
+        self.clocks = DeviceClocks()
+
+    def submit(self, payload: bytes, received_at: datetime, mid: int, qos: int) -> None:
+        """Queue the reads in a message. Called on the paho network thread."""
+        try:
+            reads = parse_reads(payload, received_at, self.clocks)
+        except ValueError:
+            # Still queued, so it is acknowledged in order with the rest
+            logging.warning("Ignoring malformed MQTT message %r", payload)
+            reads = []
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (reads, mid, qos))
+
+    async def drain(self) -> None:
+        while True:
+            messages = [await self.queue.get()]
+            reads = list(messages[0][0])
+            while len(reads) < BATCH_SIZE and not self.queue.empty():
+                messages.append(self.queue.get_nowait())
+                reads.extend(messages[-1][0])
+            if reads:
+                await self.record(reads)
+            if self.client is not None:
+                for _, mid, qos in messages:
+                    self.client.ack(mid, qos)
+
+    async def record(self, reads: list[ingest.Read]) -> None:
+        """Record reads, waiting for the database while it is unavailable.
+
+        A batch the database fails on for another reason is recorded a read
+        at a time, and the reads it cannot take are logged and skipped.
+        """
+        try:
+            await self.insert(reads)
+        except Exception:
+            if len(reads) == 1:
+                logging.exception("Skipping MQTT read %r", reads[0])
+                return
+            for read in reads:
+                await self.record([read])
+
+    async def insert(self, reads: list[ingest.Read]) -> None:
+        attempt = 0
+        while True:
+            try:
+                async with db.get_connection(self.engine) as conn:
+                    await ingest.record_passings(conn, reads)
+                return
+            except Exception as e:
+                if not unavailable(e):
+                    raise
+                logging.exception("Could not record %d MQTT reads", len(reads))
+            await asyncio.sleep(min(2**attempt, 30) + random.random())
+            attempt += 1
+
+    def on_connect(self, client, userdata, flags, rc, properties):
+        if rc == 0:
+            logging.info("MQTT ingest connected, subscribing to %s", self.topic)
+            # Renewed on every reconnect
+            client.subscribe(self.topic, qos=1)
+        else:
+            logging.error("MQTT ingest could not connect: %s", rc)
+
+    def on_message(self, client, userdata, message):
+        self.submit(message.payload, datetime.now(), message.mid, message.qos)
+
+    def start(self, engine: AsyncEngine, settings: Settings) -> None:
+        self.engine = engine
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.create_task(self.drain())
+
+        # A shared subscription hands each read to only one of the API workers
+        self.topic = settings.MQTT_TOPIC
+        if settings.MQTT_SHARE_GROUP:
+            self.topic = f"$share/{settings.MQTT_SHARE_GROUP}/{self.topic}"
+
+        self.client = mqtt.Client(
+            callback_api_version=mqtt_enums.CallbackAPIVersion.VERSION2,
+            client_id=settings.MQTT_CLIENT_ID,
+            # Reads are acknowledged by drain once they are committed
+            manual_ack=True,
+        )
+        self.client.username_pw_set(settings.MQTT_USERNAME, settings.MQTT_PASSWORD)
+        if settings.MQTT_CA_CERTS:
+            self.client.tls_set(ca_certs=settings.MQTT_CA_CERTS)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect_async(settings.MQTT_HOST, settings.MQTT_PORT)
+        self.client.loop_start()
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.client = None
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.engine = None
+
+
+mqtt_ingest = MqttIngest()
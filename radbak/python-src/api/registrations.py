@@ -0,0 +1,206 @@
+"""Registering a whole field for a race from one upload.
+
+Uploads are CSV with a header naming the `name` and `tag` columns, or
+NDJSON with one {"name": ..., "tag": ...} object per line. Rows are parsed
+as the upload streams in and copied into a staging table with COPY, and
+everything after that is a handful of set-wise statements: the runners are
+matched by name or created, and their tags registered or changed. A row
+that cannot be registered is reported by its line number, and the others
+are registered regardless.
+"""
+
+import codecs
+import csv
+import json
+from typing import AsyncIterable, AsyncIterator, NamedTuple
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# Runner.name and RunnerInRace.TagID are VARCHAR(255)
+MAX_LENGTH = 255
+
+STAGING = "registration_import"
+
+
+class Registration(NamedTuple):
+    line: int
+    name: str
+    tag: str
+
+
+class RowError(NamedTuple):
+    line: int
+    error: str
+
+
+async def lines(source: AsyncIterable[bytes]) -> AsyncIterator[tuple[int, str]]:
+    """The numbered lines of a UTF-8 upload, however it is chunked."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    number = 0
+    pending = ""
+    async for chunk in source:
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        for line in complete:
+            number += 1
+            yield number, line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield number + 1, pending.rstrip("\r")
+
+
+def validate(line: int, name, tag, errors: list[RowError]) -> Registration | None:
+    name = name.strip() if isinstance(name, str) else ""
+    tag = tag.strip() if isinstance(tag, str) else ""
+    if not name or not tag:
+        errors.append(RowError(line, "Both a name and a tag are required"))
+    elif len(name) > MAX_LENGTH or len(tag) > MAX_LENGTH:
+        errors.append(RowError(line, f"Names and tags are at most {MAX_LENGTH} long"))
+    else:
+        return Registration(line, name, tag)
+    return None
+
+
+async def parse_csv(
+    source: AsyncIterable[bytes], errors: list[RowError]
+) -> AsyncIterator[Registration]:
+    """Registrations from a CSV upload. Fields may be quoted but not span lines."""
+    columns = None
+    async for line, text in lines(source):
+        if not text.strip():
+            continue
+        try:
+            fields = next(csv.reader([text], strict=True))
+        except csv.Error as e:
+            if columns is None:
+                raise ValueError(f"The header cannot be read: {e}") from e
+            errors.append(RowError(line, f"The row cannot be read: {e}"))
+            continue
+        if columns is None:
+            header = [field.strip().lower() for field in fields]
+            if "name" not in header or "tag" not in header:
+                raise ValueError("The header must name a name and a tag column")
+            columns = header.index("name"), header.index("tag")
+            continue
+        if len(fields) <= max(columns):
+            errors.append(RowError(line, "The row is missing the name or tag"))
+            continue
+        registration = validate(line, fields[columns[0]], fields[columns[1]], errors)
+        if registration is not None:
+            yield registration
+
+
+async def parse_ndjson(
+    source: AsyncIterable[bytes], errors: list[RowError]
+) -> AsyncIterator[Registration]:
+    """Registrations from an upload of one JSON object per line."""
+    async for line, text in lines(source):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError:
+            errors.append(RowError(line, "The line is not valid JSON"))
+            continue
+        if not isinstance(row, dict):
+            errors.append(RowError(line, "The line is not a JSON object"))
+            continue
+        registration = validate(line, row.get("name"), row.get("tag"), errors)
+        if registration is not None:
+            yield registration
+
+
+# Each marks the rows it finds with an error, and they go no further
+CHECKS = [
+    # Only the first row for a tag or a runner counts
+    f"""
+    UPDATE {STAGING} s
+    SET error = CASE WHEN d.tag_rank > 1
+        THEN 'The tag is given to a runner on line ' || d.first_tag_line
+        ELSE 'The runner is given a tag on line ' || d.first_name_line
+    END
+    FROM (
+        SELECT line,
+            row_number() OVER (PARTITION BY tag ORDER BY line) AS tag_rank,
+            min(line) OVER (PARTITION BY tag) AS first_tag_line,
+            row_number() OVER (PARTITION BY name ORDER BY line) AS name_rank,
+            min(line) OVER (PARTITION BY name) AS first_name_line
+        FROM {STAGING}
+    ) d
+    WHERE d.line = s.line AND (d.tag_rank > 1 OR d.name_rank > 1)
+    """,
+    f"""
+    UPDATE {STAGING} s
+    SET error = 'The tag is already registered to ' || r.name || ' in this race'
+    FROM RunnerInRace rir
+    JOIN Runner r ON r.RunnerID = rir.RunnerID
+    WHERE s.error IS NULL
+      AND rir.RaceID = :race_id
+      AND rir.TagID = s.tag
+      AND r.name <> s.name
+    """,
+]
+CREATE_RUNNERS = f"""
+INSERT INTO Runner (name)
+SELECT name FROM {STAGING} WHERE error IS NULL
+ON CONFLICT (name) DO NOTHING
+"""
+# Registers new runners, and gives those already registered their new tag
+REGISTER = f"""
+INSERT INTO RunnerInRace (RunnerID, RaceID, TagID)
+SELECT r.RunnerID, :race_id, s.tag
+FROM {STAGING} s
+JOIN Runner r ON r.name = s.name
+WHERE s.error IS NULL
+ON CONFLICT (RunnerID, RaceID) DO UPDATE SET TagID = EXCLUDED.TagID
+WHERE RunnerInRace.TagID <> EXCLUDED.TagID
+RETURNING xmax = 0 AS registered
+"""
+
+
+async def import_registrations(
+    conn: AsyncConnection,
+    race_id: int,
+    registrations: AsyncIterable[Registration],
+    errors: list[RowError],
+) -> dict:
+    """Register the runners of an upload in a race, returning a report.
+
+    Raises ValueError from the parser if the upload cannot be read at all.
+    """
+    await conn.execute(
+        sa.text(
+            f"CREATE TEMPORARY TABLE {STAGING}"
+            " (line INT PRIMARY KEY, name TEXT NOT NULL, tag TEXT NOT NULL, error TEXT)"
+            " ON COMMIT DROP"
+        )
+    )
+    raw = (await conn.get_raw_connection()).driver_connection
+    status = await raw.copy_records_to_table(
+        STAGING, records=registrations, columns=["line", "name", "tag"]
+    )
+    # asyncpg returns the command tag, e.g. "COPY 1500", and the rows that
+    # could not be parsed were never copied
+    rows = int(status.split()[-1]) + len(errors)
+
+    for check in CHECKS:
+        await conn.execute(sa.text(check), {"race_id": race_id})
+    result = await conn.execute(sa.text(CREATE_RUNNERS))
+    runners_created = result.rowcount
+    result = await conn.execute(sa.text(REGISTER), {"race_id": race_id})
+    changes = [row.registered for row in result]
+    result = await conn.execute(
+        sa.text(f"SELECT line, error FROM {STAGING} WHERE error IS NOT NULL")
+    )
+    errors.extend(RowError(row.line, row.error) for row in result)
+
+    registered = sum(changes)
+    return {
+        "rows": rows,
+        "registered": registered,
+        "retagged": len(changes) - registered,
+        "unchanged": rows - len(errors) - len(changes),
+        "runners_created": runners_created,
+        "errors": [error._asdict() for error in sorted(errors)],
+    }
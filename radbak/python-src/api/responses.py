@@ -0,0 +1,101 @@
+import hashlib
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, NamedTuple
+
+import orjson
+from fastapi import Request, Response
+
+OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def default(value: Any) -> Any:
+    # asyncpg returns NUMERIC as Decimal, and records are mappings
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, "items"):
+        return dict(value.items())
+    raise TypeError(f"Cannot encode {type(value).__name__} as JSON")
+
+
+def dumps(content: Any) -> bytes:
+    """Encode content as JSON, taking asyncpg records as they come."""
+    if isinstance(content, bytes):
+        return content
+    if isinstance(content, str):
+        return content.encode()
+    return orjson.dumps(content, default=default, option=OPTIONS)
+
+
+class JSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class Encoded(NamedTuple):
+    body: bytes
+    etag: str
+
+
+class ResponseCache:
+    """Encoded read responses, kept until a write to their race.
+
+    Entries are scoped to a race, or to None for lists that span races.
+    Every encode is remembered with an ETag derived from the body, so a
+    client that sends it back in If-None-Match gets a 304 and workers agree
+    on the tag. Invalidations bump a generation per scope; a response that
+    was being encoded across one is served but not kept.
+    """
+
+    def __init__(self, max_entries: int = 10_000) -> None:
+        self.max_entries = max_entries
+        # Least recently used first
+        self.entries: OrderedDict[tuple[int | None, str], Encoded] = OrderedDict()
+        self.generations: dict[int | None, int] = {}
+
+    def invalidate(self, race_id: int | None) -> None:
+        self.generations[race_id] = self.generations.get(race_id, 0) + 1
+        for key in [key for key in self.entries if key[0] == race_id]:
+            del self.entries[key]
+
+    def clear(self) -> None:
+        for race_id in list(self.generations):
+            self.generations[race_id] += 1
+        self.entries.clear()
+
+    async def get(
+        self, race_id: int | None, key: str, render: Callable[[], Awaitable[Any]]
+    ) -> Encoded:
+        entry = self.entries.get((race_id, key))
+        if entry is not None:
+            self.entries.move_to_end((race_id, key))
+            return entry
+
+        generation = self.generations.setdefault(race_id, 0)
+        body = dumps(await render())
+        entry = Encoded(body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"')
+        if self.generations.get(race_id, 0) == generation:
+            self.entries[(race_id, key)] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+
+response_cache = ResponseCache()
+
+
+async def cached(
+    request: Request, race_id: int | None, render: Callable[[], Awaitable[Any]]
+) -> Response:
+    """The response for a read from the cache, or a 304 if the client has it."""
+    key = request.url.path
+    if request.url.query:
+        key += "?" + request.url.query
+    body, etag = await response_cache.get(race_id, key, render)
+    # Clients may keep the response, but must ask whether it is still current
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", "").replace(" ", "").split(","):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
@@ -0,0 +1,215 @@
+"""Exporting a race's results as CSV, NDJSON or Parquet.
+
+There is one row per runner and checkpoint passed, with the split since the
+previous checkpoint, the time since the start and the runner's final rank.
+Runners without passings get a single row without a checkpoint. The database
+computes everything and the rows are read through a server-side cursor a
+chunk at a time, so an export starts right away and is never held in memory
+as a whole.
+
+Parquet needs pyarrow (`poetry install -E parquet`).
+"""
+
+import csv
+import io
+from typing import AsyncIterable, AsyncIterator, Callable, NamedTuple, Sequence
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from api.responses import dumps
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Rows per cursor fetch, and per Parquet row group
+CHUNK_ROWS = 5000
+
+COLUMNS = [
+    "rank",
+    "runner_id",
+    "name",
+    "tag",
+    "passed",
+    "time_seconds",
+    "position",
+    "checkpoint_id",
+    "location",
+    "passing_time",
+    "split_seconds",
+    "elapsed_seconds",
+]
+
+# Ranked the way the leaderboard ranks: most checkpoints passed, then earliest
+# to the last of them. The passings table is the live one or an archived
+# partition.
+RESULTS = """
+WITH race AS (
+    SELECT startTime FROM Race WHERE RaceID = :race_id
+),
+route AS (
+    SELECT cir.CheckpointID, cir.Position, c.Location
+    FROM CheckpointInRace cir
+    JOIN Checkpoint c ON c.CheckpointID = cir.CheckpointID
+    WHERE cir.RaceID = :race_id
+),
+passings AS (
+    SELECT cp.RunnerID, route.Position, cp.CheckpointID, route.Location,
+        cp.PassingTime,
+        EXTRACT(EPOCH FROM cp.PassingTime - coalesce(
+            lag(cp.PassingTime) OVER (
+                PARTITION BY cp.RunnerID ORDER BY route.Position
+            ),
+            (SELECT startTime FROM race)
+        ))::float8 AS split,
+        EXTRACT(EPOCH FROM cp.PassingTime - (SELECT startTime FROM race))::float8
+            AS elapsed
+    FROM {passings} cp
+    JOIN route ON route.CheckpointID = cp.CheckpointID
+    WHERE cp.RaceID = :race_id
+),
+standings AS (
+    SELECT rir.RunnerID, r.name, rir.TagID,
+        count(p.CheckpointID) AS passed,
+        max(p.PassingTime) AS last_time,
+        max(p.elapsed) AS time_seconds
+    FROM RunnerInRace rir
+    JOIN Runner r ON r.RunnerID = rir.RunnerID
+    LEFT JOIN passings p ON p.RunnerID = rir.RunnerID
+    WHERE rir.RaceID = :race_id
+    GROUP BY rir.RunnerID, r.name, rir.TagID
+),
+ranked AS (
+    SELECT rank() OVER (ORDER BY passed DESC, last_time ASC NULLS LAST) AS rank, *
+    FROM standings
+)
+SELECT s.rank, s.RunnerID, s.name, s.TagID, s.passed, s.time_seconds,
+    p.Position, p.CheckpointID, p.Location, p.PassingTime, p.split, p.elapsed
+FROM ranked s
+LEFT JOIN passings p ON p.RunnerID = s.RunnerID
+ORDER BY s.rank, s.RunnerID, p.Position
+"""
+
+
+async def fetch_results(
+    conn: AsyncConnection, race_id: int, passings: str
+) -> AsyncIterator[Sequence[Sequence]]:
+    """The result rows of a race in chunks, from the given passings table."""
+    result = await conn.stream(
+        sa.text(RESULTS.format(passings=passings)).execution_options(
+            yield_per=CHUNK_ROWS
+        ),
+        {"race_id": race_id},
+    )
+    async for chunk in result.partitions():
+        yield chunk
+
+
+def csv_value(value):
+    # Times as ISO 8601, like the JSON responses
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+async def to_csv(chunks: AsyncIterable[Sequence[Sequence]]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue().encode()
+    async for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([[csv_value(value) for value in row] for row in chunk])
+        yield buffer.getvalue().encode()
+
+
+async def to_ndjson(
+    chunks: AsyncIterable[Sequence[Sequence]],
+) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        yield b"".join(dumps(dict(zip(COLUMNS, row))) + b"\n" for row in chunk)
+
+
+class ParquetSink:
+    """A file for ParquetWriter that hands back what was written so far."""
+
+    closed = False
+
+    def __init__(self) -> None:
+        self.written: list[bytes] = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.written.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.written)
+        self.written.clear()
+        return data
+
+
+def parquet_schema():
+    return pa.schema(
+        [
+            ("rank", pa.int64()),
+            ("runner_id", pa.int64()),
+            ("name", pa.string()),
+            ("tag", pa.string()),
+            ("passed", pa.int64()),
+            ("time_seconds", pa.float64()),
+            ("position", pa.int64()),
+            ("checkpoint_id", pa.int64()),
+            ("location", pa.string()),
+            ("passing_time", pa.timestamp("us")),
+            ("split_seconds", pa.float64()),
+            ("elapsed_seconds", pa.float64()),
+        ]
+    )
+
+
+async def to_parquet(
+    chunks: AsyncIterable[Sequence[Sequence]],
+) -> AsyncIterator[bytes]:
+    """Write each chunk as a row group, sending it as soon as it is written."""
+    schema = parquet_schema()
+    sink = ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    async for chunk in chunks:
+        columns = list(zip(*chunk))
+        writer.write_batch(
+            pa.record_batch(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(columns, schema)
+                ],
+                schema=schema,
+            )
+        )
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+class Format(NamedTuple):
+    media_type: str
+    encode: Callable[[AsyncIterable[Sequence[Sequence]]], AsyncIterator[bytes]]
+
+
+FORMATS = {
+    "csv": Format("text/csv", to_csv),
+    "ndjson": Format("application/x-ndjson", to_ndjson),
+    "parquet": Format("application/vnd.apache.parquet", to_parquet),
+}
@@ -2,11 +2,14 @@ from datetime import datetime, timezone
 from typing import List, Optional
 
 import sqlalchemy as sa
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
-from api import deps
+from api import archive, db, deps, ingest, migrations, registrations, results
+from api.responses import JSONResponse, cached
 from api.socket.router import pg_notify
+from api.standings import live_standings
 
 router = APIRouter()
 
@@ -46,51 +49,50 @@ class CheckpointPassing(BaseModel):
     PassingTime: datetime
 
 
+# Everything the migrations create, for resetting the database
+TABLES = [
+    "Checkpoint",
+    "Runner",
+    "RunnerInRace",
+    "Race",
+    "Organizer",
+    "CheckpointInRace",
+    "CheckpointPassing",
+    "OrganizedBy",
+    "LiveEvent",
+    "LiveEventOrder",
+    "schema_version",
+]
+
+
 @router.get("/Test_flow")
 async def test_routes(dbc: deps.GetDbCtx):
     async with dbc as conn:
         # Run delete_db
-        tables = [
-            "Checkpoint",
-            "Runner",
-            "RunnerInRace",
-            "Race",
-            "Organizer",
-            "CheckpointInRace",
-            "CheckpointPassing",
-            "OrganizedBy",
-        ]
-        for table in tables:
+        for table in TABLES:
             await conn.execute(sa.text(f"DROP TABLE IF EXISTS {table} CASCADE;"))
+        await conn.execute(sa.text("DROP SEQUENCE IF EXISTS live_event_seq"))
+        await conn.execute(sa.text(f"DROP SCHEMA IF EXISTS {archive.SCHEMA} CASCADE"))
 
         # Run setup_db
-        creation_queries = [
-            "CREATE TABLE IF NOT EXISTS Checkpoint (CheckpointID SERIAL PRIMARY KEY, DeviceID BIGINT NOT NULL, Location VARCHAR(255) NOT NULL);",
-            "CREATE TABLE IF NOT EXISTS Runner (RunnerID SERIAL PRIMARY KEY, name VARCHAR(255) NOT NULL UNIQUE);",
-            "CREATE TABLE IF NOT EXISTS Race (RaceID SERIAL PRIMARY KEY, Name VARCHAR(255) NOT NULL, startTime TIMESTAMP NOT NULL);",
-            "CREATE TABLE IF NOT EXISTS RunnerInRace (RunnerID INT NOT NULL, RaceID INT NOT NULL, TagID VARCHAR(255) NOT NULL, PRIMARY KEY (RunnerID, RaceID), FOREIGN KEY (RunnerID) REFERENCES Runner (RunnerID) ON DELETE CASCADE, FOREIGN KEY (RaceID) REFERENCES Race (RaceID) ON DELETE CASCADE);",
-            "CREATE TABLE IF NOT EXISTS Organizer (OrganizerID SERIAL PRIMARY KEY, Name VARCHAR(255) NOT NULL);",
-            "CREATE TABLE IF NOT EXISTS CheckpointInRace (CheckpointID INT NOT NULL, RaceID INT NOT NULL, Position INT NOT NULL, TimeLimit TIMESTAMP, PRIMARY KEY (CheckpointID, RaceID), FOREIGN KEY (CheckpointID) REFERENCES Checkpoint (CheckpointID) ON DELETE CASCADE, FOREIGN KEY (RaceID) REFERENCES Race (RaceID) ON DELETE CASCADE);",
-            "CREATE TABLE IF NOT EXISTS CheckpointPassing (RunnerID INT NOT NULL, CheckpointID INT NOT NULL, PassingTime TIMESTAMP NOT NULL, PRIMARY KEY (RunnerID, CheckpointID), FOREIGN KEY (RunnerID) REFERENCES Runner (RunnerID) ON DELETE CASCADE, FOREIGN KEY (CheckpointID) REFERENCES Checkpoint (CheckpointID) ON DELETE CASCADE);",
-            "CREATE TABLE IF NOT EXISTS OrganizedBy (OrganizerID INT NOT NULL, RaceID INT NOT NULL, PRIMARY KEY (OrganizerID, RaceID), FOREIGN KEY (OrganizerID) REFERENCES Organizer (OrganizerID), FOREIGN KEY (RaceID) REFERENCES Race (RaceID));",
-        ]
-        for query in creation_queries:
-            await conn.execute(sa.text(query))
+        await migrations.upgrade(conn)
         # Test POST /race
         race_data = {
             "name": "Krukes Ultra Trail Challenge",
             "start_time": "2024-04-25T12:40:40",
         }
         await conn.execute(
-            sa.text(
-                f"INSERT INTO Race (Name, startTime) VALUES ('{race_data['name']}', '{race_data['start_time']}')"
-            )
+            sa.text("INSERT INTO Race (Name, startTime) VALUES (:name, :start_time)"),
+            {
+                "name": race_data["name"],
+                "start_time": datetime.fromisoformat(race_data["start_time"]),
+            },
         )
 
         # Test POST /runner
         runner_data = {"username": "bjørnar"}
         await conn.execute(
-            sa.text(f"INSERT INTO Runner (name) VALUES ('{runner_data['username']}')")
+            sa.text("INSERT INTO Runner (name) VALUES (:username)"), runner_data
         )
 
         # Test POST /checkpoint
@@ -101,8 +103,9 @@ async def test_routes(dbc: deps.GetDbCtx):
         }
         await conn.execute(
             sa.text(
-                f"INSERT INTO checkpoint VALUES ({checkpoint_data['CheckpointID']}, {checkpoint_data['DeviceID']}, '{checkpoint_data['Location']}')"
-            )
+                "INSERT INTO checkpoint VALUES (:CheckpointID, :DeviceID, :Location)"
+            ),
+            checkpoint_data,
         )
         # Test POST /checkpoint
         checkpoint2_data = {
@@ -112,8 +115,9 @@ async def test_routes(dbc: deps.GetDbCtx):
         }
         await conn.execute(
             sa.text(
-                f"INSERT INTO checkpoint VALUES ({checkpoint2_data['CheckpointID']}, {checkpoint2_data['DeviceID']}, '{checkpoint2_data['Location']}')"
-            )
+                "INSERT INTO checkpoint VALUES (:CheckpointID, :DeviceID, :Location)"
+            ),
+            checkpoint2_data,
         )
 
         # Test POST /register_tag
@@ -142,9 +146,10 @@ async def test_routes(dbc: deps.GetDbCtx):
         }
         await conn.execute(
             sa.text(
-                "INSERT INTO CheckpointPassing (RunnerID, CheckpointID, PassingTime) VALUES (:RunnerID, :CheckpointID, :PassingTime)"
+                "INSERT INTO CheckpointPassing (RaceID, RunnerID, CheckpointID, PassingTime) VALUES (:RaceID, :RunnerID, :CheckpointID, :PassingTime)"
             ),
             {
+                "RaceID": tag_data["RaceID"],
                 "RunnerID": tag_data["RunnerID"],
                 "CheckpointID": passing_data["CheckpointID"],
                 "PassingTime": passing_data["PassingTime"],
@@ -184,6 +189,7 @@ async def test_routes(dbc: deps.GetDbCtx):
         # Test GET /checkpoints
         checkpoints_result = await conn.execute(sa.text("SELECT * FROM Checkpoint"))
         checkpoints = checkpoints_result.mappings().all()
+        await pg_notify(conn, "cache", "*")
     return {
         "race_post_test": race_data,
         "runner_post_test": runner_data,
@@ -200,37 +206,23 @@ async def test_routes(dbc: deps.GetDbCtx):
 @router.post("/delete_db")
 async def delete_db(dbc: deps.GetDbCtx):
     async with dbc as conn:
-        tables = [
-            "Checkpoint",
-            "Runner",
-            "RunnerInRace",
-            "Race",
-            "Organizer",
-            "CheckpointInRace",
-            "CheckpointPassing",
-            "OrganizedBy",
-        ]
-        for table in tables:
+        for table in TABLES:
             await conn.execute(sa.text(f"DROP TABLE IF EXISTS {table} CASCADE;"))
+        await conn.execute(sa.text("DROP SEQUENCE IF EXISTS live_event_seq"))
+        await conn.execute(sa.text(f"DROP SCHEMA IF EXISTS {archive.SCHEMA} CASCADE"))
+        await pg_notify(conn, "cache", "*")
         return {"message": "Database deletion completed successfully"}
 
 
 @router.post("/setup_db")
 async def setup_db(dbc: deps.GetDbCtx):
     async with dbc as conn:
-        tables = [
-            "CREATE TABLE IF NOT EXISTS Checkpoint (CheckpointID SERIAL PRIMARY KEY, DeviceID BIGINT NOT NULL, Location VARCHAR(255) NOT NULL);",
-            "CREATE TABLE IF NOT EXISTS Runner (RunnerID SERIAL PRIMARY KEY, name VARCHAR(255) NOT NULL UNIQUE);",
-            "CREATE TABLE IF NOT EXISTS Race (RaceID SERIAL PRIMARY KEY, Name VARCHAR(255) NOT NULL, startTime TIMESTAMP NOT NULL);",
-            "CREATE TABLE IF NOT EXISTS RunnerInRace (RunnerID INT NOT NULL, RaceID INT NOT NULL, TagID VARCHAR(255) NOT NULL, PRIMARY KEY (RunnerID, RaceID), FOREIGN KEY (RunnerID) REFERENCES Runner (RunnerID) ON DELETE CASCADE, FOREIGN KEY (RaceID) REFERENCES Race (RaceID) ON DELETE CASCADE);",
-            "CREATE TABLE IF NOT EXISTS Organizer (OrganizerID SERIAL PRIMARY KEY, Name VARCHAR(255) NOT NULL);",
-            "CREATE TABLE IF NOT EXISTS CheckpointInRace (CheckpointID INT NOT NULL, RaceID INT NOT NULL, Position INT NOT NULL, TimeLimit TIMESTAMP, PRIMARY KEY (CheckpointID, RaceID), FOREIGN KEY (CheckpointID) REFERENCES Checkpoint (CheckpointID) ON DELETE CASCADE, FOREIGN KEY (RaceID) REFERENCES Race (RaceID) ON DELETE CASCADE);",
-            "CREATE TABLE IF NOT EXISTS CheckpointPassing (RunnerID INT NOT NULL, CheckpointID INT NOT NULL, PassingTime TIMESTAMP NOT NULL, PRIMARY KEY (RunnerID, CheckpointID), FOREIGN KEY (RunnerID) REFERENCES Runner (RunnerID) ON DELETE CASCADE, FOREIGN KEY (CheckpointID) REFERENCES Checkpoint (CheckpointID) ON DELETE CASCADE);",
-            "CREATE TABLE IF NOT EXISTS OrganizedBy (OrganizerID INT NOT NULL, RaceID INT NOT NULL, PRIMARY KEY (OrganizerID, RaceID), FOREIGN KEY (OrganizerID) REFERENCES Organizer (OrganizerID), FOREIGN KEY (RaceID) REFERENCES Race (RaceID));",
-        ]
-        for table_creation_query in tables:
-            await conn.execute(sa.text(table_creation_query))
-        return {"message": "Database setup completed successfully"}
+        applied = await migrations.upgrade(conn)
+        await pg_notify(conn, "cache", "*")
+        return {
+            "message": "Database setup completed successfully",
+            "applied_migrations": applied,
+        }
 
 
 @router.post("/seed_db")
@@ -261,6 +253,7 @@ async def seed_db(dbc: deps.GetDbCtx):
                 "INSERT INTO RunnerInRace (RunnerID, RaceID, TagID) VALUES (1, 1, 'tag1'), (2, 1, 'tag2')"
             )
         )
+        await pg_notify(conn, "cache", "*")
 
     return {"message": "Database seeded with sample data"}
 
@@ -270,8 +263,10 @@ async def create_runner(runner: Runner, dbc: deps.GetDbCtx):
     async with dbc as conn:
         try:
             await conn.execute(
-                sa.text(f"INSERT INTO Runner (name) VALUES ('{runner.username}')")
+                sa.text("INSERT INTO Runner (name) VALUES (:name)"),
+                {"name": runner.username},
             )
+            await pg_notify(conn, "responses", "*")
             return {"message": "Runner added"}
         except sa.exc.IntegrityError:
             raise HTTPException(status_code=400, detail="Username taken")
@@ -282,10 +277,13 @@ async def create_race(race: Race, dbc: deps.GetDbCtx):
     async with dbc as conn:
         result = await conn.execute(
             sa.text(
-                f"INSERT INTO Race (Name, startTime) VALUES ('{race.name}', '{race.start_time}') RETURNING RaceID"
-            )
+                "INSERT INTO Race (Name, startTime) VALUES (:name, :start_time)"
+                " RETURNING RaceID"
+            ),
+            {"name": race.name, "start_time": race.start_time},
         )
         race_id = result.scalar()  # Fetch the returned race ID
+        await pg_notify(conn, "responses", "*")
     return {"message": "Race created", "race_id": race_id}
 
 
@@ -294,10 +292,13 @@ async def post_checkpoint(checkpoint: Checkpoint, dbc: deps.GetDbCtx):
     async with dbc as conn:
         result = await conn.execute(
             sa.text(
-                f"INSERT INTO Checkpoint (DeviceID, Location) VALUES ({checkpoint.DeviceID}, '{checkpoint.Location}') RETURNING CheckpointID"
-            )
+                "INSERT INTO Checkpoint (DeviceID, Location) VALUES (:DeviceID, :Location)"
+                " RETURNING CheckpointID"
+            ),
+            {"DeviceID": checkpoint.DeviceID, "Location": checkpoint.Location},
         )
         checkpoint_id = result.scalar()  # Fetch the returned checkpoint ID
+        await pg_notify(conn, "responses", "*")
     return {"message": "Checkpoint added", "checkpoint_id": checkpoint_id}
 
 
@@ -315,6 +316,17 @@ async def add_runner_to_race(runner_in_race: RunnerInRace, dbc: deps.GetDbCtx):
         if runner_exists.scalar() is None:
             raise HTTPException(status_code=404, detail="Runner not found")
 
+        tag_taken = await conn.execute(
+            sa.text(
+                "SELECT 1 FROM RunnerInRace WHERE RaceID = :RaceID AND TagID = :TagID"
+            ),
+            {"RaceID": runner_in_race.RaceID, "TagID": runner_in_race.TagID},
+        )
+        if tag_taken.scalar() is not None:
+            raise HTTPException(
+                status_code=400, detail="Tag is already registered in this race"
+            )
+
         # Insert the runner into the race
         await conn.execute(
             sa.text(
@@ -326,9 +338,41 @@ async def add_runner_to_race(runner_in_race: RunnerInRace, dbc: deps.GetDbCtx):
                 "TagID": runner_in_race.TagID,
             },
         )
+        await pg_notify(conn, "cache", str(runner_in_race.RaceID))
         return {"message": "Runner added to the race"}
 
 
+# Upload formats, by Content-Type
+REGISTRATION_PARSERS = {
+    "text/csv": registrations.parse_csv,
+    "application/x-ndjson": registrations.parse_ndjson,
+    "application/ndjson": registrations.parse_ndjson,
+}
+
+
+@router.post("/race/{race_id}/registrations/import")
+async def import_registrations(race_id: int, request: Request, dbc: deps.GetDbCtx):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    parser = REGISTRATION_PARSERS.get(content_type.lower())
+    if parser is None:
+        raise HTTPException(
+            status_code=415, detail="Upload text/csv or application/x-ndjson"
+        )
+
+    errors: list[registrations.RowError] = []
+    async with dbc as conn:
+        if await get_archived_at(conn, race_id) is not None:
+            raise HTTPException(status_code=400, detail="Race is archived")
+        try:
+            report = await registrations.import_registrations(
+                conn, race_id, parser(request.stream(), errors), errors
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        await pg_notify(conn, "cache", str(race_id))
+    return report
+
+
 @router.post("/race/{race_id}/checkpoint/{checkpoint_id}/{position}")
 async def add_checkpoint_to_race(
     race_id: int,
@@ -368,154 +412,129 @@ async def add_checkpoint_to_race(
                 "parsed_time_limit": parsed_time_limit,
             },
         )
+        await pg_notify(conn, "cache", str(race_id))
     return {"message": "Checkpoint added to race", "status_code": 200}
 
 
 @router.post("/checkpoint_passing")
 async def post_checkpoint_passing(passing: CheckpointPassing, dbc: deps.GetDbCtx):
-    # Convert PassingTime to offset-naive UTC datetime
-
     async with dbc as conn:
-        # Retrieve the RunnerID based on the TagID
-        result = await conn.execute(
-            sa.text("SELECT RunnerID FROM RunnerInRace WHERE TagID = :TagID"),
-            {"TagID": passing.TagID},
+        outcome = await ingest.record_passing(
+            conn, passing.TagID, passing.DeviceID, passing.PassingTime
         )
-        runner_id = result.scalar()
 
-        result = await conn.execute(
-            sa.text("SELECT RaceID FROM RunnerInRace WHERE TagID = :TagID"),
-            {"TagID": passing.TagID},
+    if outcome == ingest.Outcome.UNKNOWN_TAG:
+        raise HTTPException(
+            status_code=400, detail="Invalid TagID: No runner found with this TagID"
         )
-        race_id = result.scalar()
-
-        # Check if there is a recent passing within the last 30 seconds for the same TagID
-        recent_passing_check = await conn.execute(
-            sa.text(
-                """SELECT 1 FROM CheckpointPassing 
-                   WHERE RunnerID = :runnerID 
-                     AND passingtime > NOW() + INTERVAL ' 120 minute' - INTERVAL '5 second'"""
-            ),
-            {"runnerID": runner_id},
+    if outcome == ingest.Outcome.DUPLICATE:
+        raise HTTPException(
+            status_code=400,
+            detail="Checkpoint passing repeats a recent read of this tag at this checkpoint",
         )
-        if recent_passing_check.scalar() is not None:
-            raise HTTPException(
-                status_code=400,
-                detail="Checkpoint passing not allowed within 30 seconds of the last passing",
-            )
-
-        result = await conn.execute(
-            sa.text(
-                """SELECT * FROM 
-                        checkpoint NATURAL JOIN checkpointinrace  
-                        NATURAL LEFT JOIN (
-                            SELECT * FROM checkpointpassing
-                            WHERE runnerid = :runnerID)
-                        WHERE raceid = :raceID
-                        AND deviceid = :deviceID
-                        AND runnerid ISNULL
-                        ORDER BY position"""
-            ),
-            {"runnerID": runner_id, "raceID": race_id, "deviceID": passing.DeviceID},
+    if outcome == ingest.Outcome.NO_CHECKPOINT:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid DeviceID: No remaining checkpoint in race for this device",
         )
-        checkpoint_id = result.scalar()
+    return {"message": "Checkpoint passing added"}
 
-        if runner_id:
-            parameters = {
-                "RunnerID": runner_id,
-                "CheckpointID": checkpoint_id,
-                "PassingTime": passing.PassingTime,
-            }
-            await conn.execute(
-                sa.text(
-                    "INSERT INTO CheckpointPassing (RunnerID, CheckpointID, PassingTime) VALUES (:RunnerID, :CheckpointID, :PassingTime)"
-                ),
-                parameters,
-            )
-            await pg_notify(
-                conn, "all", "New checkpoint passing added"
-            )  # Notify the websocket that a new passing was added to update the live feed.
-            return {"message": "Checkpoint passing added"}
-        else:
-            raise HTTPException(
-                status_code=400, detail="Invalid TagID: No runner found with this TagID"
-            )
+
+@router.post("/checkpoint_passings/batch")
+async def post_checkpoint_passings_batch(
+    passings: List[CheckpointPassing], dbc: deps.GetDbCtx
+):
+    reads = [
+        ingest.Read(passing.TagID, passing.DeviceID, passing.PassingTime)
+        for passing in passings
+    ]
+    async with dbc as conn:
+        outcomes = await ingest.record_passings(conn, reads)
+
+    return {
+        "added": outcomes.count(ingest.Outcome.ADDED),
+        "results": [
+            {"index": index, "outcome": outcome}
+            for index, outcome in enumerate(outcomes)
+        ],
+    }
 
 
 @router.get("/runners")
-async def get_runners(dbc: deps.GetDbCtx):
-    async with dbc as conn:
-        result = await conn.execute(sa.text("SELECT * FROM Runner"))
-        runners = result.mappings().all()
-    return {"runners": runners}
+async def get_runners(request: Request, dbc: deps.GetDbCtx):
+    async def render():
+        async with dbc as conn:
+            result = await conn.execute(sa.text("SELECT * FROM Runner"))
+            return {"runners": result.mappings().all()}
+
+    return await cached(request, None, render)
 
 
 @router.get("/races", response_model=List[RaceOut])
-async def get_races(dbc: deps.GetDbCtx):
-    async with dbc as conn:
-        result = await conn.execute(
-            sa.text(
-                "SELECT RaceID as raceid, Name as name, startTime as starttime FROM Race"
+async def get_races(request: Request, dbc: deps.GetDbCtx):
+    async def render():
+        async with dbc as conn:
+            result = await conn.execute(
+                sa.text(
+                    "SELECT RaceID as raceid, Name as name, startTime as starttime FROM Race"
+                )
             )
-        )
-        races = result.mappings().all()
-    return races
+            return result.mappings().all()
+
+    return await cached(request, None, render)
 
 
 @router.get("/checkpoints")
-async def get_checkpoints(dbc: deps.GetDbCtx):
-    async with dbc as conn:
-        result = await conn.execute(sa.text("SELECT * FROM checkpoint"))
-    checkpoints = result.fetchall()
-    return {"checkpoints": str(checkpoints)}
+async def get_checkpoints(request: Request, dbc: deps.GetDbCtx):
+    async def render():
+        async with dbc as conn:
+            result = await conn.execute(sa.text("SELECT * FROM checkpoint"))
+            return {"checkpoints": result.mappings().all()}
+
+    return await cached(request, None, render)
+
+
+CHECKPOINTS_IN_RACE = db.Statement(
+    "checkpoints_in_race",
+    "SELECT checkpointid, position, timelimit FROM checkpointinrace WHERE raceid = $1",
+)
+RUNNERS_IN_RACE = db.Statement(
+    "runners_in_race",
+    """
+    SELECT runnerid, name, TagID
+    FROM runnerinrace NATURAL JOIN runner WHERE raceid = $1
+    """,
+)
+RUNNER_PASSINGS = db.Statement(
+    "runner_passings",
+    "SELECT checkpointid, passingtime FROM checkpointpassing WHERE runnerid = $1",
+)
 
 
 @router.get("/checkpointinrace/{race_id}")
-async def get_checkpoints_in_race(race_id: int, dbc: deps.GetDbCtx):
-    async with dbc as conn:
-        result = await conn.execute(
-            sa.text(
-                f"""
-                    SELECT checkpointid, position, timelimit
-                    FROM checkpointinrace WHERE raceid = {race_id}
-                """
-            )
-        )
-        json_result = result.mappings().all()
-    return json_result
+async def get_checkpoints_in_race(race_id: int, request: Request, dbc: deps.GetDbCtx):
+    async def render():
+        async with dbc as conn:
+            return await db.fetch(conn, CHECKPOINTS_IN_RACE, race_id)
+
+    return await cached(request, race_id, render)
 
 
 @router.get("/runners/{race_id}")
-async def get_runners_in_race(race_id: int, dbc: deps.GetDbCtx):
+async def get_runners_in_race(race_id: int, request: Request, dbc: deps.GetDbCtx):
+    async def render():
+        async with dbc as conn:
+            return await db.fetch(conn, RUNNERS_IN_RACE, race_id)
 
-    async with dbc as conn:
-        result = await conn.execute(
-            sa.text(
-                f"""
-                SELECT runnerid, name, TagID
-                FROM runnerinrace NATURAL JOIN runner WHERE raceid = {race_id}
-            """
-            )
-        )
-        json_result = result.mappings().all()
-    return json_result
+    return await cached(request, race_id, render)
 
 
 @router.get("/checkpointpassings/{runner_id}")
 async def get_checkpoint_passings(runner_id: int, dbc: deps.GetDbCtx):
-
+    # Spans races, so it is encoded but not cached
     async with dbc as conn:
-        result = await conn.execute(
-            sa.text(
-                f"""
-                    SELECT checkpointid, passingtime
-                    FROM checkpointpassing
-                   WHERE runnerid = {runner_id}
-               """
-            )
-        )
-        json_result = result.mappings().all()
-    return json_result
+        records = await db.fetch(conn, RUNNER_PASSINGS, runner_id)
+    return JSONResponse(records)
 
 
 @router.get("/tables")
@@ -537,12 +556,15 @@ async def tables(dbc: deps.GetDbCtx):
 @router.delete("/race/{race_id}")
 async def delete_race(race_id: int, dbc: deps.GetDbCtx):
     async with dbc as conn:
+        # Dropping the partition is cheaper than cascading the delete row by row
+        await archive.drop_race(conn, race_id)
         result = await conn.execute(
             sa.text("DELETE FROM Race WHERE RaceID = :race_id"),
             {"race_id": race_id},
         )
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Race not found")
+        await pg_notify(conn, "cache", str(race_id))
         return {"message": "Race deleted successfully"}
 
 
@@ -555,6 +577,7 @@ async def delete_runner(runner_id: int, dbc: deps.GetDbCtx):
         )
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Runner not found")
+        await pg_notify(conn, "cache", "*")
         return {"message": "Runner deleted successfully"}
 
 
@@ -567,74 +590,352 @@ async def delete_checkpoint(checkpoint_id: int, dbc: deps.GetDbCtx):
         )
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Checkpoint not found")
+        await pg_notify(conn, "cache", "*")
         return {"message": "Checkpoint deleted successfully"}
 
 
 @router.delete("/checkpoint_passings")
-async def delete_checkpoint_passings(dbc: deps.GetDbCtx):
+async def delete_checkpoint_passings(dbc: deps.GetDbCtx, race_id: Optional[int] = None):
     async with dbc as conn:
-        await conn.execute(sa.text("DELETE FROM checkpointpassing"))
+        if race_id is None:
+            await conn.execute(sa.text("TRUNCATE CheckpointPassing"))
+            await pg_notify(conn, "cache", "*")
+        else:
+            partition = await conn.execute(
+                sa.text("SELECT to_regclass(:name) IS NOT NULL"),
+                {"name": archive.partition_name(race_id)},
+            )
+            if not partition.scalar():
+                raise HTTPException(status_code=404, detail="Race not found")
+            await conn.execute(sa.text(f"TRUNCATE {archive.partition_name(race_id)}"))
+            await pg_notify(conn, "cache", str(race_id))
         return {"message": "Checkpointpassings removed"}
 
 
-@router.get("/race/{race_id}/details")
-async def get_race_details(race_id: int, dbc: deps.GetDbCtx):
+async def get_archived_at(conn, race_id: int) -> Optional[datetime]:
+    result = await conn.execute(
+        sa.text("SELECT RaceID, ArchivedAt FROM Race WHERE RaceID = :race_id"),
+        {"race_id": race_id},
+    )
+    race = result.first()
+    if race is None:
+        raise HTTPException(status_code=404, detail="Race not found")
+    return race.archivedat
+
+
+@router.post("/race/{race_id}/archive")
+async def archive_race(race_id: int, dbc: deps.GetDbCtx):
     async with dbc as conn:
-        race_details = await conn.execute(
-            sa.text("SELECT RaceID, Name, startTime FROM Race WHERE RaceID = :race_id"),
-            {"race_id": race_id},
-        )
-        race = race_details.mappings().first()
-        if not race:
-            raise HTTPException(status_code=404, detail="Race not found")
+        if await get_archived_at(conn, race_id) is not None:
+            raise HTTPException(status_code=400, detail="Race is already archived")
+        if await live_standings.is_active(conn, race_id):
+            raise HTTPException(status_code=400, detail="Race is still active")
+        archived = await archive.archive_race(conn, race_id)
+        await pg_notify(conn, "cache", str(race_id))
+    return {"message": "Race archived", "passings": archived}
 
-        # Fetch racers in this race
-        racers = await conn.execute(
-            sa.text(
-                """
-                SELECT r.RunnerID, r.name
-                FROM Runner r
-                JOIN RunnerInRace rir ON r.RunnerID = rir.RunnerID
-                WHERE rir.RaceID = :race_id
-                """
-            ),
-            {"race_id": race_id},
-        )
-        racers_list = racers.mappings().all()
 
-        # Fetch checkpoints in this race with time limits
-        checkpoints = await conn.execute(
-            sa.text(
-                """
-                SELECT c.CheckpointID, c.Location, cir.TimeLimit
-                FROM Checkpoint c
-                JOIN CheckpointInRace cir ON c.CheckpointID = cir.CheckpointID
-                WHERE cir.RaceID = :race_id
-                """
-            ),
-            {"race_id": race_id},
-        )
-        checkpoints_list = checkpoints.mappings().all()
+@router.get("/race/{race_id}/archive")
+async def export_race_archive(race_id: int, request: Request, dbc: deps.GetDbCtx):
+    async with dbc as conn:
+        await get_archived_at(conn, race_id)
+        if not await archive.is_archived(conn, race_id):
+            raise HTTPException(status_code=404, detail="Race has no archive")
+
+    async def stream():
+        engine = request.app.state.sqlalchemy_engine
+        async with db.get_connection(engine) as conn:
+            async for chunk in archive.export_race(conn, race_id):
+                yield chunk
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/gzip",
+        headers={
+            "Content-Disposition": f'attachment; filename="race-{race_id}.csv.gz"'
+        },
+    )
+
+
+@router.delete("/race/{race_id}/archive")
+async def purge_race_archive(race_id: int, dbc: deps.GetDbCtx):
+    async with dbc as conn:
+        await get_archived_at(conn, race_id)
+        if not await archive.is_archived(conn, race_id):
+            raise HTTPException(status_code=404, detail="Race has no archive")
+        await archive.purge_race(conn, race_id)
+    return {"message": "Race archive removed"}
 
-        # Fetch checkpoint passings for this race, including checkpoint locations
-        checkpoint_passings = await conn.execute(
-            sa.text(
-                """
-                SELECT cp.CheckpointID, cp.PassingTime, r.name AS RunnerName, c.Location AS CheckpointLocation
-                FROM CheckpointPassing cp
-                JOIN RunnerInRace rir ON cp.RunnerID = rir.RunnerID
-                JOIN Runner r ON r.RunnerID = rir.RunnerID
-                JOIN Checkpoint c ON cp.CheckpointID = c.CheckpointID
-                WHERE rir.RaceID = :race_id
-                """
-            ),
-            {"race_id": race_id},
+
+@router.post("/race/{race_id}/restore")
+async def restore_race(race_id: int, request: Request, dbc: deps.GetDbCtx):
+    # Restores from the archive schema, or from an uploaded export when the
+    # archive has been removed.
+    async with dbc as conn:
+        if await get_archived_at(conn, race_id) is None:
+            raise HTTPException(status_code=400, detail="Race is not archived")
+        if not await archive.is_archived(conn, race_id):
+            uploaded = request.headers.get("content-length", "0") != "0"
+            if not uploaded and "transfer-encoding" not in request.headers:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Race has no archive, upload its export to restore it",
+                )
+            await archive.import_race(conn, race_id, request.stream())
+        await archive.restore_race(conn, race_id)
+        await pg_notify(conn, "cache", str(race_id))
+    return {"message": "Race restored"}
+
+
+@router.get("/race/{race_id}/results.{format}")
+async def export_race_results(
+    race_id: int, format: str, request: Request, dbc: deps.GetDbCtx
+):
+    if format not in results.FORMATS:
+        raise HTTPException(status_code=404, detail="Unknown results format")
+    if format == "parquet" and results.pq is None:
+        raise HTTPException(
+            status_code=501, detail="Parquet export needs pyarrow installed"
         )
-        passings_list = checkpoint_passings.mappings().all()
+    async with dbc as conn:
+        # An archived race's passings are read from its archive
+        passings = "CheckpointPassing"
+        if await get_archived_at(conn, race_id) is not None:
+            if not await archive.is_archived(conn, race_id):
+                raise HTTPException(status_code=404, detail="Race has no archive")
+            passings = f"{archive.SCHEMA}.{archive.partition_name(race_id)}"
+
+    media_type, encode = results.FORMATS[format]
+
+    async def stream():
+        engine = request.app.state.sqlalchemy_engine
+        async with db.get_connection(engine) as conn:
+            async for chunk in encode(results.fetch_results(conn, race_id, passings)):
+                yield chunk
+
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="race-{race_id}-results.{format}"'
+            )
+        },
+    )
+
+
+# Most runners in one page of race details
+MAX_DETAILS_RUNNERS = 1000
+
+# The race, its route and one page of runners with their passings, built as
+# one JSON document by the database. Runners are paged by RunnerID, and
+# next_after_runner_id is set while there may be more.
+RACE_DETAILS = db.Statement(
+    "race_details",
+    """
+    WITH race AS (
+        SELECT RaceID, Name, startTime FROM Race WHERE RaceID = $1
+    ),
+    page AS (
+        SELECT rir.RunnerID, r.name, rir.TagID
+        FROM RunnerInRace rir
+        JOIN Runner r ON r.RunnerID = rir.RunnerID
+        WHERE rir.RaceID = $1 AND rir.RunnerID > $2
+        ORDER BY rir.RunnerID
+        LIMIT $3
+    ),
+    passings AS (
+        SELECT cp.RunnerID, json_agg(json_build_object(
+            'checkpointid', cp.CheckpointID,
+            'checkpointlocation', c.Location,
+            'passingtime', cp.PassingTime
+        ) ORDER BY cp.PassingTime) AS passings
+        FROM CheckpointPassing cp
+        JOIN Checkpoint c ON c.CheckpointID = cp.CheckpointID
+        WHERE cp.RaceID = $1 AND cp.RunnerID IN (SELECT RunnerID FROM page)
+        GROUP BY cp.RunnerID
+    )
+    SELECT json_build_object(
+        'race', json_build_object(
+            'raceid', race.RaceID,
+            'name', race.Name,
+            'starttime', race.startTime
+        ),
+        'checkpoints', coalesce((
+            SELECT json_agg(json_build_object(
+                'checkpointid', c.CheckpointID,
+                'location', c.Location,
+                'position', cir.Position,
+                'timelimit', cir.TimeLimit
+            ) ORDER BY cir.Position)
+            FROM CheckpointInRace cir
+            JOIN Checkpoint c ON c.CheckpointID = cir.CheckpointID
+            WHERE cir.RaceID = $1
+        ), '[]'::json),
+        'racers', coalesce((
+            SELECT json_agg(json_build_object(
+                'runnerid', page.RunnerID,
+                'name', page.name,
+                'tagid', page.TagID,
+                'passings', coalesce(passings.passings, '[]'::json)
+            ) ORDER BY page.RunnerID)
+            FROM page
+            LEFT JOIN passings ON passings.RunnerID = page.RunnerID
+        ), '[]'::json),
+        'next_after_runner_id', (
+            SELECT max(RunnerID) FROM page HAVING count(*) = $3
+        )
+    )::text
+    FROM race
+    """,
+)
+
+
+@router.get("/race/{race_id}/details")
+async def get_race_details(
+    race_id: int,
+    request: Request,
+    dbc: deps.GetDbCtx,
+    after_runner_id: int = 0,
+    limit: int = MAX_DETAILS_RUNNERS,
+):
+    limit = max(1, min(limit, MAX_DETAILS_RUNNERS))
+
+    async def render():
+        async with dbc as conn:
+            details = await db.fetchval(
+                conn, RACE_DETAILS, race_id, after_runner_id, limit
+            )
+        if details is None:
+            raise HTTPException(status_code=404, detail="Race not found")
+        return details
+
+    return await cached(request, race_id, render)
+
+
+# Ranking, splits and latest checkpoint for every runner, built as one JSON
+# document by the database so a refresh is a single statement.
+LEADERBOARD = db.Statement(
+    "leaderboard",
+    """
+    WITH race AS (
+        SELECT RaceID, startTime FROM Race WHERE RaceID = $1
+    ),
+    route AS (
+        SELECT CheckpointID, Position, TimeLimit
+        FROM CheckpointInRace WHERE RaceID = $1
+    ),
+    passings AS (
+        SELECT cp.RunnerID, cp.CheckpointID, route.Position, cp.PassingTime,
+            EXTRACT(EPOCH FROM cp.PassingTime - coalesce(
+                lag(cp.PassingTime) OVER (
+                    PARTITION BY cp.RunnerID ORDER BY route.Position
+                ),
+                (SELECT startTime FROM race)
+            )) AS split
+        FROM CheckpointPassing cp
+        JOIN route ON route.CheckpointID = cp.CheckpointID
+        WHERE cp.RaceID = $1
+    ),
+    standings AS (
+        SELECT rir.RunnerID, r.name, rir.TagID,
+            count(p.CheckpointID) AS passed,
+            max(p.PassingTime) AS last_time,
+            (array_agg(p.CheckpointID ORDER BY p.Position DESC)
+                FILTER (WHERE p.CheckpointID IS NOT NULL))[1] AS last_checkpoint,
+            coalesce(
+                json_object_agg(p.CheckpointID, p.PassingTime)
+                    FILTER (WHERE p.CheckpointID IS NOT NULL),
+                '{}'::json
+            ) AS times,
+            coalesce(
+                json_object_agg(p.CheckpointID, p.split)
+                    FILTER (WHERE p.CheckpointID IS NOT NULL),
+                '{}'::json
+            ) AS splits
+        FROM RunnerInRace rir
+        JOIN Runner r ON r.RunnerID = rir.RunnerID
+        LEFT JOIN passings p ON p.RunnerID = rir.RunnerID
+        WHERE rir.RaceID = $1
+        GROUP BY rir.RunnerID, r.name, rir.TagID
+    ),
+    ranked AS (
+        SELECT rank() OVER (
+            ORDER BY passed DESC, last_time ASC NULLS LAST
+        ) AS rank, *
+        FROM standings
+    )
+    SELECT json_build_object(
+        'race_id', race.RaceID,
+        'start_time', race.startTime,
+        'checkpoints', coalesce((
+            SELECT json_agg(json_build_object(
+                'id', CheckpointID,
+                'position', Position,
+                'timelimit', TimeLimit
+            ) ORDER BY Position)
+            FROM route
+        ), '[]'::json),
+        'runners', coalesce((
+            SELECT json_agg(json_build_object(
+                'rank', rank,
+                'id', RunnerID,
+                'name', name,
+                'tagid', TagID,
+                'passed', passed,
+                'last_checkpoint', last_checkpoint,
+                'last_time', last_time,
+                'times', times,
+                'splits', splits
+            ) ORDER BY rank, RunnerID)
+            FROM ranked
+        ), '[]'::json)
+    )::text
+    FROM race
+    """,
+)
+
+
+@router.get("/race/{race_id}/leaderboard")
+async def get_race_leaderboard(race_id: int, request: Request, dbc: deps.GetDbCtx):
+    async def render():
+        async with dbc as conn:
+            leaderboard = await db.fetchval(conn, LEADERBOARD, race_id)
+        if leaderboard is None:
+            raise HTTPException(status_code=404, detail="Race not found")
+        return leaderboard
 
+    return await cached(request, race_id, render)
+
+
+@router.get("/race/{race_id}/standings")
+async def get_race_standings(
+    race_id: int, request: Request, limit: Optional[int] = None
+):
+    async def render():
+        race = live_standings.get(race_id)
+        if race is None:
+            race = await live_standings.refresh(race_id)
+        if race is None:
+            raise HTTPException(status_code=404, detail="Race not found")
         return {
-            "race": race,
-            "racers": racers_list,
-            "checkpoints": checkpoints_list,
-            "checkpoint_passings": passings_list,
+            "race_id": race_id,
+            "runners": len(race),
+            "standings": [standing._asdict() for standing in race.top(limit)],
         }
+
+    return await cached(request, race_id, render)
+
+
+@router.get("/race/{race_id}/standings/{runner_id}")
+async def get_runner_standing(race_id: int, runner_id: int, request: Request):
+    async def render():
+        race = live_standings.get(race_id)
+        if race is None:
+            race = await live_standings.refresh(race_id)
+        standing = race.standing(runner_id) if race is not None else None
+        if standing is None:
+            raise HTTPException(status_code=404, detail="Runner not found in race")
+        return standing._asdict()
+
+    return await cached(request, race_id, render)
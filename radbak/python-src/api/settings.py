@@ -58,6 +58,46 @@ class Settings(
 
     CORS_ALLOWED_ORIGINS: list[str] = []
 
+    # Bring the schema up to date before serving; see api/migrations
+    MIGRATE_ON_STARTUP: bool = True
+
+    # Races starting this close to now have their tag and route lookups cached
+    # and their live standings kept in memory
+    RESOLUTION_CACHE_WINDOW_HOURS: int = 24
+
+    # Reads of a tag at a checkpoint this close together are one burst, of
+    # which only the first is recorded. Bursts are remembered for the
+    # retention after their last read, up to a number of tag and checkpoint
+    # pairs.
+    DEDUPE_WINDOW_SECONDS: float = 5
+    DEDUPE_RETENTION_SECONDS: float = 300
+    DEDUPE_MAX_ENTRIES: int = 100_000
+
+    # Worker processes started by `poetry run serve`, each with its own
+    # websockets, database listener and metrics. Defaults to one, as /metrics
+    # only reports the worker that answers the scrape.
+    API_WORKERS: int | None = None
+    # Passings are shared between workers through the live event log, which
+    # keeps them this long
+    LIVE_EVENT_RETENTION_MINUTES: float = 60
+
+    # Messages queued per websocket client before its live updates are dropped,
+    # and how long a single send may take before the client is disconnected
+    WS_QUEUE_SIZE: int = 256
+    WS_SEND_TIMEOUT: float = 10
+
+    # Subscribe to checkpoint reads from inside the API instead of running
+    # fwdservice. Workers share the subscription when a group is set.
+    MQTT_INGEST: bool = False
+    MQTT_HOST: str = "o4b81453.ala.eu-central-1.emqxsl.com"
+    MQTT_PORT: int = 8883
+    MQTT_TOPIC: str = "postcheckpoint"
+    MQTT_SHARE_GROUP: str = "radbak-api"
+    MQTT_CLIENT_ID: str = ""
+    MQTT_USERNAME: str = "fwdservice"
+    MQTT_PASSWORD: str = "fwdservice"
+    MQTT_CA_CERTS: str | None = "./fwdservice/emqxsl-ca.crt"
+
     HASHING_SECRET: bytes = b"hushhushhush"
     JWT_ACCESS_TOKEN_KEY: str = "hush"
     JWT_REFRESH_TOKEN_KEY: str = "hushhush"
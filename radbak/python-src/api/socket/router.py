@@ -1,4 +1,6 @@
 import asyncio
+import json
+import logging
 from datetime import datetime
 from typing import Literal
 
@@ -8,19 +10,35 @@ from fastapi import APIRouter, HTTPException, WebSocket
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
 
-from api import deps
+from api import deps, events, metrics
+from api.cache import resolution_cache
+from api.dedupe import read_window
+from api.responses import response_cache
 from api.settings import get_settings
+from api.standings import live_standings
 
 from . import service
 
 router = APIRouter(tags=["WebSocket"])
 
 lock = asyncio.Lock()
-manager = service.TimeoutSocketManager()
+manager = service.TimeoutSocketManager(
+    queue_size=get_settings().WS_QUEUE_SIZE,
+    send_timeout=get_settings().WS_SEND_TIMEOUT,
+)
+deltas = service.DeltaLog()
 LISTENER_TASK = None
+RELAY_TASK = None
+relay_wakeup = asyncio.Event()
+# Clients that missed more events than this reload the race instead
+MAX_CATCH_UP = 10_000
 
 
-async def pg_notify(conn: deps.GetDb, channel: Literal["all", "dm"], message: str):
+async def pg_notify(
+    conn: deps.GetDb,
+    channel: Literal["all", "dm", "cache", "passing", "responses"],
+    message: str,
+):
     await conn.execute(
         sa.text(f"SELECT pg_notify('{channel}', :msg)"), {"msg": message}
     )
@@ -36,10 +54,186 @@ async def handle_notifications(
         await manager.send_to(client_id, payload)
     if notification.channel == "all" and notification.payload:
         await manager.broadcast(notification.payload)
+    if notification.channel == "cache" and notification.payload:
+        race_id = None if notification.payload == "*" else int(notification.payload)
+        if race_id is None:
+            # The database may have been reset, outbox included
+            events.outbox.last = None
+        await resolution_cache.refresh(race_id)
+        await live_standings.refresh(race_id)
+        # Only once the race is reloaded, so no response is encoded from before
+        if race_id is None:
+            response_cache.clear()
+        else:
+            response_cache.invalidate(race_id)
+            response_cache.invalidate(None)
+    if notification.channel == "responses" and notification.payload:
+        # Runners, races or checkpoints were added, which only lists show
+        response_cache.invalidate(None)
+    if notification.channel == "passing":
+        # However many arrive, the relay reads everything new at once
+        relay_wakeup.set()
+    if notification.channel == "reads" and notification.payload:
+        for read in events.decode_reads(notification.payload):
+            read_window.remember(*read)
+
+
+def render_passings(seq: int, changes: list[dict]) -> str:
+    return json.dumps({"type": "passings", "seq": seq, "passings": changes})
+
+
+async def apply_passings(passings: list[events.Passing]) -> None:
+    for passing in passings:
+        resolution_cache.record(*passing)
+    await live_standings.apply_passings(passings)
+    for race_id in {passing.race_id for passing in passings}:
+        response_cache.invalidate(race_id)
+
+
+def changes_by_race(passings: list[events.Passing]) -> dict[int, list[dict]]:
+    changes: dict[int, list[dict]] = {}
+    for passing in passings:
+        race = live_standings.get(passing.race_id)
+        changes.setdefault(passing.race_id, []).append(
+            {
+                "race_id": passing.race_id,
+                "runner_id": passing.runner_id,
+                "checkpoint_id": passing.checkpoint_id,
+                "passing_time": passing.passing_time.isoformat(),
+                "rank": race.rank(passing.runner_id) if race else None,
+            }
+        )
+    return changes
+
+
+async def handle_events(batch: list[events.Event]) -> None:
+    """Apply a batch of events and push each race its passings as one delta."""
+    # Clients that resume after it have seen every event in the batch
+    seq = batch[-1].seq
+    passings = [passing for event in batch for passing in event.passings]
+    await apply_passings(passings)
+    for race_id, changes in changes_by_race(passings).items():
+        delta = service.Delta(seq, race_id, render_passings(seq, changes), changes)
+        deltas.append(delta)
+        await publish_delta(delta)
+
+
+async def relay() -> None:
+    """Fan out the events in the outbox as they commit, a batch at a time."""
+    while True:
+        try:
+            async with asyncio.timeout(events.outbox.poll_interval):
+                await relay_wakeup.wait()
+        except TimeoutError:
+            pass
+        relay_wakeup.clear()
+        try:
+            while True:
+                batch = await events.outbox.poll()
+                if deltas.started != events.outbox.started:
+                    # Relaying (re)started, and older deltas no longer follow on
+                    deltas.reset(events.outbox.started)
+                if batch:
+                    await handle_events(batch)
+                if len(batch) < events.outbox.batch_size:
+                    break
+            await events.outbox.prune()
+        except Exception:
+            logging.exception("Could not relay live events")
+
+
+async def missed_deltas(since: int, until: int) -> list[service.Delta] | None:
+    """Deltas in (since, until] from the outbox, or None to reload instead."""
+    missed = await events.outbox.since(since, MAX_CATCH_UP + 1)
+    if missed is None or len(missed) > MAX_CATCH_UP:
+        return None
+    return [
+        service.Delta(event.seq, race_id, render_passings(event.seq, changes), changes)
+        for event in missed
+        if event.seq <= until
+        for race_id, changes in changes_by_race(event.passings).items()
+    ]
+
+
+async def publish_delta(delta: service.Delta) -> None:
+    with metrics.WS_FANOUT_SECONDS.time():
+        await fan_out(delta)
+
+
+async def fan_out(delta: service.Delta) -> None:
+    sent = await manager.publish(
+        [service.ALL, service.race_topic(delta.race_id)], delta.message, seq=delta.seq
+    )
+    for runner_id in {change["runner_id"] for change in delta.changes}:
+        topic = service.runner_topic(delta.race_id, runner_id)
+        if not manager.has_subscribers(topic):
+            continue
+        changes = [
+            change for change in delta.changes if change["runner_id"] == runner_id
+        ]
+        await manager.publish(
+            [topic], render_passings(delta.seq, changes), exclude=sent, seq=delta.seq
+        )
+
+
+def queue_depths() -> dict[tuple[str, ...], float]:
+    depths = [len(connection.queue) for connection in manager.connections.values()]
+    return {("total",): sum(depths), ("max",): max(depths, default=0)}
+
+
+metrics.WS_CONNECTIONS.set_function(lambda: len(manager.connections))
+metrics.WS_LAGGING.set_function(
+    lambda: sum(connection.lagging for connection in manager.connections.values())
+)
+metrics.WS_QUEUE_DEPTH.set_function(queue_depths)
+
+
+def delta_for(client_id: str, delta: service.Delta) -> str | None:
+    """The part of a delta a client is subscribed to, if any."""
+    if manager.is_subscribed(client_id, service.race_topic(delta.race_id)):
+        return delta.message
+    changes = [
+        change
+        for change in delta.changes
+        if manager.is_subscribed(
+            client_id, service.runner_topic(delta.race_id, change["runner_id"])
+        )
+    ]
+    return render_passings(delta.seq, changes) if changes else None
+
+
+def subscription_topic(race_id: int | None, runner_id: int | None) -> str | None:
+    if race_id is None:
+        return None
+    if runner_id is None:
+        return service.race_topic(race_id)
+    return service.runner_topic(race_id, runner_id)
+
+
+def handle_subscription(client_id: str, message: str) -> bool:
+    """Apply a subscribe/unsubscribe request, returning False for other messages."""
+    try:
+        request = json.loads(message)
+    except ValueError:
+        return False
+    if not isinstance(request, dict) or request.get("type") not in (
+        "subscribe",
+        "unsubscribe",
+    ):
+        return False
+
+    topic = subscription_topic(request.get("race_id"), request.get("runner_id"))
+    if topic is None:
+        return True
+    if request["type"] == "subscribe":
+        manager.subscribe(client_id, topic)
+    else:
+        manager.unsubscribe(client_id, topic)
+    return True
 
 
 async def start_task():
-    global LISTENER_TASK
+    global LISTENER_TASK, RELAY_TASK
     async with lock:
         if LISTENER_TASK is not None:
             return
@@ -52,30 +246,92 @@ async def start_task():
                 {
                     "all": handle_notifications,
                     "dm": handle_notifications,
+                    "cache": handle_notifications,
+                    "passing": handle_notifications,
+                    "reads": handle_notifications,
+                    "responses": handle_notifications,
                 },
-                policy=asyncpg_listen.ListenPolicy.LAST,
+                policy=asyncpg_listen.ListenPolicy.ALL,
                 notification_timeout=5,
             )
         )
+        RELAY_TASK = asyncio.create_task(relay())
+
+
+async def stop_task():
+    global LISTENER_TASK, RELAY_TASK
+    async with lock:
+        if LISTENER_TASK is None:
+            return
+        LISTENER_TASK.cancel()
+        LISTENER_TASK = None
+        RELAY_TASK.cancel()
+        RELAY_TASK = None
 
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(
+    websocket: WebSocket,
+    since: int | None = None,
+    race_id: int | None = None,
+    runner_id: int | None = None,
+):
     await start_task()
 
     async with manager.open(websocket) as client_id:
+        topic = subscription_topic(race_id, runner_id)
+        if topic is not None:
+            manager.subscribe(client_id, topic)
 
-        async with deps.get_db_ctx_ws(websocket) as conn:
-            await pg_notify(conn, "all", f"Client #{client_id} joined")
-        await websocket.send_text(f"Client ID: {client_id}")
+        # Deltas up to this seq are sent as catch-up, and the live deltas
+        # after it are held back until they are
+        seq = deltas.seq
+        if since is not None:
+            manager.hold(client_id)
+        await manager.send_to(
+            client_id,
+            json.dumps({"type": "hello", "client_id": client_id, "seq": seq}),
+            critical=True,
+        )
+        if since is not None:
+            missed = deltas.since(since)
+            if missed is None:
+                missed = await missed_deltas(since, seq)
+            if missed is None:
+                # Too far behind to catch up, the client must reload the race
+                await manager.send_to(client_id, service.RESET, critical=True)
+                missed = []
+            messages = [delta_for(client_id, delta) for delta in missed]
+            # A client ahead of this worker has seen the deltas up to `since`
+            manager.release(
+                client_id,
+                max(since, seq),
+                [message for message in messages if message is not None],
+            )
 
+        # Only subscription changes are read from clients; messages for other
+        # clients go through POST /send
         async for message in manager.iter_text(websocket):
+            handle_subscription(client_id, message)
 
-            async with deps.get_db_ctx_ws(websocket) as conn:
-                await pg_notify(conn, "all", f"{client_id}:{message}")
 
-    async with deps.get_db_ctx_ws(websocket) as conn:
-        await pg_notify(conn, "all", f"Client #{client_id} left")
+@router.get("/live_events")
+async def get_live_events(after: int, limit: int = 1000):
+    """Passing events after a seq, for consumers catching up."""
+    missed = await events.outbox.since(after, min(limit, MAX_CATCH_UP))
+    if missed is None:
+        raise HTTPException(
+            status_code=410, detail="Events after this ID are no longer kept"
+        )
+    return {
+        "events": [
+            {
+                "seq": event.seq,
+                "passings": [passing._asdict() for passing in event.passings],
+            }
+            for event in missed
+        ]
+    }
 
 
 class Message(BaseModel):
@@ -1,35 +1,268 @@
 import asyncio
+import json
+import logging
+from collections import deque
 from contextlib import asynccontextmanager
+from typing import Iterable, NamedTuple
 from uuid import uuid4
 
-from fastapi import WebSocket, WebSocketDisconnect
+from fastapi import WebSocket, WebSocketDisconnect, status
 from fastapi.websockets import WebSocketState
 
-lock = asyncio.Lock()
+from api import metrics
+
+# Tells a client that live updates were dropped and the race must be reloaded
+RESET = json.dumps({"type": "reset"})
+
+
+# Topic of clients that did not subscribe to anything and get every message
+ALL = "*"
+
+
+def race_topic(race_id: int) -> str:
+    return f"race:{race_id}"
+
+
+def runner_topic(race_id: int, runner_id: int) -> str:
+    return f"runner:{race_id}:{runner_id}"
+
+
+class Delta(NamedTuple):
+    seq: int
+    race_id: int
+    message: str
+    changes: list[dict]
+
+
+class DeltaLog:
+    """The most recent numbered messages, for clients resuming after a reconnect.
+
+    Numbers only go up, but are not consecutive: a relayed batch is numbered
+    after its last event. Every delta numbered after `after` is kept, which
+    is where relaying started until deltas are dropped to make room.
+    """
+
+    def __init__(self, maxlen: int = 1000) -> None:
+        self.maxlen = maxlen
+        self.messages: deque[Delta] = deque()
+        self.started: int | None = None
+        self.after: int | None = None
+
+    @property
+    def seq(self) -> int:
+        if self.messages:
+            return self.messages[-1].seq
+        return self.after or 0
+
+    def reset(self, seq: int | None) -> None:
+        """Start over after `seq`, dropping every delta kept."""
+        self.messages.clear()
+        self.started = self.after = seq
+
+    def append(self, delta: Delta) -> None:
+        self.messages.append(delta)
+        if len(self.messages) > self.maxlen:
+            self.after = self.messages.popleft().seq
+
+    def since(self, seq: int) -> list[Delta] | None:
+        """Messages after `seq`, or None if this log cannot tell.
+
+        That includes a `seq` ahead of the log, from a worker that relayed
+        further or from before the outbox was reset.
+        """
+        if self.after is None or not self.after <= seq <= self.seq:
+            return None
+        return [delta for delta in self.messages if delta.seq > seq]
+
+
+class Connection:
+    """A client socket with its own bounded outbound queue and writer task.
+
+    Publishing only appends to the queue, so a slow client never holds up
+    the others. When the queue is full the queued deltas are replaced by a
+    single reset, and a client that stops reading is disconnected.
+
+    While a client catches up, live messages are held back and only queued
+    once the catch-up is, so the client gets every delta in order.
+    """
+
+    def __init__(
+        self, websocket: WebSocket, queue_size: int = 256, send_timeout: float = 10
+    ) -> None:
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.queue: deque[tuple[str, bool]] = deque()
+        self.ready = asyncio.Event()
+        self.lagging = False
+        self.dropped = 0
+        self.writer: asyncio.Task | None = None
+        self.closing: asyncio.Task | None = None
+        # Live messages held back while catching up, with their delta seq
+        self.held: list[tuple[str, int | None]] | None = None
+
+    def hold(self) -> None:
+        self.held = []
+
+    def release(self, after: int | None = None, first: Iterable[str] = ()) -> None:
+        """Queue `first` and then the held messages, skipping deltas up to
+        `after`."""
+        held, self.held = self.held or [], None
+        for message in first:
+            self.put(message)
+        for message, seq in held:
+            if seq is None or after is None or seq > after:
+                self.put(message)
+
+    def put(self, message: str, critical: bool = False, seq: int | None = None) -> None:
+        if self.held is not None and not critical:
+            self.held.append((message, seq))
+            return
+        if len(self.queue) >= self.queue_size:
+            kept = deque(item for item in self.queue if item[1])
+            self.dropped += len(self.queue) - len(kept)
+            metrics.WS_DROPPED.inc(amount=len(self.queue) - len(kept))
+            self.queue = kept
+            if not self.lagging:
+                self.queue.append((RESET, True))
+                self.lagging = True
+            if len(self.queue) >= self.queue_size:
+                # Even the messages that cannot be dropped pile up
+                self.close()
+                return
+        if self.lagging and not critical:
+            self.dropped += 1
+            metrics.WS_DROPPED.inc()
+            return
+        self.queue.append((message, critical))
+        self.ready.set()
+
+    def start(self) -> None:
+        self.writer = asyncio.create_task(self.write())
+
+    def close(self) -> None:
+        if self.writer is not None and not self.writer.done():
+            self.writer.cancel()
+            self.closing = asyncio.create_task(self.disconnect())
+
+    async def disconnect(self) -> None:
+        if self.websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            except RuntimeError:
+                pass
+
+    async def write(self) -> None:
+        try:
+            while True:
+                while self.queue:
+                    message, _ = self.queue.popleft()
+                    if message == RESET:
+                        self.lagging = False
+                    async with asyncio.timeout(self.send_timeout):
+                        await self.websocket.send_text(message)
+                self.ready.clear()
+                await self.ready.wait()
+        except asyncio.CancelledError:
+            pass
+        except TimeoutError:
+            logging.warning("Disconnecting websocket client that stopped reading")
+            await self.disconnect()
+        except (WebSocketDisconnect, RuntimeError):
+            pass
 
 
 class SocketManager:
-    def __init__(self) -> None:
-        self.connections: dict[str, WebSocket] = {}
+    def __init__(self, queue_size: int = 256, send_timeout: float = 10) -> None:
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.connections: dict[str, Connection] = {}
+        # topic -> subscribed clients, and the reverse for cleanup
+        self.subscribers: dict[str, set[str]] = {}
+        self.subscriptions: dict[str, set[str]] = {}
 
     def connect(self, websocket: WebSocket) -> str:
         client_id = uuid4().hex
-        self.connections[client_id] = websocket
+        connection = Connection(websocket, self.queue_size, self.send_timeout)
+        connection.start()
+        self.connections[client_id] = connection
+        self.subscriptions[client_id] = set()
+        self.subscribe(client_id, ALL)
         return client_id
 
     def diconnect(self, client_id: str) -> None:
-        self.connections.pop(client_id, None)
+        connection = self.connections.pop(client_id, None)
+        if connection is not None and connection.writer is not None:
+            connection.writer.cancel()
+        for topic in self.subscriptions.pop(client_id, set()):
+            self._remove_subscriber(topic, client_id)
+
+    def subscribe(self, client_id: str, topic: str) -> None:
+        if client_id not in self.subscriptions:
+            return
+        if topic != ALL:
+            self.unsubscribe(client_id, ALL)
+        self.subscriptions[client_id].add(topic)
+        self.subscribers.setdefault(topic, set()).add(client_id)
+
+    def unsubscribe(self, client_id: str, topic: str) -> None:
+        topics = self.subscriptions.get(client_id)
+        if topics is None or topic not in topics:
+            return
+        topics.discard(topic)
+        self._remove_subscriber(topic, client_id)
+
+    def _remove_subscriber(self, topic: str, client_id: str) -> None:
+        clients = self.subscribers.get(topic)
+        if clients is not None:
+            clients.discard(client_id)
+            if not clients:
+                del self.subscribers[topic]
+
+    def is_subscribed(self, client_id: str, topic: str) -> bool:
+        topics = self.subscriptions.get(client_id, ())
+        return ALL in topics or topic in topics
+
+    def has_subscribers(self, topic: str) -> bool:
+        return topic in self.subscribers
 
     async def broadcast(self, message: str):
-        async with lock:
-            for _, websocket in self.connections.items():
-                if websocket.client_state == WebSocketState.CONNECTED:
-                    await websocket.send_text(message)
+        for connection in self.connections.values():
+            connection.put(message)
 
-    async def send_to(self, client_id: str, message: str):
-        async with lock:
-            if client_id in self.connections:
-                await self.connections[client_id].send_text(message)
+    async def publish(
+        self,
+        topics: list[str],
+        message: str,
+        exclude: set[str] = frozenset(),
+        seq: int | None = None,
+    ) -> set[str]:
+        """Queue for the subscribers of any of `topics`, returning who got it.
+
+        `seq` is that of the delta the message carries, if any.
+        """
+        recipients = set().union(*(self.subscribers.get(topic, ()) for topic in topics))
+        recipients -= exclude
+        for client_id in recipients:
+            connection = self.connections.get(client_id)
+            if connection is not None:
+                connection.put(message, seq=seq)
+        return recipients
+
+    def hold(self, client_id: str) -> None:
+        """Hold back live messages for a client until release()."""
+        if client_id in self.connections:
+            self.connections[client_id].hold()
+
+    def release(
+        self, client_id: str, after: int | None = None, first: Iterable[str] = ()
+    ) -> None:
+        if client_id in self.connections:
+            self.connections[client_id].release(after, first)
+
+    async def send_to(self, client_id: str, message: str, critical: bool = False):
+        if client_id in self.connections:
+            self.connections[client_id].put(message, critical)
 
 
 class TimeoutSocketManager(SocketManager):
@@ -37,16 +270,18 @@ class TimeoutSocketManager(SocketManager):
         self,
         heartbeat: float | None = None,
         lifespan: float | None = None,
+        queue_size: int = 256,
+        send_timeout: float = 10,
     ) -> None:
-        super().__init__()
+        super().__init__(queue_size, send_timeout)
         self.heartbeat = heartbeat
         self.lifespan = lifespan
 
     @asynccontextmanager
     async def open(self, websocket: WebSocket):
+        await websocket.accept()
         client_id = self.connect(websocket)
 
-        await websocket.accept()
         try:
             async with asyncio.timeout(self.lifespan):
                 yield client_id
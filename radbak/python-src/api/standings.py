@@ -0,0 +1,243 @@
+import logging
+from bisect import insort
+from datetime import datetime, timedelta
+from typing import Iterable, NamedTuple
+
+import sqlalchemy as sa
+from sortedcontainers import SortedList
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from . import db
+
+# Sorts runners without any passing after everyone who has one
+NO_TIME = datetime.max
+
+
+class Standing(NamedTuple):
+    rank: int
+    runner_id: int
+    passed: int
+    last_time: datetime | None
+    checkpoints_behind: int
+    seconds_behind: float | None
+
+
+class RunnerProgress:
+    def __init__(self, runner_id: int) -> None:
+        self.runner_id = runner_id
+        self.checkpoints: set[int] = set()
+        self.times: list[datetime] = []
+
+    @property
+    def key(self) -> tuple[int, datetime, int]:
+        last_time = self.times[-1] if self.times else NO_TIME
+        return (-len(self.checkpoints), last_time, self.runner_id)
+
+
+class RaceStandings:
+    """Runners of one race kept ordered by (checkpoints passed desc, last passing asc).
+
+    The order is a SortedList of keys, so a passing moves its runner with a
+    remove and an add in O(log n) and a rank is one O(log n) search, instead
+    of recomputing the whole race from CheckpointPassing.
+    """
+
+    def __init__(self, race_id: int) -> None:
+        self.race_id = race_id
+        self.runners: dict[int, RunnerProgress] = {}
+        self.keys: SortedList[tuple[int, datetime, int]] = SortedList()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add_runner(self, runner_id: int) -> RunnerProgress:
+        progress = self.runners.get(runner_id)
+        if progress is None:
+            progress = self.runners[runner_id] = RunnerProgress(runner_id)
+            self.keys.add(progress.key)
+        return progress
+
+    def record(
+        self, runner_id: int, checkpoint_id: int, passing_time: datetime
+    ) -> bool:
+        """Count a passing, returning False if it was already counted."""
+        progress = self.add_runner(runner_id)
+        if checkpoint_id in progress.checkpoints:
+            return False
+
+        self.keys.remove(progress.key)
+        progress.checkpoints.add(checkpoint_id)
+        insort(progress.times, passing_time)
+        self.keys.add(progress.key)
+        return True
+
+    def rank(self, runner_id: int) -> int | None:
+        progress = self.runners.get(runner_id)
+        if progress is None:
+            return None
+        # Runners with the same count and time share a rank
+        return self.keys.bisect_left(progress.key[:2]) + 1
+
+    def standing(self, runner_id: int) -> Standing | None:
+        progress = self.runners.get(runner_id)
+        if progress is None:
+            return None
+
+        leader = self.runners[self.keys[0][2]]
+        passed = len(progress.checkpoints)
+        seconds_behind = None
+        if progress.times:
+            common = min(passed, len(leader.times))
+            seconds_behind = (
+                progress.times[common - 1] - leader.times[common - 1]
+            ).total_seconds()
+        return Standing(
+            rank=self.rank(runner_id),
+            runner_id=runner_id,
+            passed=passed,
+            last_time=progress.times[-1] if progress.times else None,
+            checkpoints_behind=len(leader.checkpoints) - passed,
+            seconds_behind=seconds_behind,
+        )
+
+    def top(self, limit: int | None = None) -> list[Standing]:
+        return [self.standing(key[2]) for key in self.keys[:limit]]
+
+
+class Standings:
+    """Live standings of the races that are currently being followed.
+
+    Races are rebuilt from the database at startup and whenever their
+    runners change. Passings are applied as they are accepted.
+    """
+
+    def __init__(self, window: timedelta = timedelta(hours=24)) -> None:
+        self.window = window
+        self.engine: AsyncEngine | None = None
+        self.races: dict[int, RaceStandings] = {}
+
+    def get(self, race_id: int) -> RaceStandings | None:
+        return self.races.get(race_id)
+
+    def load(
+        self,
+        race_id: int,
+        runners: Iterable[int],
+        passings: Iterable[tuple[int, int, datetime]],
+    ) -> RaceStandings:
+        race = RaceStandings(race_id)
+        for runner_id in runners:
+            race.add_runner(runner_id)
+        for runner_id, checkpoint_id, passing_time in passings:
+            race.record(runner_id, checkpoint_id, passing_time)
+        self.races[race_id] = race
+        return race
+
+    def record(
+        self, race_id: int, runner_id: int, checkpoint_id: int, passing_time: datetime
+    ) -> RaceStandings | None:
+        race = self.races.get(race_id)
+        if race is not None:
+            race.record(runner_id, checkpoint_id, passing_time)
+        return race
+
+    async def apply_passings(
+        self, passings: Iterable[tuple[int, int, int, datetime]]
+    ) -> None:
+        """Count accepted passings, rebuilding each race not followed yet once.
+
+        A rebuilt race is loaded with its passings from the database, these
+        included, so they are not counted again.
+        """
+        unknown: set[int] = set()
+        for race_id, runner_id, checkpoint_id, passing_time in passings:
+            if race_id in unknown:
+                continue
+            if self.record(race_id, runner_id, checkpoint_id, passing_time) is None:
+                unknown.add(race_id)
+        for race_id in unknown:
+            await self.refresh(race_id)
+
+    async def rebuild(
+        self, conn: AsyncConnection, race_id: int
+    ) -> RaceStandings | None:
+        """Load a race, or stop following it if it is gone or archived."""
+        result = await conn.execute(
+            sa.text("SELECT ArchivedAt FROM Race WHERE RaceID = :race_id"),
+            {"race_id": race_id},
+        )
+        race = result.first()
+        if race is None or race.archivedat is not None:
+            self.races.pop(race_id, None)
+            return None
+
+        result = await conn.execute(
+            sa.text(
+                """
+                SELECT rir.RunnerID, cp.CheckpointID, cp.PassingTime
+                FROM RunnerInRace rir
+                LEFT JOIN CheckpointPassing cp
+                  ON cp.RaceID = :race_id AND cp.RunnerID = rir.RunnerID
+                WHERE rir.RaceID = :race_id
+                """
+            ),
+            {"race_id": race_id},
+        )
+        rows = result.tuples().all()
+        return self.load(
+            race_id,
+            (runner_id for runner_id, _, _ in rows),
+            (row for row in rows if row[1] is not None),
+        )
+
+    async def is_active(self, conn: AsyncConnection, race_id: int) -> bool:
+        """Whether a race starts later than `window` ago, so it may still be run.
+
+        Decided from the database, so every worker gives the same answer
+        whichever races it happens to follow.
+        """
+        result = await conn.execute(
+            sa.text(
+                "SELECT 1 FROM Race WHERE RaceID = :race_id AND startTime > :earliest"
+            ),
+            {"race_id": race_id, "earliest": datetime.now() - self.window},
+        )
+        return result.scalar() is not None
+
+    async def rebuild_active(self, conn: AsyncConnection) -> None:
+        result = await conn.execute(
+            sa.text(
+                "SELECT RaceID FROM Race WHERE startTime BETWEEN :earliest AND :latest"
+                " AND ArchivedAt IS NULL"
+            ),
+            {
+                "earliest": datetime.now() - self.window,
+                "latest": datetime.now() + self.window,
+            },
+        )
+        for race_id in result.scalars().all():
+            await self.rebuild(conn, race_id)
+
+    async def refresh(self, race_id: int | None = None) -> RaceStandings | None:
+        """Rebuild one race, or every followed and active race when None."""
+        if self.engine is None:
+            return None
+        try:
+            async with db.get_connection(self.engine) as conn:
+                if race_id is not None:
+                    return await self.rebuild(conn, race_id)
+                followed = list(self.races)
+                self.races.clear()
+                for followed_race_id in followed:
+                    await self.rebuild(conn, followed_race_id)
+                await self.rebuild_active(conn)
+        except Exception:
+            logging.exception("Could not rebuild standings")
+            if race_id is None:
+                self.races.clear()
+            else:
+                self.races.pop(race_id, None)
+        return None
+
+
+live_standings = Standings()
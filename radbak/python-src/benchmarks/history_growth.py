@@ -0,0 +1,210 @@
+"""Ingest and leaderboard latency as the passing history grows.
+
+Fills the database with finished races in steps, and after each step times
+POST /checkpoint_passing and GET /race/{race_id}/leaderboard against a fresh
+live race. With the indexes from migration 3 both should stay flat however
+much history there is; run with --without-indexes to see the difference.
+
+It only adds data, never removes it, so point it at a scratch database:
+
+    POSTGRES_HOST=localhost POSTGRES_DB=bench poetry run python -m benchmarks.history_growth
+"""
+
+import argparse
+import asyncio
+import re
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import sqlalchemy as sa
+
+from api import db, migrations
+from api.main import app
+from api.migrations import v003_hot_path_indexes, v004_race_partitions
+
+# The secondary indexes as the migrations leave them, by name
+INDEXES = {
+    re.search(r"INDEX (?:IF NOT EXISTS )?(\w+) ON", statement).group(1): statement
+    for statement in v003_hot_path_indexes.STATEMENTS + v004_race_partitions.STATEMENTS
+    if re.search(r"CREATE (UNIQUE )?INDEX", statement)
+}
+
+RUNNERS_PER_RACE = 1000
+CHECKPOINTS = 10
+FIRST_DEVICE = 9001
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def create_checkpoints(conn) -> list[int]:
+    result = await conn.execute(
+        sa.text(
+            """
+            INSERT INTO Checkpoint (DeviceID, Location)
+            SELECT :first + g, 'Benchmark ' || g FROM generate_series(0, :n - 1) g
+            RETURNING CheckpointID
+            """
+        ),
+        {"first": FIRST_DEVICE, "n": CHECKPOINTS},
+    )
+    return list(result.scalars())
+
+
+async def create_race(
+    conn, name: str, start: datetime, checkpoints: list[int], with_passings: bool
+) -> int:
+    result = await conn.execute(
+        sa.text(
+            "INSERT INTO Race (Name, startTime) VALUES (:name, :start) RETURNING RaceID"
+        ),
+        {"name": name, "start": start},
+    )
+    race_id = result.scalar()
+    await conn.execute(
+        sa.text(
+            """
+            INSERT INTO CheckpointInRace (CheckpointID, RaceID, Position)
+            SELECT id, :race_id, position
+            FROM unnest(CAST(:ids AS INT[])) WITH ORDINALITY AS c(id, position)
+            """
+        ),
+        {"race_id": race_id, "ids": checkpoints},
+    )
+    # The same tags are handed out again at every race, as at the club
+    await conn.execute(
+        sa.text(
+            """
+            WITH runners AS (
+                INSERT INTO Runner (name)
+                SELECT CAST(:prefix AS TEXT) || g FROM generate_series(1, :runners) g
+                RETURNING RunnerID, name
+            ), entered AS (
+                INSERT INTO RunnerInRace (RunnerID, RaceID, TagID)
+                SELECT RunnerID, :race_id, 'bench-tag-' || substr(name, length(CAST(:prefix AS TEXT)) + 1)
+                FROM runners
+                RETURNING RunnerID
+            )
+            INSERT INTO CheckpointPassing (RaceID, RunnerID, CheckpointID, PassingTime)
+            SELECT CAST(:race_id AS INT), e.RunnerID, cir.CheckpointID,
+                   CAST(:start AS TIMESTAMP) + cir.Position * INTERVAL '10 minute' + random() * INTERVAL '5 minute'
+            FROM entered e
+            JOIN CheckpointInRace cir ON cir.RaceID = :race_id
+            WHERE CAST(:with_passings AS BOOLEAN)
+            """
+        ),
+        {
+            "prefix": f"bench-{race_id}-",
+            "runners": RUNNERS_PER_RACE,
+            "race_id": race_id,
+            "start": start,
+            "with_passings": with_passings,
+        },
+    )
+    return race_id
+
+
+async def measure(
+    client: httpx.AsyncClient, race_id: int, reads: int, queries: int
+) -> tuple[list[float], list[float]]:
+    ingest = []
+    for number in range(1, reads + 1):
+        started = time.perf_counter()
+        response = await client.post(
+            "/checkpoint_passing",
+            json={
+                "TagID": f"bench-tag-{number}",
+                "DeviceID": FIRST_DEVICE,
+                "PassingTime": datetime.now().isoformat(),
+            },
+        )
+        ingest.append(time.perf_counter() - started)
+        response.raise_for_status()
+
+    leaderboard = []
+    for _ in range(queries):
+        started = time.perf_counter()
+        response = await client.get(f"/race/{race_id}/leaderboard")
+        leaderboard.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return ingest, leaderboard
+
+
+async def main(args: argparse.Namespace) -> None:
+    engine = db.get_engine()
+    app.state.sqlalchemy_engine = engine
+    async with db.get_connection(engine) as conn:
+        await migrations.upgrade(conn)
+        if args.without_indexes:
+            for name in INDEXES:
+                await conn.execute(sa.text(f"DROP INDEX IF EXISTS {name}"))
+        checkpoints = await create_checkpoints(conn)
+        result = await conn.execute(sa.text("SELECT COUNT(*) FROM CheckpointPassing"))
+        history = result.scalar()
+
+    print(
+        f"{'passings':>12} {'ingest p50':>11} {'p99':>9} {'leaderboard p50':>16} {'p99':>9}"
+    )
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for step, target in enumerate(args.steps):
+            start = datetime.now() - timedelta(days=365)
+            while history < target:
+                async with db.get_connection(engine) as conn:
+                    await create_race(
+                        conn, "Benchmark history", start, checkpoints, True
+                    )
+                history += RUNNERS_PER_RACE * CHECKPOINTS
+                start += timedelta(hours=1)
+
+            async with db.get_connection(engine) as conn:
+                await conn.execute(sa.text("ANALYZE"))
+                live_race = await create_race(
+                    conn,
+                    "Benchmark live",
+                    datetime.now() + timedelta(minutes=step),
+                    checkpoints,
+                    False,
+                )
+
+            ingest, leaderboard = await measure(
+                client, live_race, args.reads, args.queries
+            )
+            print(
+                f"{history:>12} "
+                f"{percentile(ingest, 0.5) * 1000:>9.2f}ms {percentile(ingest, 0.99) * 1000:>7.2f}ms "
+                f"{percentile(leaderboard, 0.5) * 1000:>14.2f}ms {percentile(leaderboard, 0.99) * 1000:>7.2f}ms"
+            )
+
+    if args.without_indexes:
+        async with db.get_connection(engine) as conn:
+            for statement in INDEXES.values():
+                await conn.execute(sa.text(statement))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--steps",
+        type=lambda value: [int(step) for step in value.split(",")],
+        default=[0, 100_000, 1_000_000, 5_000_000],
+        help="History sizes, in passings, to measure at (default 0,100000,1000000,5000000)",
+    )
+    parser.add_argument(
+        "--reads", type=int, default=500, help="Passings posted per step"
+    )
+    parser.add_argument(
+        "--queries", type=int, default=50, help="Leaderboard requests per step"
+    )
+    parser.add_argument(
+        "--without-indexes",
+        action="store_true",
+        help="Drop the secondary indexes while measuring, and restore them afterwards",
+    )
+    asyncio.run(main(parser.parse_args()))
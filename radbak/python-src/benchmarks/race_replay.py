@@ -0,0 +1,427 @@
+"""Replay a simulated race against a running API and measure it end to end.
+
+Creates a race of --runners runners over --checkpoints checkpoints directly in
+the database, then sends every read at the time it would happen, compressed
+by --speed, while --spectators websocket clients follow the race:
+
+    POSTGRES_HOST=localhost poetry run python -m benchmarks.race_replay --runners 500
+
+Reads go to POST /checkpoint_passing, POST /checkpoint_passings/batch (one
+request per checkpoint per tick) or, with --via mqtt, to the broker in the
+"DeviceID:RFID:ms" format the checkpoints use, for fwdservice or the API's
+own MQTT ingest to pick up. Reports ingest throughput, read-to-broadcast
+latency as seen by the spectators, and database round trips per passing.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import httpx
+import sqlalchemy as sa
+import websockets
+
+from api import archive, db
+
+FIRST_DEVICE = 7001
+
+
+class Read(NamedTuple):
+    offset: float  # Seconds after the start of the replay
+    runner: int  # Index into the race's runners
+    position: int  # Checkpoint position, from 1
+
+
+class Race(NamedTuple):
+    race_id: int
+    start: datetime
+    tags: list[str]
+    runner_ids: list[int]
+    devices: list[int]  # By position - 1
+    checkpoint_ids: list[int]  # By position - 1
+
+
+def schedule(
+    runners: int, checkpoints: int, scenario: str, leg_seconds: float
+) -> list[Read]:
+    """Arrival of every runner at every checkpoint, in race seconds.
+
+    "mass-start" sends the whole field over the first checkpoint within two
+    seconds, "bunched-finish" brings everyone to the last checkpoint within
+    ten, and "steady" spreads the start out like a time-trial.
+    """
+    reads = []
+    for runner in range(runners):
+        pace = min(max(random.gauss(1, 0.15), 0.6), 1.6)
+        if scenario == "steady":
+            start = runner * 0.5
+        else:
+            start = random.uniform(0, 2)
+        finish = (checkpoints - 1) * leg_seconds + random.uniform(0, 10)
+        for position in range(1, checkpoints + 1):
+            offset = start + (position - 1) * leg_seconds * pace
+            if scenario == "bunched-finish":
+                # Everyone arrives together, slower runners closing the gap
+                # no faster than ten seconds per checkpoint
+                offset = min(offset, finish - (checkpoints - position) * 10)
+                if position == checkpoints:
+                    offset = finish
+            reads.append(Read(offset, runner, position))
+    return sorted(reads)
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def create_race(engine, runners: int, checkpoints: int) -> Race:
+    async with db.get_connection(engine) as conn:
+        start = datetime.now()
+        result = await conn.execute(
+            sa.text(
+                "INSERT INTO Race (Name, startTime)"
+                " VALUES ('Race replay', :start) RETURNING RaceID"
+            ),
+            {"start": start},
+        )
+        race_id = result.scalar()
+
+        devices = [FIRST_DEVICE + position for position in range(checkpoints)]
+        result = await conn.execute(
+            sa.text(
+                """
+                INSERT INTO Checkpoint (DeviceID, Location)
+                SELECT device, 'Replay ' || device
+                FROM unnest(CAST(:devices AS BIGINT[])) AS device
+                RETURNING CheckpointID
+                """
+            ),
+            {"devices": devices},
+        )
+        checkpoint_ids = list(result.scalars())
+        await conn.execute(
+            sa.text(
+                """
+                INSERT INTO CheckpointInRace (CheckpointID, RaceID, Position)
+                SELECT id, :race_id, position
+                FROM unnest(CAST(:ids AS INT[])) WITH ORDINALITY AS c(id, position)
+                """
+            ),
+            {"race_id": race_id, "ids": checkpoint_ids},
+        )
+
+        tags = [f"replay-{race_id}-{number}" for number in range(runners)]
+        result = await conn.execute(
+            sa.text(
+                """
+                WITH runners AS (
+                    INSERT INTO Runner (name)
+                    SELECT tag FROM unnest(CAST(:tags AS TEXT[])) AS tag
+                    RETURNING RunnerID, name
+                )
+                INSERT INTO RunnerInRace (RunnerID, RaceID, TagID)
+                SELECT RunnerID, :race_id, name FROM runners
+                RETURNING RunnerID, TagID
+                """
+            ),
+            {"race_id": race_id, "tags": tags},
+        )
+        runner_by_tag = {row.tagid: row.runnerid for row in result}
+        # Every API worker loads the new race into its cache and standings
+        await conn.execute(
+            sa.text("SELECT pg_notify('cache', :race)"), {"race": str(race_id)}
+        )
+
+    return Race(
+        race_id,
+        start,
+        tags,
+        [runner_by_tag[tag] for tag in tags],
+        devices,
+        checkpoint_ids,
+    )
+
+
+async def delete_race(engine, race: Race) -> None:
+    async with db.get_connection(engine) as conn:
+        await archive.drop_race(conn, race.race_id)
+        await conn.execute(
+            sa.text("DELETE FROM Race WHERE RaceID = :race_id"),
+            {"race_id": race.race_id},
+        )
+        await conn.execute(
+            sa.text("DELETE FROM Runner WHERE RunnerID = ANY(:ids)"),
+            {"ids": race.runner_ids},
+        )
+        await conn.execute(
+            sa.text("DELETE FROM Checkpoint WHERE CheckpointID = ANY(:ids)"),
+            {"ids": race.checkpoint_ids},
+        )
+        await conn.execute(sa.text("SELECT pg_notify('cache', '*')"))
+
+
+async def round_trips(engine) -> tuple[int, str]:
+    """Statements run so far, or transactions when pg_stat_statements is missing."""
+    async with db.get_connection(engine) as conn:
+        try:
+            async with conn.begin_nested():
+                result = await conn.execute(
+                    sa.text(
+                        "SELECT sum(calls) FROM pg_stat_statements"
+                        " WHERE dbid = (SELECT oid FROM pg_database"
+                        " WHERE datname = current_database())"
+                    )
+                )
+                return int(result.scalar() or 0), "statements"
+        except sa.exc.DBAPIError:
+            await conn.execute(sa.text("SELECT pg_stat_clear_snapshot()"))
+            result = await conn.execute(
+                sa.text(
+                    "SELECT xact_commit + xact_rollback FROM pg_stat_database"
+                    " WHERE datname = current_database()"
+                )
+            )
+            return int(result.scalar()), "transactions"
+
+
+class Spectators:
+    """Websocket clients following the race, noting when each passing arrives."""
+
+    def __init__(self, url: str, count: int) -> None:
+        self.url = url
+        self.count = count
+        self.connected = asyncio.Event()
+        self.ready = 0
+        # (runner_id, checkpoint_id) -> arrival time at every spectator
+        self.arrivals: dict[tuple[int, int], list[float]] = defaultdict(list)
+        self.resets = 0
+
+    async def follow(self) -> None:
+        async with websockets.connect(self.url, max_size=None) as websocket:
+            self.ready += 1
+            if self.ready == self.count:
+                self.connected.set()
+            async for raw in websocket:
+                received = time.time()
+                message = json.loads(raw)
+                if message.get("type") == "reset":
+                    self.resets += 1
+                for passing in message.get("passings", []):
+                    key = (passing["runner_id"], passing["checkpoint_id"])
+                    self.arrivals[key].append(received)
+
+
+class Sender:
+    def __init__(self, args: argparse.Namespace, race: Race) -> None:
+        self.args = args
+        self.race = race
+        self.sent: dict[tuple[int, int], float] = {}
+        self.failed = 0
+        self.limit = asyncio.Semaphore(args.concurrency)
+        self.mqtt = None
+
+    def key(self, read: Read) -> tuple[int, int]:
+        return (
+            self.race.runner_ids[read.runner],
+            self.race.checkpoint_ids[read.position - 1],
+        )
+
+    def body(self, read: Read) -> dict:
+        # Passings are stamped in race time, so the duplicate window sees
+        # the gaps of the real race rather than of the compressed replay
+        passing_time = self.race.start + timedelta(seconds=read.offset)
+        return {
+            "TagID": self.race.tags[read.runner],
+            "DeviceID": self.race.devices[read.position - 1],
+            "PassingTime": passing_time.isoformat(),
+        }
+
+    async def post(self, http: httpx.AsyncClient, reads: list[Read]) -> None:
+        async with self.limit:
+            for read in reads:
+                self.sent[self.key(read)] = time.time()
+            try:
+                if self.args.via == "batch":
+                    response = await http.post(
+                        "/checkpoint_passings/batch",
+                        json=[self.body(read) for read in reads],
+                    )
+                else:
+                    response = await http.post(
+                        "/checkpoint_passing", json=self.body(reads[0])
+                    )
+                if response.status_code != 200:
+                    self.failed += len(reads)
+            except httpx.HTTPError:
+                self.failed += len(reads)
+
+    def publish(self, read: Read) -> None:
+        self.sent[self.key(read)] = time.time()
+        payload = (
+            f"{self.race.devices[read.position - 1]}:{self.race.tags[read.runner]}:0"
+        )
+        self.mqtt.publish(self.args.mqtt_topic, payload, qos=1)
+
+    def connect_mqtt(self) -> None:
+        import paho.mqtt.client as mqtt
+        import paho.mqtt.enums as mqtt_enums
+
+        self.mqtt = mqtt.Client(
+            callback_api_version=mqtt_enums.CallbackAPIVersion.VERSION2
+        )
+        if self.args.mqtt_username:
+            self.mqtt.username_pw_set(self.args.mqtt_username, self.args.mqtt_password)
+        if self.args.mqtt_ca_certs:
+            self.mqtt.tls_set(ca_certs=self.args.mqtt_ca_certs)
+        self.mqtt.connect(self.args.mqtt_host, self.args.mqtt_port)
+        self.mqtt.loop_start()
+
+    async def replay(self, reads: list[Read]) -> float:
+        """Send the reads on schedule, returning how long it took."""
+        if self.args.via == "mqtt":
+            self.connect_mqtt()
+        # Reads due within the same tick leave together
+        ticks: dict[int, list[Read]] = defaultdict(list)
+        for read in reads:
+            ticks[int(read.offset / self.args.speed / self.args.tick)].append(read)
+
+        limits = httpx.Limits(max_connections=self.args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=self.args.base_url, limits=limits, timeout=30
+        ) as http:
+            tasks = []
+            started = time.perf_counter()
+            for tick in sorted(ticks):
+                delay = started + tick * self.args.tick - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                due = ticks[tick]
+                if self.args.via == "mqtt":
+                    for read in due:
+                        self.publish(read)
+                elif self.args.via == "batch":
+                    by_checkpoint = defaultdict(list)
+                    for read in due:
+                        by_checkpoint[read.position].append(read)
+                    for batch in by_checkpoint.values():
+                        tasks.append(asyncio.create_task(self.post(http, batch)))
+                else:
+                    for read in due:
+                        tasks.append(asyncio.create_task(self.post(http, [read])))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+
+        if self.mqtt is not None:
+            self.mqtt.loop_stop()
+            self.mqtt.disconnect()
+        return elapsed
+
+
+async def main(args: argparse.Namespace) -> None:
+    engine = db.get_engine()
+    race = await create_race(engine, args.runners, args.checkpoints)
+    reads = schedule(args.runners, args.checkpoints, args.scenario, args.leg_seconds)
+    print(
+        f"Race {race.race_id}: {len(reads)} reads, {args.scenario}, via {args.via},"
+        f" {args.spectators} spectators"
+    )
+
+    ws_url = args.base_url.replace("http", "ws", 1) + f"/ws?race_id={race.race_id}"
+    spectators = Spectators(ws_url, args.spectators)
+    followers = [
+        asyncio.create_task(spectators.follow()) for _ in range(args.spectators)
+    ]
+    if args.spectators:
+        await asyncio.wait_for(spectators.connected.wait(), timeout=30)
+    # Give the workers time to load the race before the first read
+    await asyncio.sleep(1)
+
+    trips_before, trips_unit = await round_trips(engine)
+    sender = Sender(args, race)
+    elapsed = await sender.replay(reads)
+    await asyncio.sleep(args.drain)
+    trips_after, _ = await round_trips(engine)
+
+    for follower in followers:
+        follower.cancel()
+    await asyncio.gather(*followers, return_exceptions=True)
+
+    async with db.get_connection(engine) as conn:
+        result = await conn.execute(
+            sa.text("SELECT COUNT(*) FROM CheckpointPassing WHERE RaceID = :race_id"),
+            {"race_id": race.race_id},
+        )
+        stored = result.scalar()
+    if not args.keep:
+        await delete_race(engine, race)
+    await engine.dispose()
+
+    latencies = [
+        arrival - sender.sent[key]
+        for key, arrivals in spectators.arrivals.items()
+        if key in sender.sent
+        for arrival in arrivals
+    ]
+    expected = stored * args.spectators
+    print(f"Sent {len(reads)} reads in {elapsed:.2f}s ({len(reads) / elapsed:.0f}/s)")
+    print(f"Stored {stored} passings, {sender.failed} reads failed")
+    if args.spectators:
+        print(
+            f"Broadcast {len(latencies)} of {expected} expected deliveries,"
+            f" {spectators.resets} resets"
+        )
+        print(
+            f"Read to broadcast p50 {percentile(latencies, 0.5) * 1000:.1f}ms,"
+            f" p99 {percentile(latencies, 0.99) * 1000:.1f}ms"
+        )
+    # The replay's own setup and the spectators' queries are included
+    if stored:
+        print(
+            f"{(trips_after - trips_before) / stored:.2f} database {trips_unit}"
+            " per stored passing"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://localhost:80")
+    parser.add_argument("--runners", type=int, default=200)
+    parser.add_argument("--checkpoints", type=int, default=5)
+    parser.add_argument(
+        "--scenario",
+        choices=["mass-start", "bunched-finish", "steady"],
+        default="mass-start",
+    )
+    parser.add_argument(
+        "--leg-seconds", type=float, default=60, help="Race time between checkpoints"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=10, help="How much faster than real time"
+    )
+    parser.add_argument(
+        "--tick", type=float, default=0.01, help="Seconds between sends"
+    )
+    parser.add_argument("--via", choices=["http", "batch", "mqtt"], default="http")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--spectators", type=int, default=10)
+    parser.add_argument(
+        "--drain", type=float, default=2, help="Seconds to wait for late broadcasts"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the race instead of deleting it"
+    )
+    parser.add_argument("--mqtt-host", default="localhost")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--mqtt-topic", default="postcheckpoint")
+    parser.add_argument("--mqtt-username")
+    parser.add_argument("--mqtt-password")
+    parser.add_argument("--mqtt-ca-certs")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,208 @@
+"""Measure how live updates scale with the number of API worker processes.
+
+For each count in --workers, starts the API with that many uvicorn workers
+and connects --connections-per-worker websocket spectators per worker, from
+--client-processes processes so the clients are not the bottleneck. It then
+sends --rounds rounds of passings, one per runner, through the batch
+endpoint every --interval seconds. Every passing goes to every spectator,
+so the work grows with the connections; near-linear scaling shows as the
+same latency and share of deliveries at every worker count:
+
+    POSTGRES_HOST=localhost poetry run python -m benchmarks.ws_scaling --workers 1 2 4
+
+Passings are stamped with the time they are sent, and spectators measure
+their latency against it, so run everything on one machine. The operating
+system spreads connections over the workers, not always evenly.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+import websockets
+
+from api import db
+from benchmarks.race_replay import create_race, delete_race, percentile
+
+
+async def follow(url: str, latencies: list[float], connected: list[int], stop):
+    async with websockets.connect(url, max_size=None) as websocket:
+        connected.append(1)
+        while not stop.is_set():
+            try:
+                raw = await asyncio.wait_for(websocket.recv(), timeout=0.5)
+            except TimeoutError:
+                continue
+            received = datetime.now()
+            for passing in json.loads(raw).get("passings", []):
+                sent = datetime.fromisoformat(passing["passing_time"])
+                latencies.append((received - sent).total_seconds())
+
+
+def spectate(url: str, count: int, ready, stop, results) -> None:
+    """Follow the race on `count` websockets until stopped, in its own process."""
+
+    async def run():
+        latencies: list[float] = []
+        connected: list[int] = []
+        tasks = [
+            asyncio.create_task(follow(url, latencies, connected, stop))
+            for _ in range(count)
+        ]
+        while len(connected) < count:
+            await asyncio.sleep(0.1)
+        ready.put(count)
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        results.put(latencies)
+
+    asyncio.run(run())
+
+
+async def start_api(args: argparse.Namespace, workers: int) -> subprocess.Popen:
+    env = {**os.environ, "MQTT_INGEST": "false"}
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "api.main:app",
+            "--port",
+            str(args.port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+    async with httpx.AsyncClient(base_url=args.base_url) as http:
+        for _ in range(300):
+            try:
+                if (await http.get("/races")).status_code == 200:
+                    return server
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The API did not start")
+
+
+async def send_rounds(args: argparse.Namespace, race) -> float:
+    """Send every round on schedule, returning how long it took."""
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=30) as http:
+        started = time.perf_counter()
+        for position in range(args.rounds):
+            delay = started + position * args.interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent = datetime.now().isoformat()
+            response = await http.post(
+                "/checkpoint_passings/batch",
+                json=[
+                    {
+                        "TagID": tag,
+                        "DeviceID": race.devices[position],
+                        "PassingTime": sent,
+                    }
+                    for tag in race.tags
+                ],
+            )
+            response.raise_for_status()
+        return time.perf_counter() - started
+
+
+async def measure(args: argparse.Namespace, engine, workers: int) -> dict:
+    server = await start_api(args, workers)
+    race = await create_race(engine, args.runners, args.rounds)
+    try:
+        # Give every worker time to load the race
+        await asyncio.sleep(1)
+        connections = workers * args.connections_per_worker
+        url = args.base_url.replace("http", "ws", 1) + f"/ws?race_id={race.race_id}"
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        counts = [
+            connections // args.client_processes
+            + (index < connections % args.client_processes)
+            for index in range(args.client_processes)
+        ]
+        clients = [
+            multiprocessing.Process(
+                target=spectate, args=(url, count, ready, stop, results)
+            )
+            for count in counts
+            if count
+        ]
+        for client in clients:
+            client.start()
+        loop = asyncio.get_running_loop()
+        for _ in clients:
+            await loop.run_in_executor(None, ready.get)
+
+        elapsed = await send_rounds(args, race)
+        await asyncio.sleep(args.drain)
+        stop.set()
+        latencies = []
+        for _ in clients:
+            latencies.extend(await loop.run_in_executor(None, results.get))
+        for client in clients:
+            client.join()
+    finally:
+        server.terminate()
+        server.wait()
+        await delete_race(engine, race)
+
+    expected = args.runners * args.rounds * connections
+    return {
+        "workers": workers,
+        "connections": connections,
+        "delivered": len(latencies),
+        "expected": expected,
+        "rate": len(latencies) / (elapsed + args.drain),
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    engine = db.get_engine()
+    rows = []
+    for workers in args.workers:
+        row = await measure(args, engine, workers)
+        rows.append(row)
+        print(
+            f"{row['workers']} workers, {row['connections']} connections:"
+            f" delivered {row['delivered']} of {row['expected']},"
+            f" {row['rate']:.0f} messages/s,"
+            f" p50 {row['p50'] * 1000:.1f}ms, p99 {row['p99'] * 1000:.1f}ms"
+        )
+    await engine.dispose()
+
+    # Delivered messages per second and per worker, relative to the first run
+    base = rows[0]["rate"] / rows[0]["workers"]
+    for row in rows[1:]:
+        efficiency = row["rate"] / row["workers"] / base if base else float("nan")
+        print(f"Scaling efficiency at {row['workers']} workers: {efficiency:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--connections-per-worker", type=int, default=500)
+    parser.add_argument("--client-processes", type=int, default=4)
+    parser.add_argument("--runners", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--drain", type=float, default=5)
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+    args.base_url = f"http://localhost:{args.port}"
+    asyncio.run(main(args))
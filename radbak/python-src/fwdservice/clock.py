@@ -0,0 +1,107 @@
+"""Per-checkpoint clock offset and drift, estimated from the message stream.
+
+Binary frames carry the device clock when the frame was sent. Every frame
+gives a sample of offset = receipt time - device clock, which is the true
+offset plus however long the frame took to arrive. The delay is never
+negative and is smallest when nothing is queued anywhere, so the offset is
+estimated from the lowest samples: the lowest in each bucket of device
+time, with a line fitted through them for drift and then lowered until no
+sample is below it.
+
+Passing times are then device clock + offset, so they do not move however
+long frames wait in the broker, and a backlog or larger batches no longer
+shift results. Until a device has sent a frame with little delay the
+estimate is only as good as the best frame so far.
+
+Frames must be observed in the order they arrived, which is the order the
+forwarder reads them back from its spool.
+"""
+
+from typing import NamedTuple
+
+# Width of a bucket of device time, and how many buckets are kept
+BUCKET_MS = 60_000
+BUCKETS = 30
+# Crystal tolerance and then some; a larger fitted drift is noise
+MAX_DRIFT = 500e-6
+# A device clock this far behind the newest seen, or a sample this far below
+# the estimate, means the clock was reset, e.g. by a reboot, and the estimate
+# starts over. A frame resent this late starts it over too, but the next
+# frames in order restore it.
+RESET_MS = 10_000
+
+
+class Estimate(NamedTuple):
+    """Receipt time in ms is device time + offset + drift * (device time - origin)."""
+
+    offset: float
+    drift: float
+    origin: int
+
+
+class DeviceClock:
+    def __init__(self) -> None:
+        # Bucket -> (device ms, offset ms) of the lowest sample in it
+        self.minima: dict[int, tuple[int, float]] = {}
+        self.newest = 0
+        self.estimate: Estimate | None = None
+
+    def at(self, device_ms: int) -> float:
+        offset, drift, origin = self.estimate
+        return offset + drift * (device_ms - origin)
+
+    def observe(self, device_ms: int, received_ms: float) -> Estimate:
+        offset = received_ms - device_ms
+        if self.estimate is not None and (
+            device_ms < self.newest - RESET_MS or offset < self.at(device_ms) - RESET_MS
+        ):
+            self.minima.clear()
+            self.newest = device_ms
+        self.newest = max(self.newest, device_ms)
+
+        bucket = device_ms // BUCKET_MS
+        lowest = self.minima.get(bucket)
+        if lowest is not None and lowest[1] <= offset:
+            return self.estimate
+        self.minima[bucket] = (device_ms, offset)
+        for old in [old for old in self.minima if old <= bucket - BUCKETS]:
+            del self.minima[old]
+        self.estimate = self.fit()
+        return self.estimate
+
+    def fit(self) -> Estimate:
+        points = list(self.minima.values())
+        origin = max(device_ms for device_ms, _ in points)
+        xs = [device_ms - origin for device_ms, _ in points]
+        ys = [offset for _, offset in points]
+        drift = 0.0
+        if len(points) > 1:
+            mean_x = sum(xs) / len(xs)
+            mean_y = sum(ys) / len(ys)
+            spread = sum((x - mean_x) ** 2 for x in xs)
+            if spread:
+                drift = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+                drift = max(-MAX_DRIFT, min(MAX_DRIFT, drift / spread))
+        # The lower envelope: no sample may have arrived before it was sent
+        offset = min(y - drift * x for x, y in zip(xs, ys))
+        return Estimate(offset, drift, origin)
+
+
+class DeviceClocks:
+    """The clocks of all checkpoints, by DeviceID."""
+
+    def __init__(self) -> None:
+        self.devices: dict[int, DeviceClock] = {}
+
+    def observe(self, device_id: int, device_ms: int, received_ms: float) -> Estimate:
+        clock = self.devices.get(device_id)
+        if clock is None:
+            clock = self.devices[device_id] = DeviceClock()
+        return clock.observe(device_ms, received_ms)
+
+    def estimates(self) -> dict[int, Estimate]:
+        return {
+            device_id: clock.estimate
+            for device_id, clock in self.devices.items()
+            if clock.estimate is not None
+        }
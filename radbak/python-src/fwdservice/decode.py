@@ -0,0 +1,134 @@
+"""Decoding checkpoint messages into passings for the API.
+
+This is the one decoder for both ways reads reach the API: the forward
+service, and the API's own MQTT ingest (api/mqtt.py).
+
+Checkpoints send either the original text format, one read per message:
+
+    DeviceID:RFID:MillisecondsSincePassing    e.g. 3:Tag1:1520
+
+or a binary frame carrying a whole drained passing buffer. Frames start with
+the magic bytes b"RB" and a version byte, and each version has a decoder
+registered with @decoder. Version 1, all little-endian:
+
+    header   2s magic, B version, B record count,
+             Q device id (the IMEI), Q device clock in ms when sent
+    record   I RFID, Q device clock in ms at the passing   (repeated)
+
+The records of a frame are decoded in one pass, with NumPy if it is
+installed and struct.iter_unpack otherwise. Given the device clocks from
+clock.py, frame passing times come from the device's estimated clock offset
+rather than from when this frame happened to arrive.
+"""
+
+import struct
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Passing times are sent to the API in local time
+UTC_OFFSET = timedelta(hours=2)
+
+FRAME_MAGIC = b"RB"
+FRAME_HEADER = struct.Struct("<2sBBQQ")
+RECORD = struct.Struct("<IQ")
+
+# Decoders take the payload, its receipt time and the device clocks or None
+Decoder = Callable[[bytes, datetime, Any], list[dict]]
+DECODERS: dict[int, Decoder] = {}
+
+
+def decoder(version: int) -> Callable[[Decoder], Decoder]:
+    """Register a decoder for a frame version."""
+
+    def register(function: Decoder) -> Decoder:
+        DECODERS[version] = function
+        return function
+
+    return register
+
+
+def decode(payload: bytes, received_at: datetime, clocks: Any = None) -> list[dict]:
+    """The passings in a message, raising ValueError if it is malformed."""
+    if payload.startswith(FRAME_MAGIC):
+        version = payload[len(FRAME_MAGIC)] if len(payload) > len(FRAME_MAGIC) else 0
+        frame_decoder = DECODERS.get(version)
+        if frame_decoder is None:
+            raise ValueError(f"Unknown frame version {version}")
+        return frame_decoder(payload, received_at, clocks)
+    return [decode_text(payload.decode(errors="replace"), received_at)]
+
+
+def decode_text(data: str, received_at: datetime) -> dict:
+    try:
+        device_id, rfid, milliseconds = data.split(":")
+        device_id = int(device_id)
+        timestamp = received_at - timedelta(milliseconds=int(milliseconds))
+    except ValueError as e:
+        raise ValueError(f"Expected DeviceID:RFID:Milliseconds, got {data!r}") from e
+
+    return {
+        "TagID": rfid,
+        "DeviceID": str(device_id),
+        "PassingTime": str(timestamp + UTC_OFFSET),
+    }
+
+
+@decoder(1)
+def decode_v1(payload: bytes, received_at: datetime, clocks: Any) -> list[dict]:
+    if len(payload) < FRAME_HEADER.size:
+        raise ValueError("Frame is shorter than its header")
+    _, _, count, device_id, sent_at = FRAME_HEADER.unpack_from(payload)
+    records = memoryview(payload)[FRAME_HEADER.size :]
+    if len(records) != count * RECORD.size:
+        raise ValueError(f"Frame has {len(records)} bytes for {count} records")
+
+    # Receipt time in ms = device time + offset + drift * (device time - origin).
+    # Without clocks the frame is taken to have arrived as soon as it was sent.
+    received_ms = received_at.timestamp() * 1000
+    if clocks is None:
+        offset, drift, origin = received_ms - sent_at, 0.0, sent_at
+    else:
+        offset, drift, origin = clocks.observe(device_id, sent_at, received_ms)
+
+    received = received_at + UTC_OFFSET
+    device_id = str(device_id)
+    if np is not None:
+        array = np.frombuffer(records, dtype=[("rfid", "<u4"), ("time", "<u8")])
+        device_ms = array["time"].astype(np.float64)
+        # How long before the receipt each passing happened
+        ages = received_ms - (device_ms + offset + drift * (device_ms - origin))
+        times = np.datetime64(received, "us") - np.rint(ages * 1000).astype(
+            "timedelta64[us]"
+        )
+        return [
+            {"TagID": f"{rfid:X}", "DeviceID": device_id, "PassingTime": time}
+            for rfid, time in zip(
+                array["rfid"].tolist(), np.datetime_as_string(times).tolist()
+            )
+        ]
+
+    return [
+        {
+            "TagID": f"{rfid:X}",
+            "DeviceID": device_id,
+            "PassingTime": (
+                received
+                - timedelta(
+                    milliseconds=received_ms - (time + offset + drift * (time - origin))
+                )
+            ).isoformat(timespec="microseconds"),
+        }
+        for rfid, time in RECORD.iter_unpack(records)
+    ]
+
+
+def encode_v1(device_id: int, sent_at: int, records: list[tuple[int, int]]) -> bytes:
+    """A version 1 frame, as the firmware would send it."""
+    return FRAME_HEADER.pack(
+        FRAME_MAGIC, 1, len(records), device_id, sent_at
+    ) + b"".join(RECORD.pack(rfid, time) for rfid, time in records)
@@ -1,16 +1,22 @@
 # MQTT Client subscribing to the MQTT broker and calling the API endpoint with the data
 
 # Import necessary libraries
-import json
+import asyncio
+import collections
 import random
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 
+import httpx
 import paho.mqtt.client as mqtt
 import paho.mqtt.enums as mqtt_enums
-import requests
+from clock import DeviceClocks
+from decode import decode
+from spool import Record, Spool
 
 # Define the API endpoint
-api_endpoint = "http://localhost:80/checkpoint_passing"  # Real endpoint to send checkpoint passings
+api_base_url = "http://localhost:80"
+api_endpoint = "/checkpoint_passings/batch"  # Real endpoint to send checkpoint passings
 
 
 # MQTT broker details
@@ -31,51 +37,294 @@ client_id = "python-mqtt-fwdservice"  # Fixed ID.
 username = "fwdservice"
 password = "fwdservice"
 
+# Forwarding pipeline
+batch_size = 128  # Reads sent in one request, a full checkpoint buffer or more
+batch_window = 0.05  # Seconds to wait for more reads before sending a batch
+sender_count = 4  # Batches in flight at the same time
+http_timeout = 10  # Seconds
+report_interval = 10  # Seconds between backpressure reports
+spool_directory = "./fwdservice/spool"  # Reads not yet accepted by the API
+spool_sync_interval = 0.05  # Seconds between syncing the spool to disk
+metrics_port = 9108  # Prometheus metrics at http://localhost:9108/metrics
 
-# Define the callback function for when a message is received
-def on_message(client, userdata, message):
+
+def invalid_indices(response: httpx.Response, size: int) -> set[int]:
+    """The passings a validation error points at, by index in the batch."""
     try:
-        # Extract the message payload
-        print("Message recieved!")
-        data = message.payload.decode()
-        print(f"{message.timestamp} | {data}")
-
-        # Assume messages are recieved like this:
-        # CheckpointID:RFID:Timestamp
-        # Example: 3:Tag1:2024-04-15T11:39:02.561Z  # Tag1 belongs to Erik
-
-        # Format the message data
-        split_data = data.split(":")
-
-        device_id = split_data[0]
-        rfid = split_data[1]
-        timestamp = (
-            datetime.now()
-            - timedelta(milliseconds=int(split_data[2]))
-            + timedelta(hours=2)
+        errors = response.json()["detail"]
+        # FastAPI locates each error as ["body", index, field]
+        indices = {error["loc"][1] for error in errors}
+    except (ValueError, KeyError, IndexError, TypeError):
+        return set()
+    if not all(isinstance(index, int) and 0 <= index < size for index in indices):
+        return set()
+    return indices
+
+
+class Forwarder:
+    """Moves reads from the MQTT thread to the API in batches, through a spool.
+
+    paho's callback only appends the read to the spool on disk and wakes the
+    asyncio loop, which reads batches back by size and time window and posts
+    them over a pooled keep-alive connection, so a slow API response never
+    stalls the MQTT network loop. Reads are acknowledged to the broker once
+    the spool is synced, and batches that fail are retried until the API
+    takes them, so an API restart only delays reads.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, spool: Spool) -> None:
+        self.loop = loop
+        self.spool = spool
+        self.clocks = DeviceClocks()
+        self.appended = asyncio.Event()
+        # Batches as the spool offset they start at, the records and the passings
+        self.batches: asyncio.Queue[tuple[int, list[Record], list[dict]]] = (
+            asyncio.Queue(maxsize=sender_count)
+        )
+        # Where the next batch is read from
+        self.read_offset = spool.committed
+        # Batches read but not yet taken by the API, start offset to end offset
+        self.in_flight: dict[int, int] = {}
+        # (spool offset, mid, qos) of reads to acknowledge once synced
+        self.unacked: collections.deque[tuple[int, int, int]] = collections.deque()
+        self.received = 0
+        self.forwarded = 0
+        self.rejected = 0
+        self.failed = 0
+        # Requests the API took, to tell a bad read from a failing API
+        self.requests_taken = 0
+        # Age of the oldest read in the last batch read from the spool
+        self.queue_lag = 0.0
+        # Time from receiving a message to the API accepting its batch
+        self.forward_seconds_sum = 0.0
+        self.forward_seconds_count = 0
+
+    # Called from the paho network thread
+    def submit(self, data: bytes, received_at: datetime, mid: int, qos: int) -> None:
+        try:
+            passings = decode(data, received_at)
+            offset = self.spool.append(received_at.timestamp(), data)
+        except ValueError as e:
+            print(f"Ignoring malformed message {data!r}: {e}")
+            offset = self.spool.end
+        else:
+            self.received += len(passings)
+            if not self.appended.is_set():
+                self.loop.call_soon_threadsafe(self.appended.set)
+        self.unacked.append((offset, mid, qos))
+
+    async def batch(self) -> None:
+        while True:
+            self.appended.clear()
+            records = self.spool.read(self.read_offset, batch_size)
+            if not records:
+                await self.appended.wait()
+                continue
+            if len(records) < batch_size:
+                await asyncio.sleep(batch_window)
+                records = self.spool.read(self.read_offset, batch_size)
+
+            # A binary frame holds many reads, so stop once the batch is full
+            passings = []
+            for count, record in enumerate(records, 1):
+                # Frames are read back in the order they arrived, as the
+                # clock estimates need
+                received_at = datetime.fromtimestamp(record.received_at)
+                passings.extend(decode(record.payload, received_at, self.clocks))
+                if len(passings) >= batch_size:
+                    del records[count:]
+                    break
+            start = records[0].start
+            self.in_flight[start] = self.read_offset = records[-1].end
+            self.queue_lag = time.time() - records[0].received_at
+            await self.batches.put((start, records, passings))
+
+    async def send(self, http: httpx.AsyncClient) -> None:
+        while True:
+            start, records, passings = await self.batches.get()
+            await self.forward(http, passings)
+            accepted = time.time()
+            self.forward_seconds_sum += sum(
+                accepted - record.received_at for record in records
+            )
+            self.forward_seconds_count += len(records)
+            del self.in_flight[start]
+
+    async def forward(self, http: httpx.AsyncClient, passings: list[dict]) -> None:
+        """Send passings until the API has taken or refused each one.
+
+        Passings the API refuses as invalid are dropped and the rest sent
+        again. A batch the API fails on is split in halves, and a lone
+        passing that still fails once others have gone through is dropped,
+        so one bad read never holds up the spool. While the API fails on
+        everything, nothing is dropped and the batch is only delayed.
+        """
+        # Parts of the batch still to send, with how many requests the API
+        # had taken when each, alone, first failed
+        pending: collections.deque[tuple[list[dict], int | None]] = collections.deque(
+            [(passings, None)]
+        )
+        attempt = 0
+        while pending:
+            batch, failing_since = pending.popleft()
+            try:
+                response = await http.post(api_endpoint, json=batch)
+            except httpx.HTTPError as e:
+                print(f"Failed to send data to API: {e!r}")
+                pending.appendleft((batch, failing_since))
+            else:
+                if response.status_code == 200:
+                    added = response.json()["added"]
+                    self.forwarded += added
+                    self.rejected += len(batch) - added
+                    self.requests_taken += 1
+                    attempt = 0
+                    continue
+                if response.status_code < 500:
+                    # Sending the same passings again won't help
+                    invalid = invalid_indices(response, len(batch))
+                    if not invalid:
+                        invalid = set(range(len(batch)))
+                    self.drop([batch[index] for index in sorted(invalid)], response)
+                    rest = [p for index, p in enumerate(batch) if index not in invalid]
+                    if rest:
+                        pending.appendleft((rest, None))
+                    continue
+                if len(batch) > 1:
+                    half = len(batch) // 2
+                    pending.extendleft([(batch[half:], None), (batch[:half], None)])
+                elif failing_since is not None and self.requests_taken > failing_since:
+                    self.drop(batch, response)
+                    continue
+                else:
+                    # Let the rest go first, to tell a bad read from a failing API
+                    if failing_since is None:
+                        failing_since = self.requests_taken
+                    pending.append((batch, failing_since))
+                print(f"Failed to send data to API... {response.text}")
+            await asyncio.sleep(min(2**attempt, 30) + random.random())
+            attempt += 1
+
+    def drop(self, passings: list[dict], response: httpx.Response) -> None:
+        self.failed += len(passings)
+        print(
+            f"Dropping {len(passings)} passings refused by the API: "
+            f"{passings} {response.text}"
         )
 
-        api_payload = {
-            "TagID": rfid,
-            "DeviceID": device_id,
-            "PassingTime": str(timestamp),
+    async def sync(self, client: mqtt.Client) -> None:
+        while True:
+            await asyncio.sleep(spool_sync_interval)
+            synced = await self.loop.run_in_executor(None, self.spool.sync)
+            while self.unacked and self.unacked[0][0] <= synced:
+                _, mid, qos = self.unacked.popleft()
+                client.ack(mid, qos)
+
+            # Everything before the oldest batch still in flight has been taken
+            committed = next(iter(self.in_flight), self.read_offset)
+            if committed != self.spool.committed:
+                await self.loop.run_in_executor(None, self.spool.commit, committed)
+
+    async def report(self) -> None:
+        while True:
+            await asyncio.sleep(report_interval)
+            print(
+                f"Received {self.received}, forwarded {self.forwarded}, "
+                f"rejected {self.rejected}, failed {self.failed}, "
+                f"spooled {self.spool.backlog} bytes, "
+                f"batches waiting {self.batches.qsize()}"
+            )
+            if self.batches.full():
+                print("Backpressure: the API is not keeping up with incoming reads")
+
+    def render_metrics(self) -> str:
+        """The counters in the Prometheus text format."""
+        metrics = {
+            "received_total": ("counter", "Reads received from MQTT", self.received),
+            "forwarded_total": ("counter", "Reads the API added", self.forwarded),
+            "rejected_total": ("counter", "Reads the API rejected", self.rejected),
+            "failed_total": (
+                "counter",
+                "Reads the API refused or kept failing on",
+                self.failed,
+            ),
+            "spool_backlog_bytes": (
+                "gauge",
+                "Spooled reads the API has not accepted yet",
+                self.spool.backlog,
+            ),
+            "batches_waiting": (
+                "gauge",
+                "Batches waiting for a sender",
+                self.batches.qsize(),
+            ),
+            "queue_lag_seconds": (
+                "gauge",
+                "Age of the oldest read in the last batch read from the spool",
+                self.queue_lag,
+            ),
         }
-        print("Sending pyload: ", str(api_payload))
+        lines = []
+        for name, (kind, help, value) in metrics.items():
+            lines.append(f"# HELP fwdservice_{name} {help}")
+            lines.append(f"# TYPE fwdservice_{name} {kind}")
+            lines.append(f"fwdservice_{name} {value}")
+        lines.append(
+            "# HELP fwdservice_forward_seconds Time from receiving a message to the API accepting its reads"
+        )
+        lines.append("# TYPE fwdservice_forward_seconds summary")
+        lines.append(f"fwdservice_forward_seconds_sum {self.forward_seconds_sum}")
+        lines.append(f"fwdservice_forward_seconds_count {self.forward_seconds_count}")
 
-        # Make a POST request to the API with the message data
-        response = requests.post(
-            # api_endpoint, data=json.dumps(api_payload)
-            api_endpoint,
-            data=json.dumps(api_payload),
+        estimates = self.clocks.estimates()
+        lines.append(
+            "# HELP fwdservice_clock_drift_ppm Estimated drift of each checkpoint's clock"
         )
+        lines.append("# TYPE fwdservice_clock_drift_ppm gauge")
+        for device_id, estimate in estimates.items():
+            lines.append(
+                f'fwdservice_clock_drift_ppm{{device="{device_id}"}} '
+                f"{estimate.drift * 1e6}"
+            )
+        return "\n".join(lines) + "\n"
+
+    async def serve_metrics(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # Answers every request with the metrics, which is all Prometheus asks
+        while (await reader.readline()).strip():
+            pass
+        body = self.render_metrics().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n".encode()
+            + b"Connection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+        writer.close()
 
-        if response.status_code == 200:
-            print("Data successfully forwarded to API!")
-        else:
-            print("Failed to send data to API...")
-            print(response.text)
-    except Exception as e:
-        print(f"Failed to send data to API, error processing message: {e}")
+    async def run(self, client: mqtt.Client) -> None:
+        limits = httpx.Limits(
+            max_connections=sender_count, max_keepalive_connections=sender_count
+        )
+        server = await asyncio.start_server(self.serve_metrics, port=metrics_port)
+        async with server, httpx.AsyncClient(
+            base_url=api_base_url, limits=limits, timeout=http_timeout
+        ) as http, asyncio.TaskGroup() as tasks:
+            tasks.create_task(self.batch())
+            tasks.create_task(self.sync(client))
+            tasks.create_task(self.report())
+            for _ in range(sender_count):
+                tasks.create_task(self.send(http))
+
+
+# Define the callback function for when a message is received
+def on_message(client, userdata, message):
+    # Take the time right away, before the read waits anywhere in this process
+    received_at = datetime.now()
+    userdata.submit(message.payload, received_at, message.mid, message.qos)
 
 
 # Callback when the client receives a CONNACK response from the server. I.e. This is called once we have a connection.
@@ -85,7 +334,8 @@ def on_connect(client, userdata, flags, rc, properties):
 
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        client.subscribe(topic, qos=0)
+        # QoS 1, so the broker resends reads that were never acknowledged
+        client.subscribe(topic, qos=1)
 
     else:
         print("Failed to connect, return code %d\n", rc)
@@ -95,39 +345,58 @@ def on_subscribe(client, userdata, mid, reason_code_list, properties):
     print(f"Subscribed to topic {topic} with return properties of {reason_code_list}")
 
 
-def connect_to_mqtt():
+def connect_to_mqtt(forwarder: Forwarder) -> mqtt.Client:
+    # Create a new MQTT client instance
+    client = mqtt.Client(
+        callback_api_version=mqtt_enums.CallbackAPIVersion.VERSION2,
+        client_id=client_id,
+        # Keeps the subscription and its unacknowledged reads at the broker
+        # while the service is down
+        clean_session=False,
+        userdata=forwarder,
+        # Reads are acknowledged by the forwarder once they are spooled to disk
+        manual_ack=True,
+    )
+    client.username_pw_set(username, password)
+    client.tls_set(ca_certs="./fwdservice/emqxsl-ca.crt")  # Set certificate for TLS
+
+    # Assign the on_connect callback function
+    client.on_connect = on_connect
+
+    # Set the on_message function
+    client.on_message = on_message
+
+    # Confirm subscription status
+    client.on_subscribe = on_subscribe
+
+    # Connect to the broker
+    print(f"Connecting to {broker_address}")
+    client.connect(
+        broker_address, broker_port, keepalive=10 * 60 * 60
+    )  # Keep alive for 10 hours
+
+    # Processes network traffic, dispatches callbacks and handles reconnecting
+    # in a background thread.
+    client.loop_start()
+    return client
+
+
+async def main():
+    spool = Spool(spool_directory)
+    if spool.backlog:
+        print(f"Replaying {spool.backlog} bytes of spooled reads")
+    forwarder = Forwarder(asyncio.get_running_loop(), spool)
+    client = connect_to_mqtt(forwarder)
     try:
-        # Create a new MQTT client instance
-        client = mqtt.Client(
-            callback_api_version=mqtt_enums.CallbackAPIVersion.VERSION2,
-            client_id=client_id,
-        )
-        client.username_pw_set(username, password)
-        client.tls_set(ca_certs="./fwdservice/emqxsl-ca.crt")  # Set certificate for TLS
-
-        # Assign the on_connect callback function
-        client.on_connect = on_connect
-
-        # Set the on_message function
-        client.on_message = on_message
-
-        # Confirm subscription status
-        client.on_subscribe = on_subscribe
+        await forwarder.run(client)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        spool.close()
 
-        # Connect to the broker
-        print(f"Connecting to {broker_address}")
-        client.connect(
-            broker_address, broker_port, keepalive=10 * 60 * 60
-        )  # Keep alive for 10 hours
 
-        # Publishing a hello-message to a topic
-        client.publish(topic, "Hello, EMQX!")
-
-        # Blocking call that processes network traffic, dispatches callbacks, and handles reconnecting.
-        client.loop_forever(timeout=3600 * 10)  # 10 hour timeout for now
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
     except Exception as e:
         print(f"Failed to connect or error during mqtt opera: {e}")
-
-
-if __name__ == "__main__":
-    connect_to_mqtt()
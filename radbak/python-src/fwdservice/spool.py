@@ -0,0 +1,175 @@
+"""An append-only spool of MQTT reads on disk.
+
+Every read is appended to a memory-mapped segment file before anything
+else happens to it, and the forwarder reads its batches back from there.
+Appending is a copy into memory; the pages are flushed to disk in batches
+by sync(), and the broker is only acknowledged once a read is on disk.
+
+How far the API has accepted reads is kept in a checkpoint file. After a
+restart everything past the checkpoint is forwarded again, so a read is
+sent at least once; the API drops the duplicates.
+
+Offsets are byte positions in the spool as a whole. Segment n holds the
+offsets from n * segment_size, and segments entirely before the checkpoint
+are deleted.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import NamedTuple
+
+# Payload length, CRC32 of the payload and receipt time in UNIX seconds
+HEADER = struct.Struct("<IId")
+# A length that marks the rest of a segment as unused
+PADDING = 0xFFFFFFFF
+SEGMENT_SIZE = 16 * 1024 * 1024
+CHECKPOINT = "checkpoint"
+
+
+class Record(NamedTuple):
+    start: int
+    end: int
+    received_at: float
+    payload: bytes
+
+
+class Spool:
+    def __init__(self, directory: str | Path, segment_size: int = SEGMENT_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        # Guards the write position and the open segments
+        self.lock = threading.Lock()
+        self.segments: dict[int, mmap.mmap] = {}
+
+        self.committed = self.read_checkpoint()
+        self.end = self.committed
+        for record in self.scan(self.committed):
+            self.end = record.end
+        # Whatever follows the last whole record was never fully written
+        for number in self.segment_numbers():
+            if number > self.end // segment_size:
+                self.path(number).unlink()
+        self.synced = self.end
+
+    def path(self, number: int) -> Path:
+        return self.directory / f"{number:08d}.spool"
+
+    def segment_numbers(self) -> list[int]:
+        return sorted(int(path.stem) for path in self.directory.glob("*.spool"))
+
+    def segment(self, number: int) -> mmap.mmap:
+        with self.lock:
+            mapped = self.segments.get(number)
+            if mapped is None:
+                with open(self.path(number), "a+b") as file:
+                    file.truncate(self.segment_size)
+                    mapped = mmap.mmap(file.fileno(), self.segment_size)
+                self.segments[number] = mapped
+            return mapped
+
+    def read_checkpoint(self) -> int:
+        try:
+            return int((self.directory / CHECKPOINT).read_text())
+        except FileNotFoundError:
+            numbers = self.segment_numbers()
+            return numbers[0] * self.segment_size if numbers else 0
+
+    def scan(self, offset: int, limit: int | None = None, end: int | None = None):
+        """Yield the whole records from offset, stopping at end if given."""
+        count = 0
+        while (end is None or offset < end) and (limit is None or count < limit):
+            number, position = divmod(offset, self.segment_size)
+            if position + HEADER.size > self.segment_size:
+                offset = (number + 1) * self.segment_size
+                continue
+            if end is None and not self.path(number).exists():
+                return
+            mapped = self.segment(number)
+            length, crc, received_at = HEADER.unpack_from(mapped, position)
+            if length == PADDING:
+                offset = (number + 1) * self.segment_size
+                continue
+            start = position + HEADER.size
+            if length == 0 or start + length > self.segment_size:
+                return
+            payload = mapped[start : start + length]
+            # A torn write at a crash leaves a record that does not match its CRC
+            if zlib.crc32(payload) != crc:
+                return
+            yield Record(offset, offset + HEADER.size + length, received_at, payload)
+            offset += HEADER.size + length
+            count += 1
+
+    # Called from the MQTT network thread
+    def append(self, received_at: float, payload: bytes) -> int:
+        """Write a read to the spool and return the offset just past it."""
+        size = HEADER.size + len(payload)
+        if not payload or size > self.segment_size:
+            raise ValueError(f"Cannot spool a read of {len(payload)} bytes")
+
+        number, position = divmod(self.end, self.segment_size)
+        if position + size > self.segment_size:
+            if position + HEADER.size <= self.segment_size:
+                HEADER.pack_into(self.segment(number), position, PADDING, 0, 0)
+            # The new segment is only synced from here on, so finish this one
+            self.segment(number).flush()
+            number, position = number + 1, 0
+        mapped = self.segment(number)
+        mapped[position + HEADER.size : position + size] = payload
+        HEADER.pack_into(
+            mapped, position, len(payload), zlib.crc32(payload), received_at
+        )
+        with self.lock:
+            self.end = number * self.segment_size + size + position
+        return self.end
+
+    def read(self, offset: int, limit: int) -> list[Record]:
+        """Up to limit records from offset that have been appended so far."""
+        return list(self.scan(offset, limit, self.end))
+
+    def sync(self) -> int:
+        """Flush appended records to disk and return the offset now durable."""
+        end = self.end
+        for number in range(
+            self.synced // self.segment_size, end // self.segment_size + 1
+        ):
+            self.segment(number).flush()
+        self.synced = end
+        return end
+
+    def commit(self, offset: int) -> None:
+        """Record that everything before offset has been forwarded."""
+        checkpoint = self.directory / CHECKPOINT
+        temporary = checkpoint.with_suffix(".tmp")
+        with open(temporary, "w") as file:
+            file.write(str(offset))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, checkpoint)
+        self.committed = offset
+
+        for number in self.segment_numbers():
+            if number >= offset // self.segment_size:
+                break
+            with self.lock:
+                mapped = self.segments.pop(number, None)
+            if mapped is not None:
+                mapped.close()
+            self.path(number).unlink()
+
+    @property
+    def backlog(self) -> int:
+        """Bytes appended but not yet committed."""
+        return self.end - self.committed
+
+    def close(self) -> None:
+        with self.lock:
+            for mapped in self.segments.values():
+                mapped.flush()
+                mapped.close()
+            self.segments.clear()
@@ -31,7 +31,6 @@ CMD = [
     "0.0.0.0",
     "--port",
     "80",
-    "--reload",
 ]
 
 
@@ -40,18 +39,38 @@ def _start_fwdservice():
     return subprocess.Popen(["python", "fwdservice/fwdservice.py"])
 
 
-def dev():
+def _serve(cmd: list[str]):
+    # The API subscribes to MQTT itself when MQTT_INGEST is set
+    if os.environ.get("MQTT_INGEST", "").lower() in ("1", "true"):
+        _run(cmd)
+        return
+
     # Start the forward service
     fwdservice_process = _start_fwdservice()
     try:
         # Start the Uvicorn server
-        _run(CMD)
+        _run(cmd)
     finally:
         # Ensure fwdservice.py is terminated when the Uvicorn server stops
         fwdservice_process.terminate()
         fwdservice_process.wait()
 
 
+def dev():
+    _serve(CMD + ["--reload"])
+
+
+def serve():
+    from api.settings import get_settings
+
+    # Workers share the port and each serves its own websockets. Passings
+    # reach all of them, and the workers of other nodes, through Postgres.
+    # Metrics are kept per process, so /metrics only describes every request
+    # when there is a single worker.
+    workers = get_settings().API_WORKERS or 1
+    _serve(CMD + ["--workers", str(workers)])
+
+
 def test():
     cmd = ["pytest"]
 
@@ -61,6 +80,23 @@ def test():
     return _run(cmd, env=env)
 
 
+def migrate():
+    import asyncio
+
+    from api import db, migrations
+
+    async def upgrade():
+        engine = db.get_engine()
+        try:
+            async with db.get_connection(engine) as conn:
+                return await migrations.upgrade(conn)
+        finally:
+            await engine.dispose()
+
+    applied = asyncio.run(upgrade())
+    logging.info("Applied migrations: %s", applied or "none, already up to date")
+
+
 def lint():
     _run(["ruff", "check", "."])
     _run(["black", ".", "--check"])
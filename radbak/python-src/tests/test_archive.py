@@ -0,0 +1,74 @@
+import asyncio
+import gzip
+
+from api import archive
+
+
+class FakeRawConnection:
+    def __init__(self) -> None:
+        self.copied = b""
+
+    async def copy_from_table(self, table, *, output, **kwargs):
+        for row in [b"raceid,runnerid,checkpointid,passingtime\n", b"7,1,2,x\n"]:
+            await output(row)
+
+    async def copy_to_table(self, table, *, source, **kwargs):
+        async for chunk in source:
+            self.copied += chunk
+        return "COPY 1"
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.raw = FakeRawConnection()
+        self.statements: list[str] = []
+
+    async def get_raw_connection(self):
+        return self
+
+    @property
+    def driver_connection(self):
+        return self.raw
+
+    async def execute(self, statement, params=None):
+        self.statements.append(str(statement))
+
+
+async def test_export_is_gzip_csv():
+    conn = FakeConnection()
+
+    exported = b"".join([chunk async for chunk in archive.export_race(conn, 7)])
+
+    assert gzip.decompress(exported).splitlines()[1] == b"7,1,2,x"
+
+
+async def test_import_reads_an_export_back():
+    conn = FakeConnection()
+    export = gzip.compress(b"raceid,runnerid,checkpointid,passingtime\n7,1,2,x\n")
+
+    async def upload():
+        # Split across chunks the way a request body arrives
+        yield export[:10]
+        yield export[10:]
+
+    assert await archive.import_race(conn, 7, upload()) == 1
+    assert conn.raw.copied.endswith(b"7,1,2,x\n")
+    assert "CHECK (RaceID = 7)" in conn.statements[1]
+
+
+async def test_export_stops_when_the_reader_does():
+    conn = FakeConnection()
+
+    async def copy_from_table(table, *, output, **kwargs):
+        # More rows than the queue holds
+        while True:
+            await output(b"7,1,2,x\n" * 1000)
+
+    conn.raw.copy_from_table = copy_from_table
+    export = archive.export_race(conn, 7)
+    await anext(export)
+    await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(export.aclose(), timeout=1)
+    # The COPY is over before the connection goes back to the pool
+    assert asyncio.all_tasks() == {asyncio.current_task()}
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+from api.cache import ResolutionCache
+
+START = datetime(2024, 4, 25, 12, 0)
+
+
+def make_cache() -> ResolutionCache:
+    cache = ResolutionCache()
+    # Device 10 is used both at the start and at the finish of a loop course
+    cache.load(
+        1,
+        START,
+        runners=[("tag1", 1), ("tag2", 2)],
+        checkpoints=[(10, 100, 1), (20, 200, 2), (10, 300, 3)],
+        passings=[(2, 100, START + timedelta(minutes=1))],
+    )
+    return cache
+
+
+def test_lookup_miss():
+    assert make_cache().lookup("unknown") is None
+
+
+def test_next_checkpoint_follows_positions():
+    cache = make_cache()
+    runner_id, route = cache.lookup("tag2")
+
+    assert route.next_checkpoint(runner_id, 10) == 300
+    assert route.next_checkpoint(runner_id, 20) == 200
+    assert route.next_position(runner_id) == 2
+
+
+def test_record_advances_runner():
+    cache = make_cache()
+    runner_id, route = cache.lookup("tag1")
+    cache.record(1, runner_id, 100, START)
+
+    assert route.next_checkpoint(runner_id, 10) == 300
+
+
+def test_reused_tag_resolves_to_latest_race():
+    cache = make_cache()
+    cache.load(2, START + timedelta(days=7), [("tag1", 5)], [], [])
+
+    assert cache.lookup("tag1")[0] == 5
+
+    assert cache.lookup("tag2")[0] == 2
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from fwdservice import clock, decode
+
+RECEIVED = datetime(2024, 4, 25, 12, 0, 10)
+# Receipt time in ms of device time 0
+OFFSET = RECEIVED.timestamp() * 1000 - 60_000
+
+
+def test_backlog_does_not_shift_passing_times():
+    clocks = clock.DeviceClocks()
+    on_time = decode.encode_v1(3, 60_000, [(0xA1, 58_500)])
+    # The next frame waited half a minute in the broker
+    late = decode.encode_v1(3, 61_000, [(0xB2, 59_500)])
+
+    first = decode.decode(on_time, RECEIVED, clocks)
+    second = decode.decode(late, RECEIVED + timedelta(seconds=31), clocks)
+
+    assert first[0]["PassingTime"] == "2024-04-25T14:00:08.500000"
+    assert second[0]["PassingTime"] == "2024-04-25T14:00:09.500000"
+
+
+def test_drift_is_estimated_from_the_fastest_frames():
+    device = clock.DeviceClock()
+    drift = -100e-6
+    for minute in range(20):
+        device_ms = minute * 60_000
+        for delay in (900, 150, 4000):
+            estimate = device.observe(
+                device_ms + delay,
+                OFFSET + drift * device_ms + device_ms + delay + delay,
+            )
+
+    assert estimate.drift == pytest.approx(drift, abs=1e-6)
+    assert device.at(20 * 60_000) == pytest.approx(
+        OFFSET + drift * 20 * 60_000 + 150, abs=2
+    )
+
+
+def test_a_reboot_starts_over():
+    device = clock.DeviceClock()
+    device.observe(3_600_000, OFFSET + 3_600_000)
+
+    # Rebooted a minute and a half later
+    estimate = device.observe(5_000, OFFSET + 3_700_000)
+
+    assert estimate == clock.Estimate(OFFSET + 3_695_000, 0.0, 5_000)
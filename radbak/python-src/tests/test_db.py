@@ -0,0 +1,77 @@
+import asyncpg
+import pytest
+
+from api import db
+
+STATEMENT = db.Statement("runner_name", "SELECT name FROM Runner WHERE RunnerID = $1")
+
+
+class FakePrepared:
+    def __init__(self, driver):
+        self.driver = driver
+
+    async def fetchval(self, *args):
+        if self.driver.invalidate:
+            self.driver.invalidate = False
+            raise asyncpg.exceptions.InvalidCachedStatementError("cached plan")
+        return f"runner {args[0]}"
+
+
+class FakeDriver:
+    def __init__(self):
+        self.prepared = 0
+        self.invalidate = False
+        self.transaction = False
+
+    async def prepare(self, sql):
+        self.prepared += 1
+        return FakePrepared(self)
+
+    def is_in_transaction(self):
+        return self.transaction
+
+
+class FakePooled:
+    def __init__(self):
+        self.info = {}
+        self.driver_connection = FakeDriver()
+
+
+class FakeConnection:
+    def __init__(self):
+        self.pooled = FakePooled()
+
+    async def get_raw_connection(self):
+        return self.pooled
+
+
+async def test_statements_are_prepared_once_per_connection():
+    conn = FakeConnection()
+
+    assert await db.fetchval(conn, STATEMENT, 1) == "runner 1"
+    assert await db.fetchval(conn, STATEMENT, 2) == "runner 2"
+    assert conn.pooled.driver_connection.prepared == 1
+
+    other = FakeConnection()
+    await db.fetchval(other, STATEMENT, 1)
+    assert other.pooled.driver_connection.prepared == 1
+
+
+async def test_invalidated_statements_are_prepared_again():
+    conn = FakeConnection()
+    await db.fetchval(conn, STATEMENT, 1)
+    conn.pooled.driver_connection.invalidate = True
+
+    assert await db.fetchval(conn, STATEMENT, 2) == "runner 2"
+    assert conn.pooled.driver_connection.prepared == 2
+
+
+async def test_invalidated_statements_in_a_transaction_raise():
+    conn = FakeConnection()
+    await db.fetchval(conn, STATEMENT, 1)
+    driver = conn.pooled.driver_connection
+    driver.invalidate = driver.transaction = True
+
+    with pytest.raises(asyncpg.exceptions.InvalidCachedStatementError):
+        await db.fetchval(conn, STATEMENT, 2)
+    assert STATEMENT.name not in conn.pooled.info["prepared"]
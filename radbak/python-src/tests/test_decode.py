@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+
+from fwdservice import decode
+
+RECEIVED = datetime(2024, 4, 25, 12, 0, 10)
+
+
+def test_decode_text():
+    assert decode.decode(b"3:Tag1:1500", RECEIVED) == [
+        {"TagID": "Tag1", "DeviceID": "3", "PassingTime": "2024-04-25 14:00:08.500000"}
+    ]
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_decode_frame(monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(decode, "np", None)
+    elif decode.np is None:
+        pytest.skip("NumPy is not installed")
+    frame = decode.encode_v1(
+        350457790000000, 60_000, [(0xA1B2C3D4, 58_500), (0x0BEEF, 59_990)]
+    )
+
+    assert decode.decode(frame, RECEIVED) == [
+        {
+            "TagID": "A1B2C3D4",
+            "DeviceID": "350457790000000",
+            "PassingTime": "2024-04-25T14:00:08.500000",
+        },
+        {
+            "TagID": "BEEF",
+            "DeviceID": "350457790000000",
+            "PassingTime": "2024-04-25T14:00:09.990000",
+        },
+    ]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [b"3:Tag1", b"x3:Tag1:10", b"RB\x09", decode.encode_v1(3, 0, [(1, 0)])[:-1]],
+    ids=["text", "device", "version", "truncated"],
+)
+def test_malformed_messages(payload):
+    with pytest.raises(ValueError):
+        decode.decode(payload, RECEIVED)
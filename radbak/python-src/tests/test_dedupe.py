@@ -0,0 +1,139 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from api import dedupe, ingest
+from api.events import Read
+
+START = datetime(2024, 4, 25, 12, 0)
+
+
+def at(seconds: float) -> datetime:
+    return START + timedelta(seconds=seconds)
+
+
+def test_first_read_of_a_burst_wins():
+    window = dedupe.ReadWindow()
+
+    assert not window.is_duplicate("tag1", 3, at(0))
+    window.remember("tag1", 3, at(0))
+    # The runner stands on the mat, read every two seconds
+    assert all(window.is_duplicate("tag1", 3, at(s)) for s in (2, 4, 6, 8))
+    assert not window.is_duplicate("tag1", 4, at(9))
+    assert not window.is_duplicate("tag1", 3, at(20))
+
+
+def test_bursts_expire_and_are_bounded(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(dedupe.time, "monotonic", lambda: now)
+    window = dedupe.ReadWindow(retention=timedelta(seconds=60), max_entries=2)
+    window.remember("tag1", 3, at(0))
+    window.remember("tag2", 3, at(0))
+    window.remember("tag3", 3, at(0))
+
+    assert list(window.bursts) == [("tag2", 3), ("tag3", 3)]
+
+    now += 61
+    assert not window.is_duplicate("tag2", 3, at(1))
+    assert window.bursts == {}
+
+
+async def test_repeats_in_a_batch_are_dropped_before_sql(monkeypatch):
+    monkeypatch.setattr(ingest, "read_window", dedupe.ReadWindow())
+    ingest.read_window.remember("tag1", 3, at(0))
+
+    outcomes = await ingest.record_passings(
+        None, [Read("tag1", 3, at(3)), Read("tag1", 3, at(1))]
+    )
+
+    assert outcomes == [ingest.Outcome.DUPLICATE, ingest.Outcome.DUPLICATE]
+
+
+def test_reads_are_only_remembered_once_added():
+    window = dedupe.ReadWindow()
+
+    assert not window.is_duplicate("tag1", 3, at(0))
+    assert not window.is_duplicate("tag1", 3, at(0))
+    assert window.bursts == {}
+
+
+async def test_a_failed_read_is_recorded_when_retried(monkeypatch):
+    monkeypatch.setattr(ingest, "read_window", dedupe.ReadWindow())
+    calls = []
+
+    async def fetchval(conn, statement, *args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise ConnectionError("The connection was lost")
+        return "added"
+
+    monkeypatch.setattr(ingest.db, "fetchval", fetchval)
+
+    with pytest.raises(ConnectionError):
+        await ingest.record_passing(None, "unknown", 3, at(0))
+    # The forwarder sends the same read again
+    assert await ingest.record_passing(None, "unknown", 3, at(0)) == "added"
+    assert len(calls) == 2
+
+
+async def test_passings_and_their_event_commit_together(monkeypatch):
+    monkeypatch.setattr(ingest, "read_window", dedupe.ReadWindow())
+    statements = []
+    in_transaction = False
+
+    @asynccontextmanager
+    async def transaction(conn):
+        nonlocal in_transaction
+        in_transaction = True
+        yield
+        in_transaction = False
+
+    async def fetch(conn, statement, *args):
+        statements.append((statement.name, in_transaction))
+        return {
+            "resolve_tags": [{"tagid": "tag1", "runnerid": 7, "raceid": 1}],
+            "race_routes": [(1, 3, 10)],
+            "passed_checkpoints": [],
+            "insert_passings": [{"runnerid": 7, "checkpointid": 10}],
+            "notify_added": [],
+        }[statement.name]
+
+    monkeypatch.setattr(ingest.db, "transaction", transaction)
+    monkeypatch.setattr(ingest.db, "fetch", fetch)
+
+    outcomes = await ingest.record_passings(None, [Read("tag1", 3, at(0))])
+
+    assert outcomes == [ingest.Outcome.ADDED]
+    assert statements[-2:] == [("insert_passings", True), ("notify_added", True)]
+
+
+async def test_an_in_flight_repeat_is_not_taken_for_the_next_checkpoint(
+    monkeypatch,
+):
+    monkeypatch.setattr(ingest, "read_window", dedupe.ReadWindow())
+    route = SimpleNamespace(
+        race_id=1, passed={}, next_checkpoint=lambda runner_id, device_id: 10
+    )
+    monkeypatch.setattr(ingest.resolution_cache, "lookup", lambda tag_id: (7, route))
+    calls = []
+
+    async def fetchrow(conn, statement, *args):
+        # The first read of the burst is committed, so the insert skips it
+        calls.append((statement.name, args[-1]))
+        return None
+
+    async def fetchval(conn, statement, *args):
+        calls.append((statement.name, args[-1]))
+        return "duplicate"
+
+    monkeypatch.setattr(ingest.db, "fetchrow", fetchrow)
+    monkeypatch.setattr(ingest.db, "fetchval", fetchval)
+
+    outcome = await ingest.record_passing(None, "tag1", 3, at(2))
+
+    assert outcome == ingest.Outcome.DUPLICATE
+    window = ingest.read_window.window
+    assert calls == [("insert_passing", window), ("record_passing", window)]
+    assert route.passed == {}
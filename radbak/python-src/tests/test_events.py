@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+from api import events
+
+START = datetime(2024, 4, 25, 12, 0)
+
+
+def test_passing_payload_round_trip():
+    passings = [
+        events.Passing(1, runner_id, 100, START + timedelta(seconds=runner_id))
+        for runner_id in range(500)
+    ]
+    payload = events.encode_passings(passings)
+
+    # A whole batch is one event, however large
+    assert len(payload) > events.MAX_PAYLOAD_BYTES
+    assert events.decode_passings(payload) == passings
+
+
+def test_read_payload_round_trip():
+    reads = [events.Read("tag:1", 3, START), events.Read("tag2", 4, START)]
+
+    assert events.decode_reads(events.encode_reads(reads)[0]) == reads
+
+
+def test_outbox_relays_in_seq_order_from_when_it_started():
+    outbox = events.Outbox()
+    payload = events.encode_passings([events.Passing(1, 2, 3, START)])
+
+    # Events before the worker started are already in its caches
+    assert outbox.receive(10, [(9, payload), (10, payload)]) == []
+    assert outbox.started == 10
+
+    received = outbox.receive(12, [(10, payload), (11, payload), (12, payload)])
+
+    assert [event.seq for event in received] == [11, 12]
+    assert received[0].passings == [events.Passing(1, 2, 3, START)]
+
+    # The outbox was reset, so relaying starts over
+    assert outbox.receive(1, [(1, payload)]) == []
+    assert (outbox.last, outbox.started) == (1, 1)
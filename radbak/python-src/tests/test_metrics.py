@@ -0,0 +1,45 @@
+from fastapi.testclient import TestClient
+
+from api import metrics
+from api.main import app
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("latency_seconds", "Latency", ("route",), (0.1, 1))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.55',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_statement_name():
+    assert metrics.statement_name("SELECT * FROM Runner") == "SELECT runner"
+    assert (
+        metrics.statement_name("SELECT record_checkpoint_passing(:a, :b, :c)")
+        == "SELECT record_checkpoint_passing"
+    )
+    assert (
+        metrics.statement_name(
+            "WITH added AS (INSERT INTO CheckpointPassing VALUES (1) RETURNING 1)"
+            " SELECT pg_notify('passing', '') FROM added"
+        )
+        == "INSERT checkpointpassing"
+    )
+
+
+def test_requests_are_counted_by_route_template():
+    client = TestClient(app)
+    before = metrics.REQUEST_SECONDS.count("GET", "/metrics", "200")
+
+    response = client.get("/metrics")
+
+    assert response.headers["content-type"] == metrics.CONTENT_TYPE
+    assert "# TYPE ingest_reads_total counter" in response.text
+    assert metrics.REQUEST_SECONDS.count("GET", "/metrics", "200") == before + 1
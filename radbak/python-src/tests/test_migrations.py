@@ -0,0 +1,44 @@
+from api import migrations
+
+
+class FakeResult:
+    def __init__(self, value=None) -> None:
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+class FakeConnection:
+    def __init__(self, version: int) -> None:
+        self.version = version
+        self.statements: list[str] = []
+
+    async def execute(self, statement, params=None):
+        sql = str(statement)
+        self.statements.append(sql)
+        if "MAX(Version)" in sql:
+            return FakeResult(self.version)
+        if sql.startswith("INSERT INTO schema_version"):
+            self.version = params["v"]
+        return FakeResult()
+
+
+def test_versions_are_consecutive():
+    versions = [migration.version for migration in migrations.MIGRATIONS]
+
+    assert versions == list(range(1, len(versions) + 1))
+
+
+async def test_upgrade_applies_only_pending():
+    conn = FakeConnection(version=2)
+
+    applied = await migrations.upgrade(conn)
+
+    assert applied == list(range(3, len(migrations.MIGRATIONS) + 1))
+    assert conn.version == len(migrations.MIGRATIONS)
+    assert not any("CREATE TABLE IF NOT EXISTS Runner" in s for s in conn.statements)
+    # Functions are re-created even when nothing is pending
+    conn.statements.clear()
+    assert await migrations.upgrade(conn) == []
+    assert migrations.REPEATABLE[0] in conn.statements
@@ -0,0 +1,136 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import asyncpg
+
+from api import ingest, mqtt
+from fwdservice.decode import encode_v1
+
+RECEIVED = datetime(2024, 4, 25, 12, 0, 10)
+
+
+def test_parse_reads():
+    reads = mqtt.parse_reads(b"3:Tag1:1500", RECEIVED)
+
+    assert reads == [ingest.Read("Tag1", 3, datetime(2024, 4, 25, 14, 0, 8, 500000))]
+
+
+def test_parse_reads_from_a_frame():
+    sent_at = 1_000_000
+    frame = encode_v1(7, sent_at, [(0x1A, sent_at - 1500), (0x2B, sent_at - 250)])
+
+    reads = mqtt.parse_reads(frame, RECEIVED)
+
+    assert reads == [
+        ingest.Read("1A", 7, datetime(2024, 4, 25, 14, 0, 8, 500000)),
+        ingest.Read("2B", 7, datetime(2024, 4, 25, 14, 0, 9, 750000)),
+    ]
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.acked = []
+
+    def ack(self, mid, qos):
+        self.acked.append(mid)
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+
+async def test_reads_are_recorded_in_batches(monkeypatch):
+    batches = []
+
+    @asynccontextmanager
+    async def get_connection(engine):
+        yield None
+
+    async def record_passings(conn, reads):
+        batches.append(list(reads))
+
+    monkeypatch.setattr(mqtt.db, "get_connection", get_connection)
+    monkeypatch.setattr(mqtt.ingest, "record_passings", record_passings)
+
+    client = FakeClient()
+    source = mqtt.MqttIngest()
+    source.loop = asyncio.get_running_loop()
+    source.client = client
+    source.submit(b"3:Tag1:0", RECEIVED, 1, 1)
+    source.submit(b"not a read", RECEIVED, 2, 1)
+    source.submit(encode_v1(3, 0, [(0x2B, 0), (0x3C, 0)]), RECEIVED, 3, 1)
+    await asyncio.sleep(0)
+    source.task = asyncio.create_task(source.drain())
+    await asyncio.sleep(0.01)
+    await source.stop()
+
+    assert [[read.tag_id for read in reads] for reads in batches] == [
+        ["Tag1", "2B", "3C"]
+    ]
+    assert client.acked == [1, 2, 3]
+
+
+async def test_reads_are_acked_once_committed(monkeypatch):
+    client = FakeClient()
+    attempts = []
+
+    @asynccontextmanager
+    async def get_connection(engine):
+        yield None
+
+    async def record_passings(conn, reads):
+        attempts.append(list(client.acked))
+        if len(attempts) == 1:
+            raise ConnectionError("database is down")
+
+    sleep = asyncio.sleep
+    monkeypatch.setattr(mqtt.db, "get_connection", get_connection)
+    monkeypatch.setattr(mqtt.ingest, "record_passings", record_passings)
+    # No backoff between attempts
+    monkeypatch.setattr(mqtt.asyncio, "sleep", lambda seconds: sleep(0))
+
+    source = mqtt.MqttIngest()
+    source.loop = asyncio.get_running_loop()
+    source.client = client
+    source.submit(b"3:Tag1:0", RECEIVED, 1, 1)
+    source.task = asyncio.create_task(source.drain())
+    for _ in range(10):
+        await sleep(0)
+    await source.stop()
+
+    assert attempts == [[], []]
+    assert client.acked == [1]
+
+
+async def test_a_read_the_database_cannot_take_is_skipped(monkeypatch):
+    client = FakeClient()
+    recorded = []
+
+    @asynccontextmanager
+    async def get_connection(engine):
+        yield None
+
+    async def record_passings(conn, reads):
+        if any(read.device_id >= 2**63 for read in reads):
+            raise asyncpg.NumericValueOutOfRangeError("bigint out of range")
+        recorded.extend(read.tag_id for read in reads)
+
+    monkeypatch.setattr(mqtt.db, "get_connection", get_connection)
+    monkeypatch.setattr(mqtt.ingest, "record_passings", record_passings)
+
+    source = mqtt.MqttIngest()
+    source.loop = asyncio.get_running_loop()
+    source.client = client
+    source.submit(b"3:Tag1:0", RECEIVED, 1, 1)
+    source.submit(f"{2**63}:Tag2:0".encode(), RECEIVED, 2, 1)
+    source.submit(b"3:Tag3:0", RECEIVED, 3, 1)
+    await asyncio.sleep(0)
+    source.task = asyncio.create_task(source.drain())
+    await asyncio.sleep(0.01)
+    await source.stop()
+
+    assert recorded == ["Tag1", "Tag3"]
+    assert client.acked == [1, 2, 3]
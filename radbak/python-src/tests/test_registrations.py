@@ -0,0 +1,51 @@
+import pytest
+
+from api.registrations import Registration, RowError, parse_csv, parse_ndjson
+
+
+async def chunked(data: bytes, size: int = 7):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+async def parse(parser, data: bytes):
+    errors = []
+    rows = [row async for row in parser(chunked(data), errors)]
+    return rows, errors
+
+
+async def test_csv_rows_are_read_across_chunks():
+    data = (
+        "\ufeffTag,Name\r\n"
+        'T1,"Nordmann, Ola"\r\n'
+        "T2,\r\n"
+        "\r\n"
+        'T3,"Unclosed\r\n'
+        "T4,Bjørnar"
+    ).encode()
+
+    rows, errors = await parse(parse_csv, data)
+
+    assert rows == [
+        Registration(2, "Nordmann, Ola", "T1"),
+        Registration(6, "Bjørnar", "T4"),
+    ]
+    assert [error.line for error in errors] == [3, 5]
+
+
+async def test_csv_without_name_and_tag_columns_is_rejected():
+    with pytest.raises(ValueError):
+        await parse(parse_csv, b"runner,chip\nOla,T1\n")
+
+
+async def test_ndjson_rows_are_validated():
+    data = b'{"name": "Ola", "tag": "T1"}\n[1]\n{"name": "Kari"\n{"name": "Kari", "tag": 7}\n'
+
+    rows, errors = await parse(parse_ndjson, data)
+
+    assert rows == [Registration(1, "Ola", "T1")]
+    assert errors == [
+        RowError(2, "The line is not a JSON object"),
+        RowError(3, "The line is not valid JSON"),
+        RowError(4, "Both a name and a tag are required"),
+    ]
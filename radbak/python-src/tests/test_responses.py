@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from api.responses import ResponseCache, cached, dumps, response_cache
+
+app = FastAPI()
+renders = []
+
+
+@app.get("/race/{race_id}/runners")
+async def runners(race_id: int, request: Request):
+    async def render():
+        renders.append(race_id)
+        return {"race_id": race_id, "start": datetime(2024, 4, 25, 12, 0)}
+
+    return await cached(request, race_id, render)
+
+
+def test_dumps_encodes_records_and_times():
+    assert dumps([{"a": datetime(2024, 4, 25, 12, 0), 1: None}]) == (
+        b'[{"a":"2024-04-25T12:00:00","1":null}]'
+    )
+    assert dumps('{"prebuilt": true}') == b'{"prebuilt": true}'
+
+
+def test_responses_are_encoded_once_and_revalidated():
+    renders.clear()
+    response_cache.clear()
+    client = TestClient(app)
+
+    first = client.get("/race/1/runners")
+    again = client.get(
+        "/race/1/runners", headers={"If-None-Match": first.headers["etag"]}
+    )
+
+    assert first.json() == {"race_id": 1, "start": "2024-04-25T12:00:00"}
+    assert again.status_code == 304
+    assert again.headers["etag"] == first.headers["etag"]
+    assert renders == [1]
+
+    response_cache.invalidate(2)
+    client.get("/race/1/runners")
+    response_cache.invalidate(1)
+    client.get("/race/1/runners")
+
+    assert renders == [1, 1]
+
+
+async def test_responses_encoded_across_an_invalidation_are_not_kept():
+    cache = ResponseCache()
+
+    async def render():
+        cache.invalidate(1)
+        return [1]
+
+    await cache.get(1, "/race/1", render)
+
+    assert cache.entries == {}
@@ -0,0 +1,48 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from api import results
+
+START = datetime(2024, 4, 25, 12, 0)
+ROWS = [
+    (1, 3, "Ola", "T1", 1, 600.0, 1, 5, "Top", START.replace(minute=10), 600.0, 600.0),
+    (2, 4, "Kari", "T2", 0, None, None, None, None, None, None, None),
+]
+
+
+async def chunks():
+    for row in ROWS:
+        yield [row]
+
+
+async def export(encode) -> bytes:
+    return b"".join([chunk async for chunk in encode(chunks())])
+
+
+async def test_csv_has_a_header_and_iso_times():
+    rows = list(csv.reader(io.StringIO((await export(results.to_csv)).decode())))
+
+    assert rows[0] == results.COLUMNS
+    assert rows[1][9] == "2024-04-25T12:10:00"
+    assert rows[2][:5] == ["2", "4", "Kari", "T2", "0"]
+    assert rows[2][5:] == [""] * 7
+
+
+async def test_ndjson_has_one_object_per_row():
+    lines = (await export(results.to_ndjson)).splitlines()
+
+    assert [json.loads(line)["name"] for line in lines] == ["Ola", "Kari"]
+    assert json.loads(lines[0])["passing_time"] == "2024-04-25T12:10:00"
+
+
+async def test_parquet_is_written_a_row_group_per_chunk():
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    table = pq.ParquetFile(io.BytesIO(await export(results.to_parquet)))
+
+    assert table.metadata.num_row_groups == 2
+    assert table.read().column("name").to_pylist() == ["Ola", "Kari"]
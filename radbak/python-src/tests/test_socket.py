@@ -0,0 +1,119 @@
+import asyncio
+
+from fastapi.websockets import WebSocketState
+
+from api.socket import service
+
+
+class FakeWebSocket:
+    client_state = WebSocketState.CONNECTED
+    application_state = WebSocketState.CONNECTED
+
+    def __init__(self, delay: float = 0) -> None:
+        self.delay = delay
+        self.sent: list[str] = []
+        self.closed = False
+
+    async def send_text(self, message: str) -> None:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append(message)
+
+    async def close(self, code: int = 1000) -> None:
+        self.closed = True
+        self.application_state = WebSocketState.DISCONNECTED
+
+
+def test_delta_log_resume():
+    log = service.DeltaLog(maxlen=3)
+    log.reset(2)
+    # A batch is numbered after its last event
+    for seq in (3, 5, 8, 9, 12):
+        log.append(service.Delta(seq, 1, f"message {seq}", []))
+
+    assert log.seq == 12
+    assert [delta.message for delta in log.since(6)] == [
+        "message 8",
+        "message 9",
+        "message 12",
+    ]
+    assert log.since(5) == log.since(7)
+    assert log.since(12) == []
+    assert log.since(4) is None
+
+    log.reset(0)
+    assert log.seq == 0
+    assert log.since(12) is None
+
+
+async def test_publish_only_reaches_subscribers():
+    manager = service.SocketManager()
+    everything, race_one, race_two = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    manager.connect(everything)
+    manager.subscribe(manager.connect(race_one), service.race_topic(1))
+    manager.subscribe(manager.connect(race_two), service.race_topic(2))
+
+    await manager.publish([service.ALL, service.race_topic(1)], "race 1")
+    await asyncio.sleep(0.01)
+
+    assert everything.sent == ["race 1"]
+    assert race_one.sent == ["race 1"]
+    assert race_two.sent == []
+
+
+async def test_disconnect_removes_subscriptions():
+    manager = service.SocketManager()
+    client_id = manager.connect(FakeWebSocket())
+    manager.subscribe(client_id, service.runner_topic(1, 5))
+
+    manager.diconnect(client_id)
+
+    assert manager.subscribers == {}
+    assert manager.subscriptions == {}
+
+
+async def test_slow_client_does_not_block_others():
+    manager = service.SocketManager(queue_size=4)
+    slow, fast = FakeWebSocket(delay=60), FakeWebSocket()
+    slow_id = manager.connect(slow)
+    manager.connect(fast)
+
+    for index in range(10):
+        await manager.broadcast(f"delta {index}")
+        await asyncio.sleep(0)
+
+    assert fast.sent == [f"delta {index}" for index in range(10)]
+    # The slow client's backlog collapsed into a reset instead of growing
+    queued = [message for message, _ in manager.connections[slow_id].queue]
+    assert service.RESET in queued
+    assert len(queued) < 4
+    manager.diconnect(slow_id)
+
+
+async def test_client_that_stops_reading_is_disconnected():
+    manager = service.SocketManager(send_timeout=0.01)
+    stuck = FakeWebSocket(delay=60)
+    manager.connect(stuck)
+
+    await manager.broadcast("delta")
+    await asyncio.sleep(0.05)
+
+    assert stuck.closed
+
+
+async def test_live_deltas_wait_for_the_catch_up():
+    manager = service.SocketManager()
+    websocket = FakeWebSocket()
+    client_id = manager.connect(websocket)
+    manager.hold(client_id)
+
+    # Relayed while the catch-up was read from the outbox, which may already
+    # have included delta 7
+    await manager.publish([service.ALL], "delta 7", seq=7)
+    await manager.publish([service.ALL], "delta 8", seq=8)
+    await manager.broadcast("message")
+    await manager.send_to(client_id, "hello", critical=True)
+    manager.release(client_id, 7, ["delta 6", "delta 7"])
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ["hello", "delta 6", "delta 7", "delta 8", "message"]
@@ -0,0 +1,54 @@
+from fwdservice.spool import HEADER, Spool
+
+SEGMENT_SIZE = 4096
+
+
+def test_reads_survive_a_restart(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE)
+    first = spool.append(1.5, b"3:Tag1:1500")
+    spool.append(2.5, b"3:Tag2:200")
+    spool.sync()
+    spool.commit(first)
+    spool.close()
+
+    spool = Spool(tmp_path, SEGMENT_SIZE)
+    records = spool.read(spool.committed, 10)
+
+    assert [(record.received_at, record.payload) for record in records] == [
+        (2.5, b"3:Tag2:200")
+    ]
+    assert spool.backlog == records[0].end - first
+
+
+def test_a_torn_record_ends_the_spool(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE)
+    spool.append(1.0, b"3:Tag1:1500")
+    end = spool.append(2.0, b"3:Tag2:200")
+    # Only part of the payload reached the disk
+    spool.segment(0)[end - 3 : end] = b"\0\0\0"
+    spool.close()
+
+    spool = Spool(tmp_path, SEGMENT_SIZE)
+
+    assert [record.payload for record in spool.read(0, 10)] == [b"3:Tag1:1500"]
+    assert spool.append(3.0, b"3:Tag3:100") == end
+
+
+def test_records_continue_in_the_next_segment(tmp_path):
+    spool = Spool(tmp_path, SEGMENT_SIZE)
+    payload = b"x" * (SEGMENT_SIZE // 3)
+    for number in range(5):
+        spool.append(number, payload)
+
+    records = spool.read(0, 10)
+
+    assert [record.received_at for record in records] == [0, 1, 2, 3, 4]
+    assert records[2].start == SEGMENT_SIZE
+    assert records[2].end == SEGMENT_SIZE + HEADER.size + len(payload)
+
+    spool.commit(records[3].start)
+
+    assert sorted(path.name for path in tmp_path.glob("*.spool")) == [
+        "00000001.spool",
+        "00000002.spool",
+    ]
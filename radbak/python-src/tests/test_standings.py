@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from api.standings import RaceStandings, Standings
+
+START = datetime(2024, 4, 25, 12, 0)
+
+
+def at(minutes: int) -> datetime:
+    return START + timedelta(minutes=minutes)
+
+
+def make_race() -> RaceStandings:
+    race = RaceStandings(1)
+    for runner_id in (1, 2, 3):
+        race.add_runner(runner_id)
+    race.record(1, 100, at(10))
+    race.record(2, 100, at(12))
+    race.record(1, 200, at(20))
+    return race
+
+
+def test_orders_by_checkpoints_then_time():
+    race = make_race()
+
+    assert [standing.runner_id for standing in race.top()] == [1, 2, 3]
+    assert race.rank(3) == 3
+
+
+def test_gap_to_leader():
+    standing = make_race().standing(2)
+
+    assert standing.rank == 2
+    assert standing.checkpoints_behind == 1
+    assert standing.seconds_behind == 120
+
+
+def test_overtake_moves_runner():
+    race = make_race()
+    race.record(2, 200, at(19))
+    race.record(3, 100, at(11))
+
+    assert [standing.runner_id for standing in race.top(2)] == [2, 1]
+    assert race.rank(3) == 3
+
+
+def test_same_passing_counted_once():
+    race = make_race()
+
+    assert race.record(1, 200, at(20)) is False
+    assert race.standing(1).passed == 2
+
+
+def test_ties_share_rank():
+    race = RaceStandings(1)
+    race.record(1, 100, at(5))
+    race.record(2, 100, at(5))
+
+    assert race.rank(1) == race.rank(2) == 1
+
+
+async def test_unfollowed_race_is_rebuilt_once():
+    standings = Standings()
+    rebuilt = []
+
+    async def refresh(race_id):
+        rebuilt.append(race_id)
+
+    standings.refresh = refresh
+    standings.load(1, [10], [])
+
+    await standings.apply_passings(
+        [(1, 10, 100, at(5)), (2, 20, 200, at(6)), (2, 21, 200, at(7))]
+    )
+
+    assert rebuilt == [2]
+    assert standings.get(1).standing(10).passed == 1
+
+
+class FakeResult:
+    def __init__(self, row) -> None:
+        self.row = row
+
+    def first(self):
+        return self.row
+
+
+class FakeConnection:
+    async def execute(self, statement, params=None):
+        return FakeResult(SimpleNamespace(archivedat=START))
+
+
+async def test_archived_race_is_not_followed():
+    standings = Standings()
+    standings.load(1, [10], [])
+
+    assert await standings.rebuild(FakeConnection(), 1) is None
+    assert standings.get(1) is None